@@ -0,0 +1,124 @@
+import math
+import threading
+import time
+from collections import deque
+
+import falcon
+import redis
+from app.tasks import COMPLETED_TASKS_KEY
+from app.lanes import LANES
+
+SAMPLE_INTERVAL = 0.25  # Seconds between samples of the queue depth
+RATE_WINDOW = 40  # Number of busy samples the drain rate is measured over
+
+
+class AdmissionController(object):
+    """ Rejects requests the worker can't keep up with, based on the broker queue depth and the worker drain rate
+
+        A background thread samples the depth of every lane and the number of tasks completed from it every
+        SAMPLE_INTERVAL seconds. A lane's drain rate is measured only over samples where it was not empty, so idle
+        periods don't lower it. Requests are rejected with 503 while admission_max_queue tasks or more are queued
+        over all lanes, models' lanes included, and if admission_shed_sync is set, sync requests are rejected with 429
+        when their lane is not expected to drain within their timeout. Both carry a Retry-After of the estimated time
+        until the request would be admitted """
+
+    def __init__(self, redis_client, runtime_config, lanes=LANES):
+        self._redis = redis_client
+        self._config = runtime_config
+        self._lanes = list(lanes)
+        self._lock = threading.Lock()
+
+        self._depths = {lane: 0 for lane in self._lanes}
+        self._rates = {lane: 0. for lane in self._lanes}  # Tasks per second, 0.0 while unknown
+        self._busy_samples = {lane: deque(maxlen=RATE_WINDOW) for lane in self._lanes}  # (completed tasks, seconds)
+
+        self._admitted = 0
+        self._rejected_backlog = 0
+        self._rejected_sync = 0
+
+        self._thread = threading.Thread(target=self._sample_forever, name='denzel-admission', daemon=True)
+        self._thread.start()
+
+    def admit(self, sync_timeout: float, lane: str):
+        """ Raises HTTP 503 or 429 if the request should be shed, sync_timeout == 0 means an async request """
+
+        depth, rate = sum(self._depths.values()), sum(self._rates.values())
+
+        max_queue = self._config['admission_max_queue']
+        if 0 < max_queue <= depth:
+            self._count('_rejected_backlog')
+            raise falcon.HTTPServiceUnavailable(
+                title='Overloaded',
+                description='{} tasks are queued, the limit is {}'.format(depth, max_queue),
+                retry_after=self._drain_time(depth - max_queue + 1, rate))
+
+        lane_depth, lane_rate = self._depths[lane], self._rates[lane]
+        if sync_timeout and self._config['admission_shed_sync'] and lane_rate > 0:
+            expected_wait = (lane_depth + 1) / lane_rate
+            if expected_wait > sync_timeout:
+                self._count('_rejected_sync')
+                raise falcon.HTTPTooManyRequests(
+                    title='Overloaded',
+                    description='Expected wait of {:.2f} seconds exceeds the timeout'.format(expected_wait),
+                    retry_after=self._drain_time(lane_depth + 1 - sync_timeout * lane_rate, lane_rate))
+
+        self._count('_admitted')
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'queue_depth': sum(self._depths.values()),
+                    'drain_rate': sum(self._rates.values()),
+                    'lanes': {lane: {'queue_depth': self._depths[lane], 'drain_rate': self._rates[lane]}
+                              for lane in self._lanes},
+                    'admitted': self._admitted,
+                    'rejected_backlog': self._rejected_backlog,
+                    'rejected_sync': self._rejected_sync}
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @staticmethod
+    def _drain_time(tasks: float, rate: float) -> int:
+        """ Estimates the seconds it takes to drain tasks from the queue, at least 1 """
+
+        if rate <= 0:
+            return 1
+
+        return max(int(math.ceil(tasks / rate)), 1)
+
+    def _sample(self):
+        """ Reads the depth and completed tasks counter of every lane in a single round trip """
+
+        pipeline = self._redis.pipeline(transaction=False)
+        for lane in self._lanes:
+            pipeline.llen(lane)
+            pipeline.get(COMPLETED_TASKS_KEY.format(lane))
+        values = pipeline.execute()
+
+        return {lane: (depth, int(completed or 0))
+                for lane, depth, completed in zip(self._lanes, values[::2], values[1::2])}
+
+    def _sample_forever(self):
+        last_time = last_samples = None
+
+        while True:
+            try:
+                samples = self._sample()
+                now = time.monotonic()
+
+                for lane, (depth, completed) in samples.items():
+                    # The lane's workers were busy throughout the interval only if tasks were waiting at its start
+                    if last_time is not None and self._depths[lane] > 0 and completed >= last_samples[lane][1]:
+                        busy_samples = self._busy_samples[lane]
+                        busy_samples.append((completed - last_samples[lane][1], now - last_time))
+                        seconds = sum(duration for _, duration in busy_samples)
+                        self._rates[lane] = sum(count for count, _ in busy_samples) / seconds if seconds > 0 else 0.
+
+                    self._depths[lane] = depth
+
+                last_time, last_samples = now, samples
+            except redis.RedisError:  # Redis unavailable, keep the last estimates
+                last_time = last_samples = None
+
+            time.sleep(SAMPLE_INTERVAL)
@@ -0,0 +1,401 @@
+import asyncio
+import concurrent.futures
+
+import ujson
+import redis
+import falcon
+from celery.exceptions import TimeoutError as CeleryTimeoutError
+from celery.result import AsyncResult
+from app.tasks import invoke_predict, enqueue, verify_input
+from app.lanes import choose_lane, model_lane, LANES, SYNC_LANE, ASYNC_LANE, BULK_LANE
+from app.models import model_names, load_pipeline
+from app.batching import Batcher
+from app.cache import PredictionCache, IDEMPOTENCY_HEADER
+from app.streaming import stream_predictions, NDJSON_CONTENT_TYPE
+from app.results import fetch_statuses, any_ready, wait_for_any, MAX_STATUS_WAIT
+from app.runtime_config import RuntimeConfig
+from app.codecs import decode_body, encode_body, accepted_media_type, configure_celery_serializer, UnsupportedMediaType
+from app.compression import DecompressingRequest, CompressionMiddleware, CompressionStats
+from app.admission import AdmissionController
+from app.health import HealthMonitor
+from app.tracing import Trace, untraced_result, TRACE_ID_HEADER, MODEL_VERSION_HEADER
+from app.metrics import Metrics, MetricsMiddleware, exposition, worker_snapshots, \
+    METRICS_CONTENT_TYPE, WORKER_METRICS_KEY
+from app.schema import verifier
+
+INFO_FILE = './app/assets/info.txt'
+TIMEOUT_ERRORS = (CeleryTimeoutError, concurrent.futures.TimeoutError, asyncio.TimeoutError)  # Sync result not ready
+
+
+def parse_json(raw_json: bytes):
+    """ Parses a request body, raises HTTP 400 on failure """
+
+    try:
+        return ujson.loads(raw_json.decode())
+    except ValueError:
+        raise falcon.HTTPError(falcon.HTTP_400,
+                               'Malformed JSON',
+                               'Could not decode the request body.')
+
+
+def parse_body(raw: bytes, content_type, params: dict):
+    """ Parses a request body by its content type, raises HTTP 415 or 400 on failure """
+
+    try:
+        return decode_body(raw, content_type, params)
+    except UnsupportedMediaType as ex:
+        raise falcon.HTTPError(falcon.HTTP_415,
+                               'Unsupported media type',
+                               str(ex))
+    except Exception:
+        raise falcon.HTTPError(falcon.HTTP_400,
+                               'Malformed body',
+                               'Could not decode the request body.')
+
+
+def response_media_type(req) -> str:
+    """ Chooses the response media type by the Accept header, JSON unless the client asks for msgpack """
+
+    return accepted_media_type(req.accept)
+
+
+def verify_model(model: str):
+    """ Verifies a model of app/logic/models was requested, if any, raises HTTP 404 otherwise """
+
+    if model and model not in model_verifiers:
+        raise falcon.HTTPNotFound(title='Unknown model',
+                                  description='No model named "{}" in app/logic/models'.format(model))
+
+
+def verify(json_data, model=''):
+    """ Verifies parsed request fields by the model's pipeline, raises HTTP 400 on failure """
+
+    try:
+        return (model_verifiers[model] if model else verify_input)(json_data)
+    except Exception as ex:
+        raise falcon.HTTPError(falcon.HTTP_400,
+                               'Bad input format',
+                               str(ex))
+
+
+def verify_status_query(query):
+    """ Verifies a bulk status query, raises HTTP 400 on failure
+
+        :return: Task IDs and seconds to wait for any of them to be ready """
+
+    task_ids = query.get('task_ids') if isinstance(query, dict) else None
+    if not isinstance(task_ids, list) or not task_ids or not all(isinstance(task_id, str) for task_id in task_ids):
+        raise falcon.HTTPError(falcon.HTTP_400,
+                               'Bad status query',
+                               'task_ids must be a non empty list of task IDs')
+
+    try:
+        wait = float(query.get('wait') or 0.)
+    except (TypeError, ValueError):
+        raise falcon.HTTPError(falcon.HTTP_400,
+                               'Bad status query',
+                               'wait must be a number of seconds')
+
+    return task_ids, min(max(wait, 0.), MAX_STATUS_WAIT)
+
+
+class InfoResource(object):
+
+    def __init__(self, health):
+        self._health = health
+
+    def on_get(self, req, resp):
+        """Handles GET requests"""
+
+        resp.status = falcon.HTTP_200
+
+        with open(INFO_FILE) as info_file:
+            info = ''.join(info_file)
+
+        # Versions served by the ready worker processes, more than one while reloading
+        model_versions = ', '.join(self._health.model_versions)
+        if model_versions:
+            resp.set_header(MODEL_VERSION_HEADER, model_versions)
+            info = '{}\n\nModel version: {}\n'.format(info.rstrip('\n'), model_versions)
+
+        resp.body = info
+
+
+class HealthResource(object):
+
+    def __init__(self, health):
+        self._health = health
+
+    def on_get(self, req, resp):
+        """Handles GET requests"""
+
+        status = self._health.status()
+        resp.status = falcon.HTTP_200 if status['ready'] else falcon.HTTP_503
+        resp.body = ujson.dumps(status)
+
+
+class StatusResource(object):
+
+    def on_get(self, req, resp, task_id):
+        """Handles GET requests"""
+
+        task_result = AsyncResult(task_id)
+        result = {'status': task_result.status, 'result': untraced_result(task_result.result)[0]}
+        resp.status = falcon.HTTP_200
+        resp.content_type = response_media_type(req)
+        resp.data = encode_body(result, resp.content_type)
+
+
+class BulkStatusResource(object):
+
+    def __init__(self, redis_client):
+        self._redis = redis_client
+
+    def on_get(self, req, resp):
+        """Handles GET requests, task IDs are passed comma separated"""
+
+        self._respond(req, resp, verify_status_query({'task_ids': req.get_param_as_list('task_ids'),
+                                                      'wait': req.get_param('wait')}))
+
+    def on_post(self, req, resp):
+        """Handles POST requests, for queries too long for a URL"""
+
+        self._respond(req, resp, verify_status_query(parse_json(req.stream.read())))
+
+    def _respond(self, req, resp, query):
+        task_ids, wait = query
+
+        statuses = fetch_statuses(self._redis, task_ids)
+        if wait and not any_ready(statuses):  # Long poll
+            wait_for_any(self._redis, task_ids, timeout=wait)
+            statuses = fetch_statuses(self._redis, task_ids)
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = response_media_type(req)
+        resp.data = encode_body(statuses, resp.content_type)
+
+
+class StatsResource(object):
+
+    def __init__(self, runtime_config, batcher, cache, compression_stats, admission):
+        self._config = runtime_config
+        self._batcher = batcher
+        self._cache = cache
+        self._compression_stats = compression_stats
+        self._admission = admission
+
+    def on_get(self, req, resp):
+        """Handles GET requests"""
+
+        resp.status = falcon.HTTP_200
+        resp.body = ujson.dumps({'config': self._config.snapshot(),
+                                 'batching': self._batcher.stats(),
+                                 'cache': self._cache.stats(),
+                                 'compression': self._compression_stats.stats(),
+                                 'admission': self._admission.stats()})
+
+
+class MetricsResource(object):
+
+    def __init__(self, metrics, redis_client, admission):
+        self._metrics = metrics
+        self._redis = redis_client
+        self._admission = admission
+
+    def on_get(self, req, resp):
+        """Handles GET requests, in the Prometheus text format"""
+
+        for lane, lane_stats in self._admission.stats()['lanes'].items():
+            self._metrics.set('denzel_queue_depth', lane_stats['queue_depth'], lane=lane)
+
+        try:
+            snapshots, forgotten = worker_snapshots(self._redis.hgetall(WORKER_METRICS_KEY))
+            if forgotten:  # Processes which exited, or were killed
+                self._redis.hdel(WORKER_METRICS_KEY, *forgotten)
+        except redis.RedisError:  # Report the API's own metrics regardless
+            snapshots = []
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = METRICS_CONTENT_TYPE
+        resp.body = exposition(self._metrics.snapshot(), snapshots)
+
+
+class PredictResource(object):
+
+    def __init__(self, runtime_config, batcher, cache, admission, metrics, redis_client):
+        self._config = runtime_config
+        self._batcher = batcher
+        self._cache = cache
+        self._admission = admission
+        self._metrics = metrics
+        self._redis = redis_client
+
+    def on_post(self, req, resp, model=''):
+        """Handles POST requests, of /predict/{model} for the models of app/logic/models"""
+
+        verify_model(model)
+        trace = Trace()
+
+        with self._metrics.timer('denzel_api_parse_seconds'):
+            # Read request
+            try:
+                raw_body = req.stream.read()
+            except falcon.HTTPError:  # e.g. decompressed beyond max_decompressed_size
+                raise
+            except Exception as ex:
+                raise falcon.HTTPError(falcon.HTTP_400,
+                                       'Stream read error',
+                                       str(ex))
+
+            json_data = parse_body(raw_body, req.content_type, req.params)
+        trace.mark('parse')
+
+        with self._metrics.timer('denzel_api_verify_seconds'):
+            json_data = verify(json_data, model)
+        trace.mark('verify')
+
+        media = response_media_type(req)
+        traced = True  # The trace ID is the task ID, unless answered by another request's task from the cache
+
+        try:
+            resp.status = falcon.HTTP_200
+            resp.content_type = media
+
+            sync_response_timeout = self._respond_synchronically()
+
+            if self._cache.enabled:  # Identical requests are answered from cache or wait for the one in flight
+                key = self._cache.key(json_data, sync=bool(sync_response_timeout), media=media,
+                                      idempotency_key=req.get_header(IDEMPOTENCY_HEADER), model=model)
+                traced = False
+
+                def compute():
+                    nonlocal traced
+                    traced = True
+                    return self._invoke(json_data, sync_response_timeout, media, len(raw_body), trace, model)
+
+                resp.data = self._cache.get_or_compute(key, compute, timeout=sync_response_timeout or None)
+            else:
+                resp.data = self._invoke(json_data, sync_response_timeout, media, len(raw_body), trace, model)
+        except falcon.HTTPError:  # Shed by admission control
+            raise
+        except TIMEOUT_ERRORS:
+            raise falcon.HTTPGatewayTimeout(title='Prediction timed out',
+                                            description='No result within the synchronous timeout')
+        except Exception as ex:
+            raise falcon.HTTPError(falcon.HTTP_400,
+                                   'Error invoking predict',
+                                   str(ex))
+
+        if traced:
+            resp.set_header(TRACE_ID_HEADER, trace.trace_id)
+        if sync_response_timeout:
+            trace.mark('respond')
+            resp.set_header('Server-Timing', trace.server_timing())
+            if trace.model_version:  # Unset until the first "denzel reload-model"
+                resp.set_header(MODEL_VERSION_HEADER, trace.model_version)
+
+    def _invoke(self, json_data, sync_response_timeout: float, media: str, size: int, trace: Trace,
+                model='') -> bytes:
+        """ Invokes the prediction task in the lane matching the request, returns the response body encoded as media
+
+            The request's task ID is its trace ID, sync results carry the trace as continued with the worker's stages.
+            Requests of a model of app/logic/models go to the model's own lane, and are not batched by the API """
+
+        lane = model_lane(model) if model else choose_lane(bool(sync_response_timeout), size, self._config)
+        self._admission.admit(sync_response_timeout, lane)
+
+        if self._batcher.enabled and lane in (SYNC_LANE, ASYNC_LANE):  # Coalesce with concurrent requests
+            batched = self._batcher.submit(json_data, sync_response_timeout, trace)
+            if sync_response_timeout:  # Sync response
+                result = batched.result(timeout=sync_response_timeout)
+            else:  # Async response
+                task_id = batched.result()
+        else:
+            trace.mark('enqueue')
+            task = enqueue(invoke_predict, (json_data,), {'sync': bool(sync_response_timeout)}, lane,
+                           task_id=trace.trace_id, traces=[trace],
+                           ignore_result=not sync_response_timeout and not self._config['store_async_results'])
+            if sync_response_timeout:  # Sync response, carrying the trace continued by the worker
+                result, worker_trace = untraced_result(task.get(timeout=sync_response_timeout))
+                if worker_trace is not None:
+                    trace.update(worker_trace)
+            else:  # Async response
+                task_id = task.id
+
+        if sync_response_timeout:
+            return encode_body(result, media)
+
+        return encode_body({
+            'status': 'success',
+            'data': {
+                'task_id': task_id
+            }}, media)
+
+    def _respond_synchronically(self) -> float:
+        """ Checks the configuration for the type of response (sync/async)
+
+            If timeout == 0.0, respond asynchronically, if > 0.0 respond synchronically with the value as timeout """
+
+        return self._config['synchronous_timeout']
+
+
+class PredictStreamResource(object):
+
+    def __init__(self, runtime_config, admission):
+        self._config = runtime_config
+        self._admission = admission
+
+    def on_post(self, req, resp):
+        """Handles POST requests of newline delimited JSON records, streaming back a response line per record"""
+
+        # Streams wait as long as needed, only the backlog limit applies
+        self._admission.admit(sync_timeout=0., lane=BULK_LANE)
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = NDJSON_CONTENT_TYPE
+        resp.stream = stream_predictions(iter(req.stream.readline, b''),
+                                         chunk_size=max(self._config['stream_chunk_size'], 1),
+                                         window=max(self._config['stream_window'], 1),
+                                         timeout=self._config['stream_timeout'])
+
+
+# Models of app/logic/models, sharing the API and redis, with the verify_input (and INPUT_SCHEMA) of each
+model_verifiers = {model: verifier(load_pipeline(model)) for model in model_names()}
+
+# Shared components
+redis_client = redis.Redis(host='redis')
+runtime_config = RuntimeConfig(redis_client)
+batcher = Batcher(runtime_config)
+cache = PredictionCache(runtime_config)
+compression_stats = CompressionStats()
+admission = AdmissionController(redis_client, runtime_config,
+                                lanes=LANES + [model_lane(model) for model in model_verifiers])
+metrics = Metrics()
+configure_celery_serializer(runtime_config, metrics)
+health = HealthMonitor(redis_client)
+
+# Never change this.
+app = falcon.API(request_type=DecompressingRequest,
+                 middleware=[MetricsMiddleware(metrics),
+                             CompressionMiddleware(runtime_config, compression_stats)])
+
+# Create resources
+info = InfoResource(health)
+health_resource = HealthResource(health)
+predict = PredictResource(runtime_config, batcher, cache, admission, metrics, redis_client)
+predict_stream = PredictStreamResource(runtime_config, admission)
+status = StatusResource()
+bulk_status = BulkStatusResource(redis_client)
+stats = StatsResource(runtime_config, batcher, cache, compression_stats, admission)
+metrics_resource = MetricsResource(metrics, redis_client, admission)
+
+# Routing
+app.add_route('/info', info)
+app.add_route('/health', health_resource)
+app.add_route('/predict', predict)
+app.add_route('/predict/stream', predict_stream)
+app.add_route('/predict/{model}', predict)  # Matched after /predict/stream
+app.add_route('/status/{task_id}', status)
+app.add_route('/status', bulk_status)
+app.add_route('/stats', stats)
+app.add_route('/metrics', metrics_resource)
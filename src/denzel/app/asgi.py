@@ -0,0 +1,428 @@
+import asyncio
+import functools
+import logging
+
+import ujson
+import falcon
+import falcon.asgi
+import redis.asyncio as aioredis
+from celery import states
+from app.api import INFO_FILE, TIMEOUT_ERRORS, parse_json, parse_body, response_media_type, verify, verify_model, \
+    verify_status_query, runtime_config, batcher, cache, compression_stats, admission, metrics, health
+from app.tasks import invoke_predict, enqueue
+from app.lanes import choose_lane, model_lane, SYNC_LANE, ASYNC_LANE, BULK_LANE
+from app.results import result_key, decode_meta, any_ready
+from app.cache import IDEMPOTENCY_HEADER
+from app.codecs import encode_body
+from app.compression import AsyncDecompressingRequest, AsyncCompressionMiddleware
+from app.tracing import Trace, TRACE_ID_HEADER, MODEL_VERSION_HEADER
+from app.metrics import AsyncMetricsMiddleware, exposition, worker_snapshots, \
+    METRICS_CONTENT_TYPE, WORKER_METRICS_KEY
+from app.streaming import stream_predictions_async, NDJSON_CONTENT_TYPE
+
+logger = logging.getLogger('denzel.api')
+
+
+class ResultListener(object):
+    """ Awaits task results through the notifications the redis backend publishes when storing them
+
+        All of the waiting requests share a single pub/sub connection, so waiting costs no thread and no polling """
+
+    def __init__(self, redis_client):
+        self._redis = redis_client
+        self._pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        self._waiters = {}  # Result key to the futures waiting for it
+        self._reader = None
+
+    async def wait(self, task_id: str, timeout: float) -> dict:
+        """ Waits for a task to be ready, raises asyncio.TimeoutError after timeout seconds
+
+            The response includes the 'trace' the worker returned along with a sync result """
+
+        key = result_key(task_id)
+        future = asyncio.get_event_loop().create_future()
+
+        try:
+            await self._subscribe([key], future)
+
+            # The result might have been stored before subscribing
+            response = decode_meta(await self._redis.get(key), with_trace=True)
+            if response['status'] not in states.READY_STATES:
+                response = await asyncio.wait_for(future, timeout=timeout)
+        finally:
+            await self._unsubscribe([key], future)
+
+        return response
+
+    async def wait_any(self, task_ids, timeout: float):
+        """ Waits until any of the tasks is ready or timeout seconds passed """
+
+        keys = [result_key(task_id) for task_id in task_ids]
+        future = asyncio.get_event_loop().create_future()
+
+        try:
+            await self._subscribe(keys, future)
+
+            # A task might have been ready before subscribing
+            payloads = await self._redis.mget(keys)
+            if not any(decode_meta(payload)['status'] in states.READY_STATES for payload in payloads):
+                await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await self._unsubscribe(keys, future)
+
+    async def _subscribe(self, keys, future):
+        new_keys = []
+        for key in keys:
+            waiters = self._waiters.setdefault(key, [])
+            waiters.append(future)
+            if len(waiters) == 1:
+                new_keys.append(key)
+
+        if new_keys:
+            await self._pubsub.subscribe(*new_keys)
+
+        if self._reader is None or self._reader.done():  # Started on first use, restarted should it ever stop
+            self._reader = asyncio.ensure_future(self._read())
+
+    async def _unsubscribe(self, keys, future):
+        unused_keys = []
+        for key in keys:
+            waiters = self._waiters[key]
+            waiters.remove(future)
+            if not waiters:
+                del self._waiters[key]
+                unused_keys.append(key)
+
+        if unused_keys:
+            await self._pubsub.unsubscribe(*unused_keys)
+
+    async def _read(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(timeout=1.)
+            except aioredis.RedisError:
+                await asyncio.sleep(1)  # Redis unavailable, waiters will time out meanwhile
+                continue
+            except Exception:  # e.g. read before the first subscription, a reader that stops fails every wait
+                logger.exception('Failed reading result notifications')
+                await asyncio.sleep(1)
+                continue
+
+            if message is None or message['type'] != 'message':
+                continue
+
+            try:
+                response = decode_meta(message['data'], with_trace=True)
+            except Exception:  # An unexpected payload fails its own waiters only, by their timeout
+                logger.exception('Failed decoding the result of {}'.format(message['channel']))
+                continue
+
+            if response['status'] not in states.READY_STATES:
+                continue
+
+            for future in self._waiters.get(message['channel'], []):
+                if not future.done():
+                    future.set_result(response)
+
+
+class InfoResource(object):
+
+    def __init__(self, health):
+        self._health = health
+
+    async def on_get(self, req, resp):
+        """Handles GET requests"""
+
+        resp.status = falcon.HTTP_200
+
+        with open(INFO_FILE) as info_file:
+            info = ''.join(info_file)
+
+        # Versions served by the ready worker processes, more than one while reloading
+        model_versions = ', '.join(self._health.model_versions)
+        if model_versions:
+            resp.set_header(MODEL_VERSION_HEADER, model_versions)
+            info = '{}\n\nModel version: {}\n'.format(info.rstrip('\n'), model_versions)
+
+        resp.text = info
+
+
+class HealthResource(object):
+
+    def __init__(self, health):
+        self._health = health
+
+    async def on_get(self, req, resp):
+        """Handles GET requests"""
+
+        status = self._health.status()
+        resp.status = falcon.HTTP_200 if status['ready'] else falcon.HTTP_503
+        resp.text = ujson.dumps(status)
+
+
+class StatusResource(object):
+
+    def __init__(self, redis_client):
+        self._redis = redis_client
+
+    async def on_get(self, req, resp, task_id):
+        """Handles GET requests"""
+
+        result = decode_meta(await self._redis.get(result_key(task_id)))
+        resp.status = falcon.HTTP_200
+        resp.content_type = response_media_type(req)
+        resp.data = encode_body(result, resp.content_type)
+
+
+class BulkStatusResource(object):
+
+    def __init__(self, redis_client, listener):
+        self._redis = redis_client
+        self._listener = listener
+
+    async def on_get(self, req, resp):
+        """Handles GET requests, task IDs are passed comma separated"""
+
+        await self._respond(req, resp, verify_status_query({'task_ids': req.get_param_as_list('task_ids'),
+                                                            'wait': req.get_param('wait')}))
+
+    async def on_post(self, req, resp):
+        """Handles POST requests, for queries too long for a URL"""
+
+        await self._respond(req, resp, verify_status_query(parse_json(await req.stream.read())))
+
+    async def _respond(self, req, resp, query):
+        task_ids, wait = query
+
+        statuses = await self._fetch(task_ids)
+        if wait and not any_ready(statuses):  # Long poll
+            await self._listener.wait_any(task_ids, timeout=wait)
+            statuses = await self._fetch(task_ids)
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = response_media_type(req)
+        resp.data = encode_body(statuses, resp.content_type)
+
+    async def _fetch(self, task_ids) -> dict:
+        payloads = await self._redis.mget([result_key(task_id) for task_id in task_ids])
+
+        return {task_id: decode_meta(payload) for task_id, payload in zip(task_ids, payloads)}
+
+
+class StatsResource(object):
+
+    def __init__(self, runtime_config, batcher, cache, compression_stats, admission):
+        self._config = runtime_config
+        self._batcher = batcher
+        self._cache = cache
+        self._compression_stats = compression_stats
+        self._admission = admission
+
+    async def on_get(self, req, resp):
+        """Handles GET requests"""
+
+        resp.status = falcon.HTTP_200
+        resp.text = ujson.dumps({'config': self._config.snapshot(),
+                                 'batching': self._batcher.stats(),
+                                 'cache': self._cache.stats(),
+                                 'compression': self._compression_stats.stats(),
+                                 'admission': self._admission.stats()})
+
+
+class MetricsResource(object):
+
+    def __init__(self, metrics, redis_client, admission):
+        self._metrics = metrics
+        self._redis = redis_client
+        self._admission = admission
+
+    async def on_get(self, req, resp):
+        """Handles GET requests, in the Prometheus text format"""
+
+        for lane, lane_stats in self._admission.stats()['lanes'].items():
+            self._metrics.set('denzel_queue_depth', lane_stats['queue_depth'], lane=lane)
+
+        try:
+            snapshots, forgotten = worker_snapshots(await self._redis.hgetall(WORKER_METRICS_KEY))
+            if forgotten:  # Processes which exited, or were killed
+                await self._redis.hdel(WORKER_METRICS_KEY, *forgotten)
+        except aioredis.RedisError:  # Report the API's own metrics regardless
+            snapshots = []
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = METRICS_CONTENT_TYPE
+        resp.text = exposition(self._metrics.snapshot(), snapshots)
+
+
+class PredictResource(object):
+
+    def __init__(self, runtime_config, batcher, cache, admission, metrics, redis_client, listener):
+        self._config = runtime_config
+        self._batcher = batcher
+        self._cache = cache
+        self._admission = admission
+        self._metrics = metrics
+        self._redis = redis_client
+        self._listener = listener
+
+    async def on_post(self, req, resp, model=''):
+        """Handles POST requests, of /predict/{model} for the models of app/logic/models"""
+
+        verify_model(model)
+        trace = Trace()
+
+        with self._metrics.timer('denzel_api_parse_seconds'):
+            # Read request
+            try:
+                raw_body = await req.stream.read()
+            except falcon.HTTPError:  # e.g. decompressed beyond max_decompressed_size
+                raise
+            except Exception as ex:
+                raise falcon.HTTPError(falcon.HTTP_400,
+                                       'Stream read error',
+                                       str(ex))
+
+            json_data = parse_body(raw_body, req.content_type, req.params)
+        trace.mark('parse')
+
+        with self._metrics.timer('denzel_api_verify_seconds'):
+            json_data = verify(json_data, model)
+        trace.mark('verify')
+
+        media = response_media_type(req)
+        traced = True  # The trace ID is the task ID, unless answered by another request's task from the cache
+
+        try:
+            resp.status = falcon.HTTP_200
+            resp.content_type = media
+
+            sync_response_timeout = self._config['synchronous_timeout']
+
+            if self._cache.enabled:  # Identical requests are answered from cache or wait for the one in flight
+                key = self._cache.key(json_data, sync=bool(sync_response_timeout), media=media,
+                                      idempotency_key=req.get_header(IDEMPOTENCY_HEADER), model=model)
+                traced = False
+
+                def compute():
+                    nonlocal traced
+                    traced = True
+                    return self._invoke(json_data, sync_response_timeout, media, len(raw_body), trace, model)
+
+                resp.data = await self._cache.get_or_compute_async(key, compute, timeout=sync_response_timeout or None)
+            else:
+                resp.data = await self._invoke(json_data, sync_response_timeout, media, len(raw_body), trace, model)
+        except falcon.HTTPError:  # Shed by admission control
+            raise
+        except TIMEOUT_ERRORS:
+            raise falcon.HTTPGatewayTimeout(title='Prediction timed out',
+                                            description='No result within the synchronous timeout')
+        except Exception as ex:
+            raise falcon.HTTPError(falcon.HTTP_400,
+                                   'Error invoking predict',
+                                   str(ex))
+
+        if traced:
+            resp.set_header(TRACE_ID_HEADER, trace.trace_id)
+        if sync_response_timeout:
+            trace.mark('respond')
+            resp.set_header('Server-Timing', trace.server_timing())
+            if trace.model_version:  # Unset until the first "denzel reload-model"
+                resp.set_header(MODEL_VERSION_HEADER, trace.model_version)
+
+    async def _invoke(self, json_data, sync_response_timeout: float, media: str, size: int, trace: Trace,
+                      model='') -> bytes:
+        """ Invokes the prediction task in the lane matching the request, returns the response body encoded as media
+
+            The request's task ID is its trace ID, sync results carry the trace as continued with the worker's stages.
+            Requests of a model of app/logic/models go to the model's own lane, and are not batched by the API """
+
+        lane = model_lane(model) if model else choose_lane(bool(sync_response_timeout), size, self._config)
+        self._admission.admit(sync_response_timeout, lane)
+
+        if self._batcher.enabled and lane in (SYNC_LANE, ASYNC_LANE):  # Coalesce with concurrent requests
+            batched = asyncio.wrap_future(self._batcher.submit(json_data, sync_response_timeout, trace))
+            if sync_response_timeout:  # Sync response
+                result = await asyncio.wait_for(batched, timeout=sync_response_timeout)
+            else:  # Async response
+                task_id = await batched
+        else:
+            # Publishing to the broker is blocking, keep it off the event loop
+            trace.mark('enqueue')
+            task = await asyncio.get_event_loop().run_in_executor(
+                None, functools.partial(enqueue, invoke_predict, (json_data,), {'sync': bool(sync_response_timeout)},
+                                        lane, task_id=trace.trace_id, traces=[trace],
+                                        ignore_result=not sync_response_timeout and
+                                        not self._config['store_async_results']))
+            if sync_response_timeout:  # Sync response
+                response = await self._listener.wait(task.id, timeout=sync_response_timeout)
+                if response['status'] != states.SUCCESS:
+                    raise RuntimeError(response['result'])
+                result = response['result']
+                if response['trace'] is not None:  # Continued by the worker
+                    trace.update(response['trace'])
+            else:  # Async response
+                task_id = task.id
+
+        if sync_response_timeout:
+            return encode_body(result, media)
+
+        return encode_body({
+            'status': 'success',
+            'data': {
+                'task_id': task_id
+            }}, media)
+
+
+class PredictStreamResource(object):
+
+    def __init__(self, runtime_config, admission, listener):
+        self._config = runtime_config
+        self._admission = admission
+        self._listener = listener
+
+    async def on_post(self, req, resp):
+        """Handles POST requests of newline delimited JSON records, streaming back a response line per record"""
+
+        # Streams wait as long as needed, only the backlog limit applies
+        self._admission.admit(sync_timeout=0., lane=BULK_LANE)
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = NDJSON_CONTENT_TYPE
+        resp.stream = stream_predictions_async(req.stream,
+                                               chunk_size=max(self._config['stream_chunk_size'], 1),
+                                               window=max(self._config['stream_window'], 1),
+                                               timeout=self._config['stream_timeout'],
+                                               listener=self._listener)
+
+
+# Never change this.
+app = falcon.asgi.App(request_type=AsyncDecompressingRequest,
+                      middleware=[AsyncMetricsMiddleware(metrics),
+                                  AsyncCompressionMiddleware(runtime_config, compression_stats)])
+
+# Shared components
+async_redis_client = aioredis.Redis(host='redis')
+listener = ResultListener(async_redis_client)
+
+# Create resources
+info = InfoResource(health)
+health_resource = HealthResource(health)
+predict = PredictResource(runtime_config, batcher, cache, admission, metrics, async_redis_client, listener)
+predict_stream = PredictStreamResource(runtime_config, admission, listener)
+status = StatusResource(async_redis_client)
+bulk_status = BulkStatusResource(async_redis_client, listener)
+stats = StatsResource(runtime_config, batcher, cache, compression_stats, admission)
+metrics_resource = MetricsResource(metrics, async_redis_client, admission)
+
+# Routing
+app.add_route('/info', info)
+app.add_route('/health', health_resource)
+app.add_route('/predict', predict)
+app.add_route('/predict/stream', predict_stream)
+app.add_route('/predict/{model}', predict)  # Matched after /predict/stream
+app.add_route('/status/{task_id}', status)
+app.add_route('/status', bulk_status)
+app.add_route('/stats', stats)
+app.add_route('/metrics', metrics_resource)
@@ -0,0 +1,104 @@
+import json
+import math
+import time
+
+import redis
+from celery.utils.log import get_logger
+from celery.worker.autoscale import Autoscaler
+from app.runtime_config import parse_settings
+from app.tasks import redis_client, SENT_HEADER
+
+SCALING_LOG_KEY = 'denzel:scaling_log'  # List of the latest scaling decisions, newest first
+SCALING_LOG_MAX_LEN = 1000
+TICK = 1.  # Seconds between evaluations of the policy
+SETTINGS = ['autoscale_max_depth', 'autoscale_max_wait', 'autoscale_up_cooldown', 'autoscale_down_cooldown']
+
+logger = get_logger(__name__)
+
+
+class QueueAutoscaler(Autoscaler):
+    """ Grows and shrinks a worker's processes, within its --autoscale bounds, by the queues it consumes
+
+        Processes are added while more than autoscale_max_depth tasks per process are queued, or the oldest queued
+        task waited more than autoscale_max_wait seconds, at most once every autoscale_up_cooldown seconds. A process
+        is removed once the queues are empty, at most once every autoscale_down_cooldown seconds since the last
+        change. Celery's own autoscaler scales by the tasks a worker reserved, which is never more than its processes
+        since workers take one task at a time. Decisions are logged to the worker log and to SCALING_LOG_KEY """
+
+    def __init__(self, *args, **kwargs):
+        kwargs['keepalive'] = TICK  # Also the interval the worker's event loop calls maybe_scale in
+        super().__init__(*args, **kwargs)
+        self._last_evaluation = 0.
+        self._last_scale_up = 0.
+        self._last_change = time.monotonic()  # Processes just started were not idle for long
+
+    def _queues(self) -> list:
+        queues = self.worker.app.amqp.queues
+        return list(queues.consume_from or queues)
+
+    def _sample(self):
+        """ Reads the number of queued tasks, how long the oldest one waited and the policy's settings, in a single
+            round trip. The settings are read directly, runtime_config() would start a thread in the worker's parent
+            process, which must not run threads while the pool forks """
+
+        queues = self._queues()
+        pipeline = redis_client().pipeline(transaction=False)
+        pipeline.mget(SETTINGS)
+        for queue in queues:
+            pipeline.llen(queue)
+            pipeline.lindex(queue, -1)  # The oldest message, workers pop from the tail
+        settings, *values = pipeline.execute()
+
+        oldest_wait = 0.
+        for message in values[1::2]:
+            sent_time = (json.loads(message).get('headers') or {}).get(SENT_HEADER) if message else None
+            if sent_time is not None:
+                oldest_wait = max(oldest_wait, time.time() - sent_time)
+
+        return sum(values[::2]), oldest_wait, parse_settings(SETTINGS, settings)
+
+    def _maybe_scale(self, req=None):
+        now = time.monotonic()
+        if now - self._last_evaluation < TICK:  # Also called on every task message
+            return False
+        self._last_evaluation = now
+
+        try:
+            depth, oldest_wait, config = self._sample()
+        except redis.RedisError:  # Keep the processes until the queues can be read
+            return False
+
+        processes = self.processes
+
+        if processes < self.max_concurrency and now - self._last_scale_up >= config['autoscale_up_cooldown']:
+            needed = int(math.ceil(depth / max(config['autoscale_max_depth'], 1)))
+            if needed > processes or oldest_wait > config['autoscale_max_wait']:
+                target = min(max(needed, processes + 1), self.max_concurrency)
+                self._decide('up', processes, target, depth, oldest_wait)
+                self._grow(target - processes)
+                self._last_scale_up = self._last_change = now
+                return True
+
+        if processes > self.min_concurrency and depth == 0 and \
+                now - self._last_change >= config['autoscale_down_cooldown']:
+            self._decide('down', processes, processes - 1, depth, oldest_wait)
+            self._shrink(1)
+            self._last_change = now
+            return True
+
+        return False
+
+    def _decide(self, direction: str, processes: int, target: int, depth: int, oldest_wait: float):
+        logger.info('Scaling %s from %s to %s processes, %s tasks queued, the oldest waited %.2f seconds',
+                    direction, processes, target, depth, oldest_wait)
+
+        decision = json.dumps({'time': time.time(), 'worker': self.worker.hostname, 'direction': direction,
+                               'processes': processes, 'target': target, 'queue_depth': depth,
+                               'oldest_wait': oldest_wait})
+        try:
+            pipeline = redis_client().pipeline(transaction=False)
+            pipeline.lpush(SCALING_LOG_KEY, decision)
+            pipeline.ltrim(SCALING_LOG_KEY, 0, SCALING_LOG_MAX_LEN - 1)
+            pipeline.execute()
+        except redis.RedisError:  # Still in the worker log
+            pass
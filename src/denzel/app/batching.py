@@ -0,0 +1,136 @@
+import queue
+import threading
+import time
+from typing import Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from celery import states
+from app.tasks import invoke_predict_batch, enqueue
+from app.lanes import SYNC_LANE, ASYNC_LANE
+from app.tracing import Trace
+
+
+class BatchItemError(Exception):
+    """ Raised to the caller of a batched request which failed on the worker """
+
+
+class Batcher(object):
+    """ Coalesces concurrent prediction requests into batched tasks
+
+        Requests are collected until either batch_max_size requests were collected or batch_max_wait seconds passed
+        since the first one arrived, then all of them are sent as a single invoke_predict_batch task.
+        Batching is disabled while batch_max_size <= 1 """
+
+    def __init__(self, runtime_config, collectors=32):
+        self._config = runtime_config
+        self._queue = queue.Queue()
+        self._collector = ThreadPoolExecutor(max_workers=collectors)  # Waits on sync batches results
+
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._capacity = 0
+        self._last_fill_ratio = 0.
+
+        self._thread = threading.Thread(target=self._run, name='denzel-batcher', daemon=True)
+        self._thread.start()
+
+    def settings(self) -> Tuple[int, float]:
+        """ Retrieves (batch_max_size, batch_max_wait) from the runtime configuration """
+
+        return self._config['batch_max_size'], self._config['batch_max_wait']
+
+    @property
+    def enabled(self) -> bool:
+        return self.settings()[0] > 1
+
+    def submit(self, json_data, sync_timeout: float, trace: Trace) -> Future:
+        """ Queues a verified request for the next batch, the request's task ID is its trace ID
+
+            The returned future resolves to the request's result when sync_timeout > 0, else to its task ID """
+
+        future = Future()
+        self._queue.put((json_data, sync_timeout, trace, future))
+
+        return future
+
+    def stats(self) -> dict:
+        """ Retrieves batching statistics, fill ratio is the portion of batch_max_size actually used """
+
+        with self._stats_lock:
+            return {'batches': self._batches,
+                    'items': self._items,
+                    'last_fill_ratio': self._last_fill_ratio,
+                    'mean_fill_ratio': self._items / self._capacity if self._capacity else 0.}
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]  # Block until the first request of the batch arrives
+
+            max_size, max_wait = self.settings()
+            deadline = time.monotonic() + max_wait
+            while len(batch) < max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            with self._stats_lock:
+                self._batches += 1
+                self._items += len(batch)
+                self._capacity += max(max_size, len(batch))
+                self._last_fill_ratio = len(batch) / max(max_size, len(batch))
+
+            # Response manner might change between requests, so each manner is sent separately
+            sync_items = [item for item in batch if item[1]]
+            async_items = [item for item in batch if not item[1]]
+            if sync_items:
+                self._dispatch(sync_items, sync=True)
+            if async_items:
+                self._dispatch(async_items, sync=False)
+
+    def _dispatch(self, items, sync: bool):
+        json_batch = [json_data for json_data, _, _, _ in items]
+        traces = [trace for _, _, trace, _ in items]
+
+        for trace in traces:
+            trace.mark('enqueue')
+
+        try:
+            # Async batches store their requests' results themselves, nobody asks for the batch's own result
+            task = enqueue(invoke_predict_batch, (json_batch, [trace.trace_id for trace in traces]),
+                           {'sync': sync, 'store_results': bool(self._config['store_async_results'])},
+                           SYNC_LANE if sync else ASYNC_LANE, traces=traces, ignore_result=not sync)
+        except Exception as ex:
+            for _, _, _, future in items:
+                future.set_exception(ex)
+            return
+
+        if sync:
+            self._collector.submit(self._collect, task, items)
+        else:
+            for _, _, trace, future in items:
+                future.set_result(trace.trace_id)
+
+    @staticmethod
+    def _collect(task, items):
+        """ Waits for a sync batch and fans its results back to the waiting requests """
+
+        try:
+            entries = task.get(timeout=max(timeout for _, timeout, _, _ in items))
+        except Exception as ex:
+            for _, _, _, future in items:
+                future.set_exception(ex)
+            return
+
+        for (_, _, trace, future), entry in zip(items, entries):
+            if entry.get('trace'):  # Continued by the worker
+                trace.update(Trace.from_dict(entry['trace']))
+
+            if entry['status'] == states.SUCCESS:
+                future.set_result(entry['result'])
+            else:
+                future.set_exception(BatchItemError(entry['result']))
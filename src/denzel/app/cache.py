@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from app.codecs import canonical_dumps
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+
+class PredictionCache(object):
+    """ In-memory cache of predict responses, keyed by a canonical hash of the verified request
+
+        Entries live for cache_ttl seconds and the least recently used entries are evicted once their total size
+        passes cache_max_memory bytes. Identical requests arriving while the first one is still being handled wait
+        for its response instead of invoking another task. Caching is disabled while cache_ttl == 0 """
+
+    def __init__(self, runtime_config):
+        self._config = runtime_config
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # Key to (expiry time, response body), least recently used first
+        self._in_flight = {}  # Key to the future of the request currently handling it
+        self._memory = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._config['cache_ttl'] > 0
+
+    def key(self, json_data, sync: bool, media: str, idempotency_key=None, model='') -> str:
+        """ Computes the cache key of a request, an idempotency key replaces the request content """
+
+        if idempotency_key:
+            content = 'idempotency:{}'.format(idempotency_key)
+        else:
+            content = canonical_dumps(json_data)
+
+        # Responses of another model, model version, response manner or media type can't be reused
+        prefix = '{}:{}:{}:{}:'.format(model, self._config['model_version'], 'sync' if sync else 'async', media)
+
+        return hashlib.sha1((prefix + content).encode()).hexdigest()
+
+    def get_or_compute(self, key: str, compute, timeout=None):
+        """ Retrieves the cached response body of key, or computes it using compute() """
+
+        body, future, leader = self._lookup(key)
+        if body is not None:
+            return body
+
+        if not leader:
+            return future.result(timeout=timeout)
+
+        try:
+            body = compute()
+        except Exception as ex:
+            self._complete(key, future, error=ex)
+            raise
+
+        self._complete(key, future, body=body)
+        return body
+
+    async def get_or_compute_async(self, key: str, compute, timeout=None):
+        """ Same as get_or_compute, where compute is a coroutine function """
+
+        body, future, leader = self._lookup(key)
+        if body is not None:
+            return body
+
+        if not leader:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
+
+        try:
+            body = await compute()
+        except BaseException as ex:  # Cancellation included, so followers never wait on an abandoned request
+            self._complete(key, future, error=ex)
+            raise
+
+        self._complete(key, future, body=body)
+        return body
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self._hits,
+                    'misses': self._misses,
+                    'coalesced': self._coalesced,
+                    'evictions': self._evictions,
+                    'entries': len(self._entries),
+                    'memory': self._memory}
+
+    def _lookup(self, key: str):
+        """ Returns (body, None, False) on a hit, else (None, future, leader) where the leader computes the response """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expiry, body = entry
+                if expiry > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return body, None, False
+
+                self._remove(key)
+
+            future = self._in_flight.get(key)
+            if future is not None:
+                self._coalesced += 1
+                return None, future, False
+
+            future = Future()
+            self._in_flight[key] = future
+            self._misses += 1
+            return None, future, True
+
+    def _complete(self, key: str, future: Future, body=None, error=None):
+        with self._lock:
+            if error is None:
+                self._entries[key] = (time.monotonic() + self._config['cache_ttl'], body)
+                self._memory += len(key) + len(body)
+                self._evict()
+
+            del self._in_flight[key]
+
+        if error is None:
+            future.set_result(body)
+        else:
+            future.set_exception(error)
+
+    def _evict(self):
+        max_memory = self._config['cache_max_memory']
+        while self._entries and self._memory > max_memory:
+            self._remove(next(iter(self._entries)))
+            self._evictions += 1
+
+    def _remove(self, key: str):
+        _, body = self._entries.pop(key)
+        self._memory -= len(key) + len(body)
@@ -0,0 +1,285 @@
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+import requests
+from requests.adapters import HTTPAdapter
+from app.codecs import pack, unpack, dumps
+from app.compression import compress, supported_encodings
+from app.metrics import Metrics, MetricsFlusher
+from app.runtime_config import RuntimeConfig
+from app.tracing import MODEL_VERSION_HEADER
+
+CALLBACK_QUEUE = 'denzel:callbacks'  # Results waiting for delivery
+RETRY_SET = 'denzel:callbacks:retry'  # Failed deliveries, scored by the time of their next attempt
+PROCESSING_LIST = 'denzel:callbacks:processing:{}'  # Per host, results pulled and not yet delivered or given up on
+DEAD_LETTERS = 'denzel:callbacks:dead'  # Deliveries which failed for good, latest first
+DEAD_LETTERS_MAX_LEN = 10000
+
+CONCURRENCY = 32  # Deliveries in progress at once
+PULL_SIZE = 256  # Maximal number of results taken off the queue at once
+REQUEST_TIMEOUT = 10.  # Seconds
+BACKOFF_BASE = 1.  # Seconds, doubled on every attempt
+BACKOFF_MAX = 300.  # Seconds
+
+LOG_PATH = 'logs/callbacks.log'
+
+# Moves the retries which are due back to the queue, atomically so concurrent dispatchers don't both move one
+RELEASE_DUE_SCRIPT = """
+local due = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, item in ipairs(due) do
+    redis.call('zrem', KEYS[1], item)
+    redis.call('rpush', KEYS[2], item)
+end
+return #due
+"""
+
+# Moves up to ARGV[1] of the oldest results to a processing list, returns them oldest last
+PULL_SCRIPT = """
+local items = redis.call('lrange', KEYS[1], -tonumber(ARGV[1]), -1)
+redis.call('ltrim', KEYS[1], 0, -tonumber(ARGV[1]) - 1)
+for _, item in ipairs(items) do
+    redis.call('lpush', KEYS[2], item)
+end
+return items
+"""
+
+# Moves the results left in a processing list back to the tail of the queue, to be delivered next
+REQUEUE_PROCESSING_SCRIPT = """
+local items = redis.call('lrange', KEYS[1], 0, -1)
+for _, item in ipairs(items) do
+    redis.call('rpush', KEYS[2], item)
+end
+redis.call('del', KEYS[1])
+return #items
+"""
+
+logger = logging.getLogger('denzel.callbacks')
+
+
+class CallbackError(Exception):
+    """ Raised for callback responses which are worth retrying """
+
+
+def queue_callback(redis_client, callback_uri: str, result, task_id: str, model_version=None):
+    """ Queues a result for delivery to its callback URI by the dispatcher """
+
+    redis_client.lpush(CALLBACK_QUEUE, pack({'uri': callback_uri,
+                                             'body': dumps(result),
+                                             'task_id': task_id,
+                                             'model_version': model_version,
+                                             'attempt': 0}))
+
+
+class CallbackDispatcher(object):
+    """ Delivers queued results to their callback URIs, off the inference path
+
+        Results are sent concurrently over keep-alive connections, pooled per host. With callback_batch_size > 1,
+        results queued for the same URI, predicted by the same model version, are sent together as a JSON array of up
+        to callback_batch_size results.
+        Failed deliveries are retried with exponential backoff, and after callback_max_attempts attempts, or on a
+        client error response, they are moved to the dead letters list.
+        Results are kept in the host's processing list from when they are pulled until they are delivered, retried or
+        given up on, and queued again when the dispatcher starts, so a dispatcher which exits loses none """
+
+    def __init__(self, redis_client, runtime_config, metrics: Metrics, concurrency=CONCURRENCY):
+        self._redis = redis_client
+        self._config = runtime_config
+        self._metrics = metrics
+        self._release_due = redis_client.register_script(RELEASE_DUE_SCRIPT)
+        self._pull_more = redis_client.register_script(PULL_SCRIPT)
+        self._requeue_processing = redis_client.register_script(REQUEUE_PROCESSING_SCRIPT)
+        self._processing = PROCESSING_LIST.format(socket.gethostname())
+
+        # Sessions keep a connection pool per host
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=64, pool_maxsize=concurrency)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._slots = threading.BoundedSemaphore(concurrency)  # Results are taken off the queue only when sendable
+
+    def run(self):
+        logger.info('Dispatching callbacks')
+
+        requeued = self._requeue_processing(keys=[self._processing, CALLBACK_QUEUE])
+        if requeued:
+            logger.warning('Requeued {} callbacks left undelivered by the previous dispatcher'.format(requeued))
+
+        while True:
+            try:
+                self._release_due(keys=[RETRY_SET, CALLBACK_QUEUE], args=[time.time(), PULL_SIZE])
+                items = self._pull()
+            except redis.RedisError:
+                logger.exception('Redis unavailable')
+                time.sleep(1)
+                continue
+
+            batch_size = self._config['callback_batch_size']
+            for callback_uri, group in self._group(items, batch_size):
+                self._slots.acquire()
+                self._executor.submit(self._deliver, callback_uri, group, batch_size > 1)
+
+    def _pull(self) -> list:
+        """ Waits for results to deliver, returns up to PULL_SIZE (payload, item) pairs, oldest first
+
+            Malformed results are moved to the dead letters right away """
+
+        first = self._redis.brpoplpush(CALLBACK_QUEUE, self._processing, timeout=1)
+        if first is None:
+            return []
+
+        rest = self._pull_more(keys=[CALLBACK_QUEUE, self._processing], args=[PULL_SIZE - 1])
+
+        pulled = []
+        for payload in [first] + rest[::-1]:
+            try:
+                item = unpack(payload)
+                if not isinstance(item, dict) or not {'uri', 'body', 'attempt'}.issubset(item):
+                    raise ValueError('Missing fields')
+            except Exception as ex:
+                logger.warning('Malformed callback: {}'.format(ex))
+                self._dead_malformed(payload, str(ex))
+                continue
+
+            pulled.append((payload, item))
+
+        return pulled
+
+    @staticmethod
+    def _group(pulled, batch_size: int):
+        """ Yields (callback_uri, pulled) to send together, a single pulled item each unless batching """
+
+        if batch_size <= 1:
+            for payload, item in pulled:
+                yield item['uri'], [(payload, item)]
+            return
+
+        groups = {}
+        for payload, item in pulled:  # Items queued before model versions were recorded have none
+            groups.setdefault((item['uri'], item.get('model_version')), []).append((payload, item))
+
+        for (callback_uri, _), group in groups.items():
+            for start in range(0, len(group), batch_size):
+                yield callback_uri, group[start:start + batch_size]
+
+    def _deliver(self, callback_uri: str, pulled, batched: bool):
+        """ Sends pulled items, taking them off the processing list once delivered, retried or given up on. Left on it
+            if redis fails meanwhile, to be delivered again once the dispatcher starts """
+
+        items = [item for _, item in pulled]
+        try:
+            try:
+                rejection = self._send(callback_uri, items, batched)
+            except (requests.RequestException, CallbackError) as ex:
+                self._retry(items, str(ex))
+            except Exception:
+                logger.exception('Failed delivering to {}'.format(callback_uri))
+                self._dead(items, 'Internal error')
+            else:
+                if rejection is not None:  # Won't succeed on another attempt
+                    self._dead(items, rejection)
+
+            self._ack([payload for payload, _ in pulled])
+        except redis.RedisError:
+            logger.exception('Redis unavailable, {} callbacks are delivered again on restart'.format(len(items)))
+        finally:
+            self._slots.release()
+
+    def _send(self, callback_uri: str, items, batched: bool):
+        """ Posts items to their callback URI, returns why the callback rejected them if it responded with a client
+            error, None once delivered """
+
+        bodies = [item['body'] for item in items]
+        body = b'[' + b','.join(bodies) + b']' if batched else bodies[0]
+        headers = {'Content-Type': 'application/json'}
+        if items[0].get('model_version'):
+            headers[MODEL_VERSION_HEADER] = items[0]['model_version']
+
+        encoding = self._config['callback_compression']
+        if encoding in supported_encodings() and len(body) >= self._config['compression_min_size']:
+            body = compress(body, encoding)
+            headers['Content-Encoding'] = encoding
+
+        with self._metrics.timer('denzel_callback_seconds'):
+            response = self._session.post(callback_uri, data=body, headers=headers, timeout=REQUEST_TIMEOUT)
+
+        if response.status_code == 429 or response.status_code >= 500:
+            raise CallbackError('Callback responded with status {}'.format(response.status_code))
+
+        if response.status_code >= 400:
+            return 'Callback responded with status {}'.format(response.status_code)
+
+        self._metrics.inc('denzel_callbacks_total', len(items), outcome='delivered')
+        return None
+
+    def _ack(self, payloads):
+        pipeline = self._redis.pipeline(transaction=False)
+        for payload in payloads:
+            pipeline.lrem(self._processing, 1, payload)
+        pipeline.execute()
+
+    def _retry(self, items, error: str):
+        max_attempts = self._config['callback_max_attempts']
+
+        retries = {}
+        dead = []
+        for item in items:
+            item['attempt'] += 1
+            if item['attempt'] >= max_attempts:
+                dead.append(item)
+                continue
+
+            backoff = min(BACKOFF_BASE * 2 ** (item['attempt'] - 1), BACKOFF_MAX)
+            retries[pack(item)] = time.time() + backoff * random.uniform(.5, 1.)  # Jitter spreads retries out
+
+        if retries:
+            self._redis.zadd(RETRY_SET, retries)
+            self._metrics.inc('denzel_callbacks_total', len(retries), outcome='retried')
+
+        if dead:
+            self._dead(dead, error)
+
+    def _dead(self, items, error: str):
+        logger.warning('Giving up on {} callbacks to {}: {}'.format(len(items), items[0]['uri'], error))
+
+        # Attempts start over if the dead letter is requeued
+        self._push_dead([pack(dict(item, attempt=0, error=error, failed_at=time.time())) for item in items])
+
+    def _dead_malformed(self, payload: bytes, error: str):
+        """ Moves a result which can't be read to the dead letters, along with its original payload """
+
+        self._push_dead([pack({'payload': payload, 'error': error, 'failed_at': time.time()})])
+        self._ack([payload])
+
+    def _push_dead(self, dead_letters: list):
+        pipeline = self._redis.pipeline(transaction=False)
+        pipeline.lpush(DEAD_LETTERS, *dead_letters)
+        pipeline.ltrim(DEAD_LETTERS, 0, DEAD_LETTERS_MAX_LEN - 1)
+        pipeline.execute()
+        self._metrics.inc('denzel_callbacks_total', len(dead_letters), outcome='dead')
+
+
+def main():
+    logging.basicConfig(filename=LOG_PATH, level=logging.INFO,
+                        format='[%(asctime)s: %(levelname)s/%(name)s] %(message)s')
+
+    redis_client = redis.Redis.from_url(os.environ.get('CELERY_BROKER'))
+    metrics = Metrics()
+    MetricsFlusher(metrics, redis_client)
+
+    try:
+        CallbackDispatcher(redis_client, RuntimeConfig(redis_client), metrics).run()
+    except Exception:  # Restarted by the entrypoint, its undelivered callbacks are queued again then
+        logger.exception('Callback dispatcher failed')
+        raise
+
+
+if __name__ == '__main__':
+    main()
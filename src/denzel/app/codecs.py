@@ -0,0 +1,279 @@
+import hashlib
+import io
+import json
+import time
+
+import msgpack
+import numpy as np
+import ujson
+from kombu import serialization
+from app.compression import compress, decompress, supported_encodings, GZIP, ZSTD
+
+try:  # Optional, install through requirements.txt to accept Arrow IPC requests
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:  # Optional, faster JSON encoding with native numpy support
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+NPY = 'application/x-npy'
+ARROW = 'application/vnd.apache.arrow.stream'
+
+MEDIA_TYPE_ALIASES = {'application/x-msgpack': MSGPACK}
+RESPONSE_MEDIA_TYPES = [JSON, MSGPACK]
+
+CELERY_SERIALIZER = 'denzel-msgpack'
+CELERY_CONTENT_TYPE = 'application/x-denzel-msgpack'
+
+_NDARRAY_EXT_CODE = 1
+_COMPRESSED_EXT_CODES = {ZSTD: 2, GZIP: 3}  # A whole compressed msgpack payload
+_COMPRESSED_ENCODINGS = {code: encoding for encoding, code in _COMPRESSED_EXT_CODES.items()}
+
+
+class UnsupportedMediaType(ValueError):
+    """ Raised for request bodies of a media type that can't be decoded """
+
+
+# -------- msgpack --------
+def _msgpack_default(obj):
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:  # No raw buffer to send
+            return obj.tolist()
+
+        array = np.ascontiguousarray(obj)  # 0-d arrays become 1-d, so the shape is taken from obj
+        buffer = array.data.cast('B') if array.size else b''  # Empty arrays' buffers can't be cast
+        return msgpack.ExtType(_NDARRAY_EXT_CODE,
+                               msgpack.packb([array.dtype.str, obj.shape, buffer], use_bin_type=True))
+
+    if isinstance(obj, np.generic):
+        return obj.item()
+
+    raise TypeError('Can not serialize {!r}'.format(obj))
+
+
+def _msgpack_ext_hook(code, data):
+    if code == _NDARRAY_EXT_CODE:
+        dtype, shape, buffer = msgpack.unpackb(data, raw=False)
+        # Copied once into a writable buffer, arrays over the payload's bytes would be read-only
+        return np.frombuffer(bytearray(buffer), dtype=np.dtype(dtype)).reshape(tuple(shape))
+
+    if code in _COMPRESSED_ENCODINGS:
+        return unpack(decompress(data, _COMPRESSED_ENCODINGS[code]))
+
+    return msgpack.ExtType(code, data)
+
+
+def pack(obj) -> bytes:
+    """ Serializes to msgpack, numpy arrays are packed as their raw buffers """
+
+    return msgpack.packb(obj, default=_msgpack_default, use_bin_type=True)
+
+
+def unpack(payload: bytes):
+    """ Deserializes from msgpack, numpy arrays are restored as writable arrays of their exact shape and dtype
+
+        Map keys may be any type pack accepts, e.g. the ints of per-class probabilities """
+
+    return msgpack.unpackb(payload, ext_hook=_msgpack_ext_hook, raw=False, strict_map_key=False)
+
+
+# -------- JSON --------
+def _to_builtin(obj):
+    """ Converts numpy values nested in obj to their python equivalents """
+
+    if isinstance(obj, dict):
+        return {key if not isinstance(key, np.generic) else key.item(): _to_builtin(value)
+                for key, value in obj.items()}
+
+    if isinstance(obj, (list, tuple)):
+        return [_to_builtin(value) for value in obj]
+
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+
+    if isinstance(obj, np.generic):
+        return obj.item()
+
+    return obj
+
+
+def dumps(obj) -> bytes:
+    """ Serializes to JSON, supporting numpy values """
+
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+        except TypeError:  # e.g. non contiguous arrays, fall back to converting
+            pass
+
+    return ujson.dumps(_to_builtin(obj)).encode()
+
+
+def _canonical_default(obj):
+    if isinstance(obj, np.ndarray):
+        return [obj.dtype.str, obj.shape, hashlib.sha1(np.ascontiguousarray(obj).data).hexdigest()]
+
+    if isinstance(obj, np.generic):
+        return obj.item()
+
+    raise TypeError('Can not serialize {!r}'.format(obj))
+
+
+def canonical_dumps(obj) -> str:
+    """ Serializes to a canonical string, equal objects get equal strings, numpy arrays are represented by a hash """
+
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'), default=_canonical_default)
+
+
+# -------- HTTP bodies --------
+def media_type(content_type) -> str:
+    """ Strips the parameters of a content type header, e.g. the charset """
+
+    if not content_type:
+        return JSON
+
+    media = content_type.split(';')[0].strip().lower()
+    return MEDIA_TYPE_ALIASES.get(media, media)
+
+
+def accepted_media_type(accept) -> str:
+    """ Chooses the response media type by an Accept header, msgpack only when named and preferred over JSON
+
+        Wildcards (e.g. */*, sent by default by most HTTP clients) and a missing header mean JSON, so clients which
+        don't ask for msgpack keep getting the JSON responses they always did """
+
+    if not accept or 'msgpack' not in accept.lower():
+        return JSON
+
+    qualities = {}
+    for accepted in accept.split(','):
+        media, *params = accepted.split(';')
+        quality = 1.
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.
+
+        media = media_type(media)
+        qualities[media] = max(qualities.get(media, 0.), quality)
+
+    msgpack_quality = qualities.get(MSGPACK, 0.)
+    return MSGPACK if msgpack_quality > 0 and msgpack_quality >= qualities.get(JSON, 0.) else JSON
+
+
+def _load_npy(raw: bytes) -> np.ndarray:
+    """ Loads a .npy body as a writable array, copying the body once """
+
+    stream = io.BytesIO(raw)
+    version = np.lib.format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+    else:  # Other versions, let numpy handle it
+        return np.load(io.BytesIO(raw), allow_pickle=False)
+
+    if dtype.hasobject:
+        raise UnsupportedMediaType('Arrays of python objects are not supported')
+
+    array = np.frombuffer(bytearray(raw), dtype=dtype, count=int(np.prod(shape)), offset=stream.tell())
+    return array.reshape(shape, order='F' if fortran_order else 'C')
+
+
+def decode_body(raw: bytes, content_type, params: dict):
+    """ Decodes a request body by its content type
+
+        Bodies carrying only an array (.npy, Arrow) become {'data': <array(s)>}, with the other fields (e.g.
+        callback_uri) taken from the query parameters """
+
+    media = media_type(content_type)
+
+    if media == JSON:
+        return ujson.loads(raw.decode())
+
+    if media == MSGPACK:
+        return unpack(raw)
+
+    if media == NPY:
+        json_data = dict(params)
+        json_data['data'] = _load_npy(raw)
+        return json_data
+
+    if media == ARROW:
+        if pyarrow is None:
+            raise UnsupportedMediaType('Arrow requests require pyarrow, add it to requirements.txt')
+
+        table = pyarrow.ipc.open_stream(raw).read_all()
+        json_data = dict(params)
+        json_data['data'] = {name: column.to_numpy() for name, column in zip(table.column_names, table.columns)}
+        return json_data
+
+    raise UnsupportedMediaType('Unsupported content type {}'.format(content_type))
+
+
+def encode_body(obj, media: str) -> bytes:
+    """ Encodes a response body to one of the RESPONSE_MEDIA_TYPES """
+
+    if media == MSGPACK:
+        return pack(obj)
+
+    return dumps(obj)
+
+
+# -------- Celery --------
+_celery_config = None  # Runtime configuration and metrics of this process, see configure_celery_serializer
+_celery_metrics = None
+
+
+def configure_celery_serializer(runtime_config, metrics):
+    """ Lets the celery serializer of this process follow payload_compression and report to metrics """
+
+    global _celery_config, _celery_metrics
+
+    _celery_config, _celery_metrics = runtime_config, metrics
+
+
+def _celery_pack(obj) -> bytes:
+    """ Packs task arguments and results, compressed as a whole when payload_compression is set and they are at
+        least compression_min_size bytes - compressed payloads are self describing, so either side can change it """
+
+    start_time = time.perf_counter()
+    payload = pack(obj)
+    raw_size = len(payload)
+
+    if _celery_config is not None:
+        encoding = _celery_config['payload_compression']
+        if encoding in supported_encodings() and raw_size >= _celery_config['compression_min_size']:
+            payload = msgpack.packb(msgpack.ExtType(_COMPRESSED_EXT_CODES[encoding], compress(payload, encoding)))
+
+    if _celery_metrics is not None:
+        _celery_metrics.observe('denzel_serialize_seconds', time.perf_counter() - start_time)
+        _celery_metrics.inc('denzel_payloads_total')
+        _celery_metrics.inc('denzel_payload_bytes_total', raw_size, size='raw')
+        _celery_metrics.inc('denzel_payload_bytes_total', len(payload), size='sent')
+
+    return payload
+
+
+def _celery_unpack(payload: bytes):
+    start_time = time.perf_counter()
+    obj = unpack(payload)
+
+    if _celery_metrics is not None:
+        _celery_metrics.observe('denzel_deserialize_seconds', time.perf_counter() - start_time)
+
+    return obj
+
+
+# Serializer for celery messages and results which keeps numpy arrays intact
+serialization.register(CELERY_SERIALIZER, _celery_pack, _celery_unpack,
+                       content_type=CELERY_CONTENT_TYPE,
+                       content_encoding='binary')
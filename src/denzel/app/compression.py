@@ -0,0 +1,432 @@
+import gzip
+import io
+import threading
+import time
+import zlib
+
+import falcon
+import falcon.asgi
+
+try:  # Optional, zstd is used only when installed
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+IDENTITY = 'identity'
+
+
+def supported_encodings() -> list:
+    """ Retrieves the supported content encodings, most preferred first """
+
+    return ([ZSTD] if zstandard is not None else []) + [GZIP]
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """ Compresses a whole body """
+
+    if encoding == ZSTD:
+        return zstandard.ZstdCompressor().compress(data)
+
+    return gzip.compress(data, compresslevel=6)
+
+
+def decompress(data: bytes, encoding: str) -> bytes:
+    """ Decompresses a whole body """
+
+    if encoding == ZSTD:
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    return gzip.decompress(data)
+
+
+def _compressobj(encoding: str):
+    """ Retrieves an incremental compressor, having compress(data) and flush() """
+
+    if encoding == ZSTD:
+        return zstandard.ZstdCompressor().compressobj()
+
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+
+
+def _sync_flush_mode(encoding: str) -> int:
+    """ Retrieves the flush mode which outputs all of the data compressed so far, keeping the stream open """
+
+    if encoding == ZSTD:
+        return zstandard.COMPRESSOBJ_FLUSH_BLOCK
+
+    return zlib.Z_SYNC_FLUSH
+
+
+def _decompressobj(encoding: str):
+    """ Retrieves an incremental decompressor, having decompress(data) """
+
+    if encoding == ZSTD:
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def request_encoding(req):
+    """ Retrieves a request's content encoding, None if the body is not compressed """
+
+    encoding = (req.get_header('Content-Encoding') or IDENTITY).strip().lower()
+
+    return None if encoding == IDENTITY else encoding
+
+
+def negotiate_encoding(accept_encoding) -> str:
+    """ Chooses a response encoding out of an Accept-Encoding header, None if none is acceptable """
+
+    if not accept_encoding:
+        return None
+
+    accepted = set()
+    for token in accept_encoding.split(','):
+        coding, _, params = token.strip().partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+
+    for encoding in supported_encodings():
+        if encoding in accepted or '*' in accepted:
+            return encoding
+
+    return None
+
+
+class CompressionStats(object):
+    """ Accumulates sizes and time spent on (de)compression """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._compressed = 0
+        self._decompressed = 0
+        self._bytes_in = 0
+        self._bytes_out = 0
+        self._seconds = 0.
+        self._decompression_seconds = 0.
+
+    def record_compression(self, size: int, compressed_size: int, seconds: float):
+        with self._lock:
+            self._compressed += 1
+            self._bytes_in += size
+            self._bytes_out += compressed_size
+            self._seconds += seconds
+
+    def record_decompression(self, seconds: float):
+        with self._lock:
+            self._decompressed += 1
+            self._decompression_seconds += seconds
+
+    def stats(self) -> dict:
+        """ Ratio is the compressed size out of the original size, over all of the compressed responses """
+
+        with self._lock:
+            return {'compressed_responses': self._compressed,
+                    'decompressed_requests': self._decompressed,
+                    'bytes_in': self._bytes_in,
+                    'bytes_out': self._bytes_out,
+                    'ratio': self._bytes_out / self._bytes_in if self._bytes_in else 0.,
+                    'seconds': self._seconds,
+                    'decompression_seconds': self._decompression_seconds}
+
+
+# -------- Requests --------
+def _too_large(limit: int) -> falcon.HTTPError:
+    return falcon.HTTPError(falcon.HTTP_413,
+                            'Request body too large',
+                            'Compressed bodies may decompress to {} bytes at most, per line if streamed'.format(limit))
+
+
+class _TimedReader(object):
+    """ Wraps a stream, accumulating the seconds spent reading it """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.seconds = 0.
+
+    def read(self, size=-1) -> bytes:
+        return self._timed(self._stream.read, size)
+
+    def readline(self, size=-1) -> bytes:
+        return self._timed(self._stream.readline, size)
+
+    def _timed(self, read, size: int) -> bytes:
+        start_time = time.perf_counter()
+        try:
+            return read(size)
+        finally:
+            self.seconds += time.perf_counter() - start_time
+
+
+class _LimitedReader(object):
+    """ Wraps a decompressed stream, rejecting bodies read of more than limit bytes, or lines when read line by line,
+        so a small compressed body can't take the server's memory. limit is set by CompressionMiddleware, None means
+        unlimited """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._size = 0  # Read so far
+        self.limit = None
+
+    def read(self, size=-1) -> bytes:
+        if self.limit is None:
+            return self._stream.read(size)
+
+        left = self.limit - self._size + 1
+        data = self._stream.read(left if size is None or size < 0 else min(size, left))
+        self._size += len(data)
+        if self._size > self.limit:
+            raise _too_large(self.limit)
+
+        return data
+
+    def readline(self, size=-1) -> bytes:
+        if self.limit is None:
+            return self._stream.readline(size)
+
+        line = self._stream.readline(self.limit + 2 if size is None or size < 0 else min(size, self.limit + 2))
+        if len(line) - line.endswith(b'\n') > self.limit:  # The newline is not counted
+            raise _too_large(self.limit)
+
+        return line
+
+
+class DecompressingRequest(falcon.Request):
+    """ Request whose stream is decompressed according to its Content-Encoding """
+
+    def __init__(self, env, options=None):
+        super().__init__(env, options)
+        self._compressed_stream = None
+        self._decompressed_stream = None
+
+        encoding = request_encoding(self)
+        if encoding == GZIP:
+            self._compressed_stream = _TimedReader(self.bounded_stream)
+            self._decompressed_stream = _TimedReader(gzip.GzipFile(fileobj=self._compressed_stream, mode='rb'))
+        elif encoding == ZSTD and zstandard is not None:
+            self._compressed_stream = _TimedReader(self.bounded_stream)
+            self._decompressed_stream = _TimedReader(
+                io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(self._compressed_stream)))
+
+        if self._decompressed_stream is not None:
+            self.stream = _LimitedReader(self._decompressed_stream)
+
+    @property
+    def decompression_seconds(self) -> float:
+        """ Seconds spent decompressing the body so far, the time reading the compressed body is excluded """
+
+        if self._compressed_stream is None:
+            return 0.
+
+        return max(self._decompressed_stream.seconds - self._compressed_stream.seconds, 0.)
+
+
+class _AsyncDecompressingStream(object):
+    """ Decompresses an ASGI request stream as it is read, limited as _LimitedReader is - a whole body read at once,
+        or each line of a body iterated over """
+
+    def __init__(self, stream, encoding: str):
+        self._stream = stream
+        self._decompressor = _decompressobj(encoding)
+        self.seconds = 0.  # Spent decompressing
+        self.limit = None
+
+    async def read(self) -> bytes:
+        chunks = []
+        size = 0
+        async for data in self._decompressed():
+            size += len(data)
+            if self.limit is not None and size > self.limit:
+                raise _too_large(self.limit)
+            chunks.append(data)
+
+        return b''.join(chunks)
+
+    async def __aiter__(self):
+        line_size = 0  # Of the line in progress
+        async for data in self._decompressed():
+            if self.limit is not None:
+                line_size = self._check_lines(data, line_size)
+            yield data
+
+    def _check_lines(self, data: bytes, line_size: int) -> int:
+        """ Raises if a line data continues or holds is over the limit, returns the size of the line it leaves open """
+
+        start = 0
+        end = data.find(b'\n')
+        while end >= 0:
+            if line_size + end - start > self.limit:
+                raise _too_large(self.limit)
+            line_size, start = 0, end + 1
+            end = data.find(b'\n', start)
+
+        line_size += len(data) - start
+        if line_size > self.limit:
+            raise _too_large(self.limit)
+
+        return line_size
+
+    async def _decompressed(self):
+        async for data in self._stream:
+            start_time = time.perf_counter()
+            data = self._decompressor.decompress(data)
+            self.seconds += time.perf_counter() - start_time
+            if data:
+                yield data
+
+
+class AsyncDecompressingRequest(falcon.asgi.Request):
+    """ Same as DecompressingRequest, for the ASGI app """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._decompressing_stream = None
+
+    @property
+    def stream(self):
+        encoding = request_encoding(self)
+        if encoding not in supported_encodings():
+            return super().stream
+
+        if self._decompressing_stream is None:
+            self._decompressing_stream = _AsyncDecompressingStream(super().stream, encoding)
+
+        return self._decompressing_stream
+
+    @property
+    def decompression_seconds(self) -> float:
+        """ Seconds spent decompressing the body so far """
+
+        return self._decompressing_stream.seconds if self._decompressing_stream is not None else 0.
+
+
+# -------- Responses --------
+class CompressionMiddleware(object):
+    """ Rejects requests of unsupported encodings, compresses responses the client accepts compressed
+
+        Bodies are compressed only from compression_min_size bytes, streamed bodies are always compressed, and
+        flushed after every chunk so the client gets each chunk as soon as it is produced. Compressed requests are
+        limited to max_decompressed_size bytes once decompressed, per line when read line by line. The time spent
+        decompressing a request is recorded as its response is ready, for streamed requests the part read by then """
+
+    def __init__(self, runtime_config, stats: CompressionStats):
+        self._config = runtime_config
+        self._stats = stats
+
+    def process_request(self, req, resp):
+        encoding = request_encoding(req)
+        if encoding is None:
+            return
+
+        if encoding not in supported_encodings():
+            raise falcon.HTTPError(falcon.HTTP_415,
+                                   'Unsupported content encoding',
+                                   'Supported encodings are {}'.format(', '.join(supported_encodings())))
+
+        if self._config['max_decompressed_size'] > 0:
+            req.stream.limit = self._config['max_decompressed_size']
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if request_encoding(req) in supported_encodings():
+            self._stats.record_decompression(getattr(req, 'decompression_seconds', 0.))
+
+        encoding = self._response_encoding(req, resp)
+        if encoding is None:
+            return
+
+        if resp.stream is not None:
+            resp.stream = self._compress_stream(resp.stream, encoding)
+        else:
+            body = self._body(resp)
+            if body is None or len(body) < self._config['compression_min_size']:
+                return
+
+            start_time = time.perf_counter()
+            compressed = compress(body, encoding)
+            self._stats.record_compression(len(body), len(compressed), time.perf_counter() - start_time)
+
+            self._replace_body(resp, compressed)
+
+        resp.set_header('Content-Encoding', encoding)
+        resp.append_header('Vary', 'Accept-Encoding')
+
+    @staticmethod
+    def _response_encoding(req, resp):
+        if resp.get_header('Content-Encoding'):  # Already encoded
+            return None
+
+        return negotiate_encoding(req.get_header('Accept-Encoding'))
+
+    @staticmethod
+    def _body(resp):
+        """ Retrieves the response body as bytes """
+
+        text = resp.text if hasattr(resp, 'text') else resp.body
+        if text is not None:
+            return text.encode()
+
+        return resp.data
+
+    @staticmethod
+    def _replace_body(resp, data: bytes):
+        # Text takes precedence over data, so it is cleared
+        if hasattr(resp, 'text'):
+            resp.text = None
+        else:
+            resp.body = None
+
+        resp.data = data
+
+    def _compress_stream(self, stream, encoding: str):
+        compressor, flush_mode = _compressobj(encoding), _sync_flush_mode(encoding)
+        size = compressed_size = 0
+        seconds = 0.
+        try:
+            for data in stream:
+                start_time = time.perf_counter()
+                compressed = compressor.compress(data) + compressor.flush(flush_mode)
+                seconds += time.perf_counter() - start_time
+                size, compressed_size = size + len(data), compressed_size + len(compressed)
+                yield compressed
+
+            compressed = compressor.flush()
+            compressed_size += len(compressed)
+            yield compressed
+        finally:  # Also when the client went away before the end
+            self._stats.record_compression(size, compressed_size, seconds)
+
+
+class AsyncCompressionMiddleware(CompressionMiddleware):
+    """ Same as CompressionMiddleware, for the ASGI app """
+
+    async def process_request(self, req, resp):
+        super().process_request(req, resp)
+
+    async def process_response(self, req, resp, resource, req_succeeded):
+        super().process_response(req, resp, resource, req_succeeded)
+
+    async def _compress_stream(self, stream, encoding: str):
+        compressor, flush_mode = _compressobj(encoding), _sync_flush_mode(encoding)
+        size = compressed_size = 0
+        seconds = 0.
+        try:
+            async for data in stream:
+                start_time = time.perf_counter()
+                compressed = compressor.compress(data) + compressor.flush(flush_mode)
+                seconds += time.perf_counter() - start_time
+                size, compressed_size = size + len(data), compressed_size + len(compressed)
+                yield compressed
+
+            compressed = compressor.flush()
+            compressed_size += len(compressed)
+            yield compressed
+        finally:
+            self._stats.record_compression(size, compressed_size, seconds)
@@ -0,0 +1,84 @@
+import json
+import threading
+import time
+from collections import Counter
+
+import redis
+
+WORKERS_KEY = 'denzel:workers'  # Hash of worker process to its latest heartbeat
+HEARTBEAT_TTL = 5.  # Seconds without a heartbeat after which a worker process is considered gone
+FORGET_AGE = 3600.  # Seconds, heartbeats and metrics of processes gone for longer are removed
+POLL_INTERVAL = 1.  # Seconds between reads of the heartbeats
+
+# Worker process states, in the order they go through
+LOADING = 'loading'
+WARMING = 'warming'
+READY = 'ready'
+
+
+def heartbeat(state: str, model_version=None, model='', throughput=0.) -> str:
+    return json.dumps({'state': state, 'model_version': model_version, 'model': model, 'throughput': throughput,
+                       'time': time.time()})
+
+
+class HealthMonitor(object):
+    """ Follows the heartbeats of the worker processes, so health checks are answered without a round trip to redis
+
+        A background thread reads the heartbeats every POLL_INTERVAL seconds. Denzel is ready while redis is
+        reachable and at least one worker process reported it is ready within the last HEARTBEAT_TTL seconds.
+        The model versions served are those of the ready processes, more than one while a reload is in progress.
+        Ready processes of the models of app/logic/models are also counted per model """
+
+    def __init__(self, redis_client):
+        self._redis = redis_client
+        self._lock = threading.Lock()
+        self._status = {'ready': False, 'redis': False, 'workers': {LOADING: 0, WARMING: 0, READY: 0},
+                        'model_versions': [], 'models': {}}
+
+        self._thread = threading.Thread(target=self._poll_forever, name='denzel-health', daemon=True)
+        self._thread.start()
+
+    @property
+    def model_versions(self) -> list:
+        with self._lock:
+            return self._status['model_versions']
+
+    def status(self) -> dict:
+        with self._lock:
+            return dict(self._status, workers=dict(self._status['workers']), models=dict(self._status['models']))
+
+    def _poll_forever(self):
+        while True:
+            try:
+                heartbeats = self._redis.hgetall(WORKERS_KEY)
+                now = time.time()
+
+                workers = {LOADING: 0, WARMING: 0, READY: 0}
+                model_versions = set()
+                models = Counter()
+                forgotten = []
+                for process, payload in heartbeats.items():
+                    worker_heartbeat = json.loads(payload)
+                    age = now - worker_heartbeat['time']
+                    if age > FORGET_AGE:
+                        forgotten.append(process)
+                    elif age <= HEARTBEAT_TTL and worker_heartbeat['state'] in workers:
+                        workers[worker_heartbeat['state']] += 1
+                        if worker_heartbeat['state'] == READY and worker_heartbeat.get('model_version'):
+                            model_versions.add(worker_heartbeat['model_version'])
+                        if worker_heartbeat['state'] == READY and worker_heartbeat.get('model'):
+                            models[worker_heartbeat['model']] += 1
+
+                if forgotten:  # Processes which were killed without removing their heartbeat
+                    self._redis.hdel(WORKERS_KEY, *forgotten)
+
+                status = {'ready': workers[READY] > 0, 'redis': True, 'workers': workers,
+                          'model_versions': sorted(model_versions), 'models': dict(models)}
+            except redis.RedisError:
+                status = {'ready': False, 'redis': False, 'workers': {LOADING: 0, WARMING: 0, READY: 0},
+                          'model_versions': [], 'models': {}}
+
+            with self._lock:
+                self._status = status
+
+            time.sleep(POLL_INTERVAL)
@@ -0,0 +1,31 @@
+SYNC_LANE = 'sync'  # Latency critical, sync responses
+ASYNC_LANE = 'async'  # Async responses, delivered through callbacks
+BULK_LANE = 'bulk'  # Oversized requests and streams
+
+# Broker queues, each consumed by its own workers when lane weights are set (see entrypoints/denzel.sh)
+LANES = [SYNC_LANE, ASYNC_LANE, BULK_LANE]
+
+# Every model of app/logic/models has a lane of its own, consumed by the model's worker group
+MODEL_LANE_PREFIX = 'model.'
+
+
+def model_lane(model: str) -> str:
+    return MODEL_LANE_PREFIX + model
+
+
+def is_lane(name: str) -> bool:
+    """ Checks whether name is a broker queue tasks are sent to """
+
+    return name in LANES or name.startswith(MODEL_LANE_PREFIX)
+
+
+def choose_lane(sync: bool, size: int, runtime_config) -> str:
+    """ Chooses the lane of a request by its response manner and body size in bytes
+
+        Requests of bulk_min_size bytes or more go to the bulk lane, so they don't hold back smaller requests """
+
+    bulk_min_size = runtime_config['bulk_min_size']
+    if 0 < bulk_min_size <= size:
+        return BULK_LANE
+
+    return SYNC_LANE if sync else ASYNC_LANE
@@ -0,0 +1,2 @@
+# Additional models served by this project, one module each, defining the same functions as pipeline.py
+# A model named fraud (models/fraud.py) is served on /predict/fraud by a worker group of its own
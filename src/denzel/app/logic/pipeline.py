@@ -1,4 +1,12 @@
 # -------- Handled by api container --------
+# Optional schema of the requests, validating all of a request's records at once before verify_input - which then gets
+# them as a numpy array of a row per record and a column per feature, and their IDs as "record_ids", e.g.
+# INPUT_SCHEMA = {'required': ['callback_uri'],
+#                 'records': 'data',
+#                 'features': {'height': 'float64', 'weight': 'float64', 'embedding': ('float32', (16,))}}
+INPUT_SCHEMA = None
+
+
 def verify_input(json_data):
     """
     Verifies the validity of an API request content
@@ -26,6 +34,30 @@ def load_model():
     return  # return the loaded model object
 
 
+def load_variant(variant):
+    """
+    Load a variant of the model (e.g. of a tenant) to memory, for requests naming it in their "model_variant" field
+    Variants are loaded on first use, the most recently used are kept in memory (see "denzel variants")
+
+    :param variant: Name of the variant, as given in the request
+    :return: Model, will be used by the predict and process functions for the requests naming the variant
+    """
+
+    raise ValueError('Unknown model variant {}'.format(variant))  # return the loaded variant object
+
+
+def warmup():
+    """
+    Sample API requests, run through verify_input, process and predict when a worker process starts, before it
+    is reported ready - so the first real requests don't pay for lazy initializations
+
+    :return: List of request contents, as in an API call
+    :rtype: list
+    """
+
+    return []  # return sample request contents, e.g. [{'callback_uri': 'http://localhost', 'data': ...}]
+
+
 def process(model, json_data):
     """
     Process the json_data passed from verify_input to model ready data
@@ -51,3 +83,33 @@ def predict(model, data):
 
     # return a dictionary that will be parsed to JSON and sent back to API-caller
     return {}
+
+
+# -------- Optional, vectorized batches --------
+# Used when requests are predicted together (see "denzel batching --worker-drain"), define both to opt in - otherwise
+# batched requests are predicted one by one with process and predict
+# def process_batch(model, json_batch):
+#     """
+#     Process many requests at once, used when requests are predicted together (see "denzel batching --worker-drain")
+#     Implement vectorized, e.g. stacking the requests into a single array
+#
+#     :param model: Loaded object from load_model function
+#     :param json_batch: List of data from the verify_input function
+#     :return: Model ready data of the whole batch
+#     """
+#
+#     return [process(model, json_data) for json_data in json_batch]
+#
+#
+# def predict_batch(model, batch_data):
+#     """
+#     Predicts many requests at once, used when requests are predicted together (see "denzel batching --worker-drain")
+#     Implement vectorized, e.g. a single call to the model on the stacked array
+#
+#     :param model: Loaded object from load_model function
+#     :param batch_data: Data from process_batch function
+#     :return: List of responses to the API-callers, one per request and in the same order
+#     :rtype: list
+#     """
+#
+#     return [predict(model, data) for data in batch_data]
@@ -0,0 +1,285 @@
+import bisect
+import json
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import redis
+from app.health import FORGET_AGE
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+WORKER_METRICS_KEY = 'denzel:worker_metrics'  # Hash of worker process to its latest metrics snapshot
+FLUSH_INTERVAL = 1.  # Seconds between flushes of a worker process's metrics
+STALE_GAUGE_AGE = 3 * FLUSH_INTERVAL  # Seconds, gauges of processes which stopped flushing are dropped
+
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)  # Seconds
+
+# Exported metrics, mapping name to (type, help) - add new metrics here
+METRICS = {
+    'denzel_api_requests_total': ('counter', 'API requests by route and status'),
+    'denzel_api_request_seconds': ('histogram', 'API request latency by route, end to end for sync predictions'),
+    'denzel_api_in_flight': ('gauge', 'API requests in progress'),
+    'denzel_api_parse_seconds': ('histogram', 'Time reading and decoding prediction request bodies'),
+    'denzel_api_verify_seconds': ('histogram', 'Time in verify_input'),
+    'denzel_queue_depth': ('gauge', 'Tasks waiting in the broker by lane'),
+    'denzel_queue_wait_seconds': ('histogram', 'Time tasks waited in the broker by lane'),
+    'denzel_process_seconds': ('histogram', 'Time in process, per request'),
+    'denzel_predict_seconds': ('histogram', 'Time in predict, per request'),
+    'denzel_stage_utilization': ('gauge', 'Share of time a worker process spent in process and predict, by stage'),
+    'denzel_callback_seconds': ('histogram', 'Time posting results to callback URIs'),
+    'denzel_callbacks_total': ('counter', 'Results delivered to callback URIs, retried or given up on, by outcome'),
+    'denzel_serialize_seconds': ('histogram', 'Time serializing task arguments and results, compression included'),
+    'denzel_deserialize_seconds': ('histogram', 'Time deserializing task arguments and results'),
+    'denzel_payloads_total': ('counter', 'Serialized task arguments and results'),
+    'denzel_payload_bytes_total': ('counter', 'Size of serialized task arguments and results, raw and as sent'),
+    'denzel_task_seconds': ('histogram', 'Task run time in the worker by lane'),
+    'denzel_end_to_end_seconds': ('histogram', 'Time from sending a task to its completion by lane'),
+    'denzel_tasks_total': ('counter', 'Completed tasks by lane and state'),
+    'denzel_drained_tasks_total': ('counter', 'Tasks taken off the broker and predicted by another task, by lane'),
+    'denzel_worker_in_flight': ('gauge', 'Tasks running in the worker'),
+    'denzel_worker_rss_bytes': ('gauge', 'Resident memory of a worker process'),
+    'denzel_worker_shared_bytes': ('gauge', 'Resident memory a worker process shares with other processes'),
+    'denzel_worker_private_bytes': ('gauge', 'Resident memory used by a worker process alone'),
+    'denzel_variant_requests_total': ('counter', 'Requests naming a model variant, by whether it was resident'),
+    'denzel_variant_load_seconds': ('histogram', 'Time in load_variant'),
+    'denzel_variant_evictions_total': ('counter', 'Model variants evicted to stay within the memory budget'),
+    'denzel_variant_resident_bytes': ('gauge', 'Memory of the model variants resident in a worker process'),
+}
+
+_KINDS = {'counter': 'counters', 'gauge': 'gauges', 'histogram': 'histograms'}
+
+
+def _labels(labels: dict) -> str:
+    """ Formats labels as they appear in the exposition format, e.g. {lane="sync"} """
+
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                          for name, value in sorted(labels.items())) + '}'
+
+
+def _with_bound(labels: str, bound) -> str:
+    bound_label = 'le="{}"'.format(bound)
+    return '{' + (labels[1:-1] + ',' if labels else '') + bound_label + '}'
+
+
+def process_memory() -> dict:
+    """ Retrieves the resident memory of this process in bytes, split to pages shared with other processes (e.g.
+        inherited from the parent and untouched since) and private pages, empty where /proc is unavailable """
+
+    usage = {'Rss': 0, 'Shared_Clean': 0, 'Shared_Dirty': 0, 'Private_Clean': 0, 'Private_Dirty': 0}
+
+    # smaps_rollup sums smaps cheaply, from Linux 4.14
+    path = '/proc/self/smaps_rollup' if os.path.exists('/proc/self/smaps_rollup') else '/proc/self/smaps'
+    try:
+        with open(path) as smaps:
+            for line in smaps:
+                field, _, value = line.partition(':')
+                if field in usage:
+                    usage[field] += int(value.split()[0]) * 1024  # Kilobytes
+    except OSError:
+        return {}
+
+    return {'rss': usage['Rss'],
+            'shared': usage['Shared_Clean'] + usage['Shared_Dirty'],
+            'private': usage['Private_Clean'] + usage['Private_Dirty']}
+
+
+class Metrics(object):
+    """ In-memory counters, gauges and histograms, cheap enough to update on every request
+
+        Histograms keep a count per bucket of BUCKETS plus +Inf, followed by the sum of the observed values """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(lambda: defaultdict(float))  # Name to labels to value
+        self._gauges = defaultdict(lambda: defaultdict(float))
+        self._histograms = defaultdict(dict)
+
+    def inc(self, name: str, value=1., **labels):
+        with self._lock:
+            self._counters[name][_labels(labels)] += value
+
+    def set(self, name: str, value, **labels):
+        with self._lock:
+            self._gauges[name][_labels(labels)] = value
+
+    def add(self, name: str, value, **labels):
+        """ Adds to a gauge, value may be negative """
+
+        with self._lock:
+            self._gauges[name][_labels(labels)] += value
+
+    def observe(self, name: str, value: float, **labels):
+        index = bisect.bisect_left(BUCKETS, value)
+        key = _labels(labels)
+
+        with self._lock:
+            histogram = self._histograms[name].get(key)
+            if histogram is None:
+                histogram = self._histograms[name][key] = [0] * (len(BUCKETS) + 1) + [0.]
+            histogram[index] += 1
+            histogram[-1] += value
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """ Observes the seconds spent in the block, also when it raises """
+
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def snapshot(self) -> dict:
+        """ Retrieves all of the values as a JSON serializable dictionary """
+
+        with self._lock:
+            return {'counters': {name: dict(series) for name, series in self._counters.items()},
+                    'gauges': {name: dict(series) for name, series in self._gauges.items()},
+                    'histograms': {name: {key: list(histogram) for key, histogram in series.items()}
+                                   for name, series in self._histograms.items()}}
+
+
+def merge(snapshots) -> dict:
+    """ Sums snapshots of many processes, gauges of snapshots older than STALE_GAUGE_AGE are left out """
+
+    merged = {kind: defaultdict(lambda: defaultdict(float)) for kind in ('counters', 'gauges')}
+    merged['histograms'] = defaultdict(dict)
+    now = time.time()
+
+    for snapshot in snapshots:
+        for kind in ('counters', 'gauges'):
+            if kind == 'gauges' and now - snapshot.get('time', now) > STALE_GAUGE_AGE:
+                continue
+            for name, series in snapshot[kind].items():
+                for key, value in series.items():
+                    merged[kind][name][key] += value
+
+        for name, series in snapshot['histograms'].items():
+            for key, histogram in series.items():
+                total = merged['histograms'][name].get(key)
+                merged['histograms'][name][key] = histogram if total is None else \
+                    [a + b for a, b in zip(total, histogram)]
+
+    return merged
+
+
+def render(snapshot: dict) -> str:
+    """ Renders a snapshot in the Prometheus text exposition format """
+
+    lines = []
+    for name, (metric_type, description) in sorted(METRICS.items()):
+        series = snapshot[_KINDS[metric_type]].get(name)
+        if not series:
+            continue
+
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+
+        for labels, value in sorted(series.items()):
+            if metric_type != 'histogram':
+                lines.append('{}{} {}'.format(name, labels, float(value)))
+                continue
+
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), value[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, _with_bound(labels, bound), cumulative))
+            lines.append('{}_sum{} {}'.format(name, labels, float(value[-1])))
+            lines.append('{}_count{} {}'.format(name, labels, cumulative))
+
+    return '\n'.join(lines) + '\n'
+
+
+def worker_snapshots(worker_metrics: dict) -> tuple:
+    """ Reads the snapshots the worker processes flushed to redis, returns them along with the fields of processes
+        which stopped flushing more than FORGET_AGE seconds ago, left out to be removed. Prometheus takes the drop of
+        their counters as a reset """
+
+    now = time.time()
+    snapshots = []
+    forgotten = []
+    for field, payload in worker_metrics.items():
+        snapshot = json.loads(payload)
+        if now - snapshot.get('time', now) > FORGET_AGE:
+            forgotten.append(field)
+        else:
+            snapshots.append(snapshot)
+
+    return snapshots, forgotten
+
+
+def exposition(local_snapshot: dict, snapshots) -> str:
+    """ Renders the API's own metrics together with the snapshots of the worker processes """
+
+    return render(merge([local_snapshot] + list(snapshots)))
+
+
+class MetricsFlusher(object):
+    """ Writes a process's metrics snapshot to redis every FLUSH_INTERVAL seconds, in a background thread
+
+        on_flush(pipeline, snapshot), if given, may add its own commands to the same round trip """
+
+    def __init__(self, metrics: Metrics, redis_client, on_flush=None):
+        self._metrics = metrics
+        self._redis = redis_client
+        self._on_flush = on_flush
+        self._field = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+        self._thread = threading.Thread(target=self._flush_forever, name='denzel-metrics', daemon=True)
+        self._thread.start()
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+
+            snapshot = self._metrics.snapshot()
+            snapshot['time'] = time.time()
+
+            try:
+                pipeline = self._redis.pipeline(transaction=False)
+                pipeline.hset(WORKER_METRICS_KEY, self._field, json.dumps(snapshot))
+                if self._on_flush is not None:
+                    self._on_flush(pipeline, snapshot)
+                pipeline.execute()
+            except redis.RedisError:  # Redis unavailable, the next flush carries the totals anyway
+                pass
+
+
+# -------- Middleware --------
+class MetricsMiddleware(object):
+    """ Counts API requests and measures their latency by route """
+
+    def __init__(self, metrics: Metrics):
+        self._metrics = metrics
+
+    def process_request(self, req, resp):
+        req.context.metrics_start_time = time.perf_counter()
+        self._metrics.add('denzel_api_in_flight', 1)
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        start_time = getattr(req.context, 'metrics_start_time', None)
+        if start_time is None:  # Rejected before process_request
+            return
+
+        route = req.uri_template or 'unmatched'
+        status = str(resp.status).split(' ')[0]
+
+        self._metrics.add('denzel_api_in_flight', -1)
+        self._metrics.inc('denzel_api_requests_total', route=route, status=status)
+        self._metrics.observe('denzel_api_request_seconds', time.perf_counter() - start_time, route=route)
+
+
+class AsyncMetricsMiddleware(MetricsMiddleware):
+    """ Same as MetricsMiddleware, for the ASGI app """
+
+    async def process_request(self, req, resp):
+        super().process_request(req, resp)
+
+    async def process_response(self, req, resp, resource, req_succeeded):
+        super().process_response(req, resp, resource, req_succeeded)
@@ -0,0 +1,39 @@
+import importlib
+import pkgutil
+
+MODEL_ENV = 'DENZEL_MODEL'  # Names the model a worker group serves, unset for the default pipeline.py
+MODELS_PACKAGE = 'app.logic.models'
+RESERVED_NAMES = ('stream',)  # Taken by other /predict/... routes
+
+
+def model_names() -> list:
+    """ Retrieves the names of the models declared in app/logic/models, a module each, without importing them """
+
+    try:
+        models_package = importlib.import_module(MODELS_PACKAGE)
+    except ImportError:  # Projects created before models were added
+        return []
+
+    names = sorted(name for _, name, _ in pkgutil.iter_modules(models_package.__path__))
+    for name in names:
+        if name in RESERVED_NAMES:
+            raise ValueError('"{}" can\'t be a model name, rename app/logic/models/{}.py'.format(name, name))
+
+    return names
+
+
+def load_pipeline(model=None):
+    """ Imports the pipeline module of a model, pipeline.py when model is empty """
+
+    if not model:
+        return importlib.import_module('app.logic.pipeline')
+
+    return importlib.import_module('{}.{}'.format(MODELS_PACKAGE, model))
+
+
+def main():
+    print('\n'.join(model_names()))  # Read by entrypoints/denzel.sh, to start a worker group per model
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PipelinedPredictor(object):
+    """ Predicts many requests with process and predict overlapping - process runs on a pool of threads, feeding a
+        bounded queue of model ready data the predict stage consumes, so the model does not idle while the next
+        request is processed
+
+        Threads rather than processes, since the worker's own processes are daemonic and can't have children, and
+        numeric code (numpy, pandas, most models) releases the GIL while it computes. The bounded queue holds back
+        the process threads while predict falls behind, capping the model ready data kept in memory """
+
+    def __init__(self, process, predict, metrics):
+        self._process = process
+        self._predict = predict
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_key = None  # (pid, threads) the executor was created for, as threads don't survive a fork
+
+    def _get_executor(self, threads: int) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor_key != (os.getpid(), threads):
+                if self._executor is not None and self._executor_key[0] == os.getpid():
+                    self._executor.shutdown(wait=False)  # Threads were changed, idle threads exit
+                self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='denzel-process')
+                self._executor_key = (os.getpid(), threads)
+
+            return self._executor
+
+    def predict_many(self, model, json_batch, traces, threads: int, queue_size: int) -> list:
+        """ Predicts the requests, returns a (result, exception) pair per request as ordered in json_batch,
+            exception being None on success """
+
+        processed = queue.Queue(maxsize=max(queue_size, 1))
+
+        def process_one(index):
+            data, error = None, None
+            try:
+                with self._metrics.timer('denzel_process_seconds'):
+                    data = self._process(model, json_batch[index])
+                traces[index].mark('process')
+            except Exception as ex:
+                error = ex
+
+            processed.put((index, data, error))  # Blocks while the queue is full
+
+        executor = self._get_executor(threads)
+        for index in range(len(json_batch)):
+            executor.submit(process_one, index)
+
+        # Requests are predicted as they are processed, the outcomes are put back in order
+        outcomes = [None] * len(json_batch)
+        for _ in range(len(json_batch)):
+            index, data, error = processed.get()
+            if error is None:
+                try:
+                    with self._metrics.timer('denzel_predict_seconds'):
+                        result = self._predict(model, data)
+                    traces[index].mark('predict')
+                except Exception as ex:
+                    error = ex
+
+            outcomes[index] = (None, error) if error is not None else (result, None)
+
+        return outcomes
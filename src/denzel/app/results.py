@@ -0,0 +1,70 @@
+import time
+
+from celery import states
+from app.tasks import app as celery_app
+from app.tracing import untraced_result
+
+MAX_STATUS_WAIT = 60.  # Seconds, longest a status request is held open
+
+
+def result_key(task_id: str) -> bytes:
+    """ Retrieves the redis key under which the backend stores a task's result """
+
+    return celery_app.backend.get_key_for_task(task_id)
+
+
+def decode_meta(payload, with_trace=False) -> dict:
+    """ Decodes a raw result stored by the backend to a {'status': ..., 'result': ...} response
+
+        A missing payload means the task is unknown to the backend, which is reported as pending. The worker's trace
+        of a sync request is added as 'trace' with with_trace, and is otherwise dropped """
+
+    if payload is None:
+        status, result, trace = states.PENDING, None, None
+    else:
+        meta = celery_app.backend.decode_result(payload)
+        status, (result, trace) = meta['status'], untraced_result(meta['result'])
+
+        if status in states.EXCEPTION_STATES:
+            result = str(celery_app.backend.exception_to_python(result))
+
+    response = {'status': status, 'result': result}
+    if with_trace:
+        response['trace'] = trace
+
+    return response
+
+
+def fetch_statuses(redis_client, task_ids) -> dict:
+    """ Retrieves the responses of many tasks in a single round trip, mapping task ID to response """
+
+    payloads = redis_client.mget([result_key(task_id) for task_id in task_ids])
+
+    return {task_id: decode_meta(payload) for task_id, payload in zip(task_ids, payloads)}
+
+
+def any_ready(statuses: dict) -> bool:
+    return any(response['status'] in states.READY_STATES for response in statuses.values())
+
+
+def wait_for_any(redis_client, task_ids, timeout: float):
+    """ Blocks until any of the tasks is ready or timeout seconds passed """
+
+    deadline = time.monotonic() + timeout
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+
+    try:
+        pubsub.subscribe(*[result_key(task_id) for task_id in task_ids])
+
+        # A task might have been ready before subscribing
+        if any_ready(fetch_statuses(redis_client, task_ids)):
+            return
+
+        remaining = timeout
+        while remaining > 0:
+            message = pubsub.get_message(timeout=remaining)
+            if message is not None and decode_meta(message['data'])['status'] in states.READY_STATES:
+                return
+            remaining = deadline - time.monotonic()
+    finally:
+        pubsub.close()
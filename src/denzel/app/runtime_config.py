@@ -0,0 +1,102 @@
+import threading
+import time
+
+import redis
+
+CONFIG_CHANNEL = 'denzel_config'  # The CLI publishes to this channel whenever it changes a setting
+REFRESH_INTERVAL = 30.  # Seconds, fallback refresh in case a notification was missed
+
+# Live settings, mapping name to (type, default value) - add new runtime settings here
+SETTINGS = {
+    'synchronous_timeout': (float, 5.),  # 0.0 means async responses
+    'batch_max_size': (int, 0),  # <= 1 means no batching
+    'batch_max_wait': (float, 0.),  # Seconds
+    'worker_drain_size': (int, 0),  # Waiting tasks a worker predicts at once, <= 1 means one
+    'pipeline_threads': (int, 0),  # Threads running process while predict runs, 0 means one after the other
+    'pipeline_queue_size': (int, 4),  # Processed requests waiting for predict, from which process threads wait
+    'cache_ttl': (float, 0.),  # Seconds, 0.0 means no caching
+    'cache_max_memory': (int, 64 * 1024 ** 2),  # Bytes
+    'model_version': (str, ''),
+    'variant_max_memory': (int, 1024 ** 3),  # Bytes, model variants resident in every worker process
+    'stream_chunk_size': (int, 256),  # Records sent to the worker as a single task
+    'stream_window': (int, 4),  # Chunks in progress at once
+    'stream_timeout': (float, 60.),  # Seconds, per chunk
+    'compression_min_size': (int, 1024),  # Bytes, smaller bodies are not compressed
+    'max_decompressed_size': (int, 100 * 1024 ** 2),  # Bytes, of compressed request bodies or their lines if streamed
+    'callback_compression': (str, ''),  # Encoding of callback bodies, empty means uncompressed
+    'payload_compression': (str, ''),  # Encoding of task arguments and results, empty means uncompressed
+    'callback_batch_size': (int, 1),  # Results sent to the same callback URI together, as a JSON array if > 1
+    'callback_max_attempts': (int, 5),  # Delivery attempts before a result is moved to the dead letters
+    'admission_max_queue': (int, 0),  # Queued tasks from which requests are rejected, 0 means unlimited
+    'admission_shed_sync': (int, 0),  # 1 rejects sync requests which are not expected to finish within the timeout
+    'store_async_results': (int, 1),  # 0 skips storing results delivered to callback URIs, /status won't find them
+    'bulk_min_size': (int, 0),  # Bytes, requests this large go to the bulk lane, 0 means only streams do
+    'autoscale_max_depth': (int, 1),  # Queued tasks per worker process from which processes are added
+    'autoscale_max_wait': (float, 1.),  # Seconds the oldest queued task may wait before processes are added
+    'autoscale_up_cooldown': (float, 10.),  # Seconds between adding processes
+    'autoscale_down_cooldown': (float, 60.),  # Seconds from the last change before removing a process
+}
+
+
+def parse_settings(names: list, values: list) -> dict:
+    """ Converts the raw values of settings, as read from redis, to their types, unset or malformed ones to their
+        defaults. For processes which read settings without a RuntimeConfig, e.g. ones which must not start threads """
+
+    settings = {}
+    for name, value in zip(names, values):
+        setting_type, default = SETTINGS[name]
+        try:
+            settings[name] = default if value is None else setting_type(value.decode())
+        except ValueError:  # Malformed value, treat as unset
+            settings[name] = default
+
+    return settings
+
+
+class RuntimeConfig(object):
+    """ Local snapshot of the runtime settings stored in redis
+
+        The snapshot is refreshed whenever a notification arrives on CONFIG_CHANNEL, and at least once every
+        REFRESH_INTERVAL seconds, so reading a setting never goes over the network """
+
+    def __init__(self, redis_client, refresh_interval=REFRESH_INTERVAL):
+        self._redis = redis_client
+        self._refresh_interval = refresh_interval
+        self._snapshot = {name: default for name, (_, default) in SETTINGS.items()}
+
+        try:
+            self.refresh()
+        except redis.RedisError:  # Redis not up yet, keep defaults until the listener manages to refresh
+            pass
+
+        self._thread = threading.Thread(target=self._listen, name='denzel-runtime-config', daemon=True)
+        self._thread.start()
+
+    def __getitem__(self, name):
+        return self._snapshot[name]
+
+    def snapshot(self) -> dict:
+        return dict(self._snapshot)
+
+    def refresh(self):
+        """ Reads all of the settings from redis in a single round trip """
+
+        names = list(SETTINGS)
+        self._snapshot = parse_settings(names, self._redis.mget(names))  # Swapped as a whole, never seen partially
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CONFIG_CHANNEL)
+                self.refresh()  # Changes might have been missed while not subscribed
+
+                last_refresh = time.monotonic()
+                while True:
+                    timeout = max(self._refresh_interval - (time.monotonic() - last_refresh), 0.)
+                    message = pubsub.get_message(timeout=timeout)
+                    if message is not None or time.monotonic() - last_refresh >= self._refresh_interval:
+                        self.refresh()
+                        last_refresh = time.monotonic()
+            except redis.RedisError:
+                time.sleep(1)  # Redis unavailable, retry subscribing
@@ -0,0 +1,157 @@
+import operator
+
+import numpy as np
+
+SCHEMA_ATTRIBUTE = 'INPUT_SCHEMA'  # Optional schema of a pipeline's requests, see InputValidator
+RECORD_IDS_FIELD = 'record_ids'  # Added by the validator, the IDs of the records as ordered in the array's rows
+
+# Kinds of values accepted for a feature by the kind of its dtype, e.g. integers for a float feature
+_ACCEPTED_KINDS = {'f': 'fiu', 'c': 'fiuc', 'i': 'iu', 'u': 'iu', 'b': 'b'}
+
+
+class InputValidator(object):
+    """ Validates requests by a declared schema, compiled once so a request's records are checked and converted to a
+        numpy array at once instead of value by value
+
+        The schema is a dict of:
+            features - Mapping of feature name to its dtype, or to (dtype, shape) for array features, in the order of
+                the array's columns
+            records - Field of the records, "data" by default
+            required - Other fields every request must have, e.g. ["callback_uri"]
+
+        The records may be a mapping of record ID to its features, a list of records, a mapping of feature name to a
+        numpy array of its values (as Arrow bodies are decoded) or a numpy array of the columns (.npy bodies). They
+        are replaced by a 2D array of a row per record and a column per feature, array features flattened into
+        consecutive columns, and the record IDs are added as record_ids (list indices when records have no IDs).
+        Extra features are ignored, booleans among numbers are taken as 0 and 1 """
+
+    def __init__(self, schema: dict):
+        features = schema['features']
+        features = list(features.items()) if isinstance(features, dict) else list(features)
+        if not features:
+            raise ValueError('{} must declare at least one feature'.format(SCHEMA_ATTRIBUTE))
+
+        self._records = schema.get('records', 'data')
+        self._required = list(schema.get('required', []))
+        self._names = [name for name, _ in features]
+        self._dtypes = []
+        self._shapes = []
+        for _, spec in features:
+            dtype, shape = spec if isinstance(spec, (tuple, list)) else (spec, ())
+            self._dtypes.append(np.dtype(dtype))
+            self._shapes.append(tuple(shape))
+
+        self._dtype = np.result_type(*self._dtypes)
+        self._width = sum(int(np.prod(shape)) for shape in self._shapes)
+
+        # Scalar features of a single kind are converted in one call, other schemas a feature at a time
+        self._uniform = not any(self._shapes) and len({dtype.kind for dtype in self._dtypes}) == 1
+        self._get_features = operator.itemgetter(*self._names)  # A record's features, a tuple unless there is one
+
+    def __call__(self, json_data):
+        """ Returns a copy of json_data with its records validated and converted, raises ValueError if invalid """
+
+        for field in self._required:
+            if field not in json_data:
+                raise ValueError('{} not supplied'.format(field))
+
+        if self._records not in json_data:
+            raise ValueError('no {} to predict for!'.format(self._records))
+
+        records = json_data[self._records]
+        if isinstance(records, np.ndarray):
+            record_ids, array = list(range(len(records))), self._from_array(records)
+        elif isinstance(records, dict) and isinstance(next(iter(records.values()), None), np.ndarray):
+            count = len(next(iter(records.values())))
+            record_ids, array = list(range(count)), self._from_columns(records, count)
+        elif isinstance(records, dict):
+            record_ids, array = list(records), self._from_records(list(records.values()))
+        elif isinstance(records, list):
+            record_ids, array = list(range(len(records))), self._from_records(records)
+        else:
+            raise ValueError('{} must be a mapping of record ID to features or a list of records'.format(self._records))
+
+        validated = dict(json_data)
+        validated[self._records] = array
+        validated[RECORD_IDS_FIELD] = record_ids
+        return validated
+
+    def _from_records(self, records: list) -> np.ndarray:
+        if not records:
+            return np.empty((0, self._width), dtype=self._dtype)
+
+        try:
+            rows = list(map(self._get_features, records))
+        except KeyError as ex:
+            raise ValueError('For each record all of the features {} must be present, {} is missing'.format(
+                self._names, ex))
+        except TypeError:
+            raise ValueError('Every record must be a mapping of feature name to value')
+
+        if self._uniform:
+            array = self._convert(rows, self._dtype, 'Features')
+            if array.size != len(rows) * self._width:
+                raise ValueError('Features must be single values')
+
+            return array.reshape(len(rows), self._width)
+
+        columns = zip(*rows) if len(self._names) > 1 else [rows]
+        return self._stack(list(columns), len(rows))
+
+    def _from_columns(self, records: dict, count: int) -> np.ndarray:
+        try:
+            columns = [records[name] for name in self._names]
+        except KeyError as ex:
+            raise ValueError('All of the features {} must be present, {} is missing'.format(self._names, ex))
+
+        return self._stack(columns, count)
+
+    def _from_array(self, records: np.ndarray) -> np.ndarray:
+        if records.ndim != 2 or records.shape[1] != self._width:
+            raise ValueError('{} must be an array of {} columns'.format(self._records, self._width))
+
+        return self._convert(records, self._dtype, 'Features')
+
+    def _stack(self, columns: list, count: int) -> np.ndarray:
+        """ Converts a column per feature and stacks them as the array's columns """
+
+        if not count:
+            return np.empty((0, self._width), dtype=self._dtype)
+
+        arrays = []
+        for name, dtype, shape, column in zip(self._names, self._dtypes, self._shapes, columns):
+            array = self._convert(column, dtype, name)
+            if array.shape != (count,) + shape:
+                raise ValueError('{} must be given for every record with the shape {}'.format(name, shape))
+
+            arrays.append(array.reshape(count, -1))
+
+        return np.hstack(arrays).astype(self._dtype, copy=False)
+
+    @staticmethod
+    def _convert(values, dtype: np.dtype, name: str) -> np.ndarray:
+        try:
+            array = np.asarray(values)
+        except ValueError:  # Values of different shapes
+            raise ValueError('{} must be of type {}'.format(name, dtype.name))
+
+        if array.dtype.kind not in _ACCEPTED_KINDS.get(dtype.kind, dtype.kind):
+            raise ValueError('{} must be of type {}'.format(name, dtype.name))
+
+        return array.astype(dtype, copy=False)
+
+
+def verifier(pipeline):
+    """ Retrieves the verification of a pipeline's requests - its verify_input, preceded by the validator of its
+        INPUT_SCHEMA if it declares one """
+
+    schema = getattr(pipeline, SCHEMA_ATTRIBUTE, None)
+    if schema is None:
+        return pipeline.verify_input
+
+    validate, verify_input = InputValidator(schema), pipeline.verify_input
+
+    def verify(json_data):
+        return verify_input(validate(json_data))
+
+    return verify
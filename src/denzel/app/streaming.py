@@ -0,0 +1,153 @@
+import asyncio
+import functools
+from collections import deque
+
+import ujson
+from celery import states
+from app.codecs import dumps
+from app.tasks import invoke_predict_batch, enqueue, verify_input
+from app.lanes import BULK_LANE
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+
+def _parse_record(line: bytes):
+    """ Parses and verifies a single NDJSON record, returns (json_data, error) """
+
+    try:
+        return verify_input(ujson.loads(line.decode())), None
+    except Exception as ex:
+        return None, str(ex)
+
+
+def _dispatch(chunk):
+    """ Sends the valid records of a chunk as a single batch task, returns None if there are none """
+
+    json_batch = [json_data for _, json_data, error in chunk if error is None]
+    if not json_batch:
+        return None
+
+    return enqueue(invoke_predict_batch, (json_batch, [None] * len(json_batch)), {'sync': True}, BULK_LANE)
+
+
+def _format_chunk(chunk, entries) -> bytes:
+    """ Formats the responses of a chunk as NDJSON lines, ordered as the records were received """
+
+    entries = iter(entries)
+    lines = []
+    for index, _, error in chunk:
+        if error is None:
+            entry = next(entries)
+        else:
+            entry = {'status': states.FAILURE, 'result': error}
+        lines.append(dumps({'index': index, 'status': entry['status'], 'result': entry['result']}))
+
+    return b'\n'.join(lines) + b'\n'
+
+
+def _failed_chunk(chunk, error: Exception) -> bytes:
+    return _format_chunk([(index, None, str(error)) for index, _, _ in chunk], [])
+
+
+def stream_predictions(lines, chunk_size: int, window: int, timeout: float):
+    """ Predicts NDJSON records, yielding their responses as NDJSON lines
+
+        Records are read only when there is room for them: at most window chunks of chunk_size records are being
+        predicted at any moment, so memory use does not depend on the size of the input """
+
+    in_flight = deque()  # (chunk, task) ordered as sent
+    chunk = []
+    index = 0
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        json_data, error = _parse_record(line)
+        chunk.append((index, json_data, error))
+        index += 1
+        if len(chunk) < chunk_size:
+            continue
+
+        in_flight.append((chunk, _dispatch(chunk)))
+        chunk = []
+
+        if len(in_flight) >= window:  # Wait for the oldest chunk before reading more
+            yield _collect(*in_flight.popleft(), timeout=timeout)
+
+    if chunk:
+        in_flight.append((chunk, _dispatch(chunk)))
+
+    while in_flight:
+        yield _collect(*in_flight.popleft(), timeout=timeout)
+
+
+def _collect(chunk, task, timeout: float) -> bytes:
+    if task is None:
+        return _format_chunk(chunk, [])
+
+    try:
+        return _format_chunk(chunk, task.get(timeout=timeout))
+    except Exception as ex:
+        return _failed_chunk(chunk, ex)
+
+
+async def stream_predictions_async(stream, chunk_size: int, window: int, timeout: float, listener):
+    """ Same as stream_predictions, reading from an ASGI request stream and waiting through a ResultListener """
+
+    loop = asyncio.get_event_loop()
+    in_flight = deque()
+    chunk = []
+    index = 0
+
+    async for line in _read_lines(stream):
+        line = line.strip()
+        if not line:
+            continue
+
+        json_data, error = _parse_record(line)
+        chunk.append((index, json_data, error))
+        index += 1
+        if len(chunk) < chunk_size:
+            continue
+
+        # Publishing to the broker is blocking, keep it off the event loop
+        in_flight.append((chunk, await loop.run_in_executor(None, functools.partial(_dispatch, chunk))))
+        chunk = []
+
+        if len(in_flight) >= window:
+            yield await _collect_async(*in_flight.popleft(), timeout=timeout, listener=listener)
+
+    if chunk:
+        in_flight.append((chunk, await loop.run_in_executor(None, functools.partial(_dispatch, chunk))))
+
+    while in_flight:
+        yield await _collect_async(*in_flight.popleft(), timeout=timeout, listener=listener)
+
+
+async def _collect_async(chunk, task, timeout: float, listener) -> bytes:
+    if task is None:
+        return _format_chunk(chunk, [])
+
+    try:
+        response = await listener.wait(task.id, timeout=timeout)
+        if response['status'] != states.SUCCESS:
+            raise RuntimeError(response['result'])
+        return _format_chunk(chunk, response['result'])
+    except Exception as ex:
+        return _failed_chunk(chunk, ex)
+
+
+async def _read_lines(stream):
+    """ Splits an ASGI request stream to lines """
+
+    remainder = b''
+    async for data in stream:
+        lines = (remainder + data).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line
+
+    if remainder:
+        yield remainder
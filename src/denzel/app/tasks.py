@@ -1,45 +1,801 @@
+import base64
+import gc
+import json
 import os
+import socket
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager, suppress
 
 import celery
-import requests
-from app.logic.pipeline import process, load_model, predict
+import redis
+from celery import states, signals
+from celery.utils.log import get_task_logger
+from kombu import serialization
+from app.codecs import CELERY_SERIALIZER, configure_celery_serializer
+from app.callbacks import queue_callback
+from app.runtime_config import RuntimeConfig
+from app.lanes import ASYNC_LANE, is_lane
+from app.models import load_pipeline, MODEL_ENV
+from app.schema import verifier
+from app.metrics import Metrics, MetricsFlusher, process_memory, FLUSH_INTERVAL
+from app.pipelining import PipelinedPredictor
+from app.variants import VariantCache, VARIANT_FIELD
+from app.health import heartbeat, WORKERS_KEY, HEARTBEAT_TTL, LOADING, WARMING, READY
+from app.tracing import Trace, traces_header, traces_from_request, traces_from_header, record_traces, traced_result, \
+    TRACES_HEADER
 
 CELERY_BROKER = os.environ.get('CELERY_BROKER')
 CELERY_BACKEND = os.environ.get('CELERY_BACKEND')
+COMPLETED_TASKS_KEY = 'denzel:completed_tasks:{}'  # Finished tasks per lane, the API derives drain rates from it
+SENT_HEADER = 'denzel_sent'  # Message header carrying the time a task was sent
+RESULT_TTL = int(os.environ.get('RESULT_TTL', 24 * 3600))  # Seconds results are stored for, 0 means forever
+WORKER_PRELOAD = os.environ.get('WORKER_PRELOAD', '1') == '1'  # Load the model before forking the worker processes
+MODEL_NAME = os.environ.get(MODEL_ENV, '')  # Model of app/logic/models this worker group serves, empty for pipeline.py
+DRAINING_KEY = 'denzel:draining'  # Hash of the draining lists of the worker processes to the time they were filled
+DRAINING_LIST_KEY = 'denzel:draining:{}:{}'  # Per lane and worker process, tasks drained and not yet completed
+REQUEUE_INTERVAL = 30.  # Seconds between checks for tasks drained by worker processes which are gone
+FULL_COLLECTION_THRESHOLD = 1000  # Without gc.freeze (Python 3.6), younger collections between full ones, default 10
+
+# The API sends all models the same tasks, each model's worker group runs them with the model's own pipeline
+pipeline = load_pipeline(MODEL_NAME)
+process, load_model, predict = pipeline.process, pipeline.load_model, pipeline.predict
+verify_input = verifier(pipeline)  # Validating by the pipeline's INPUT_SCHEMA first, if it declares one
 
 app = celery.Celery('tasks', broker=CELERY_BROKER, backend=CELERY_BACKEND)
+app.conf.update(task_serializer=CELERY_SERIALIZER,  # Numpy arrays pass between the API and worker intact
+                result_serializer=CELERY_SERIALIZER,
+                accept_content=[CELERY_SERIALIZER, 'json'],
+                task_default_queue=ASYNC_LANE,
+                worker_prefetch_multiplier=1,  # A busy process must not hold tasks other processes could take
+                worker_proc_alive_timeout=600,  # Seconds, worker processes load the model on start unless preloaded
+                result_expires=RESULT_TTL or None,
+                worker_autoscaler='app.autoscaling:QueueAutoscaler')  # Used when started with --autoscale
+
+_redis_client = None
+_runtime_config = None
+_runtime_config_pid = None
+
+# Aggregated in memory and flushed to redis periodically by every worker process
+metrics = Metrics()
+_completed = Counter()  # Lane to tasks completed by this process
+_flushed_completed = Counter()
+_throughput = 0.  # Tasks per second this process completed between its last two flushes, sent with its heartbeats
+_throughput_time = None
+_stage_busy = {}  # Stage to (seconds spent in it, time) as of the previous flush
+_metrics_flusher_pid = None
+_requeue_time = 0.
+
+pipelined = PipelinedPredictor(process, predict, metrics)
+_variant_cache = None
+_variant_cache_pid = None
+
+_state = LOADING  # Of this process's model, sent with its heartbeats
+# Optional hooks, projects created before they were added lack them
+warmup = getattr(pipeline, 'warmup', None)
+process_batch = getattr(pipeline, 'process_batch', None)
+predict_batch = getattr(pipeline, 'predict_batch', None)
+load_variant = getattr(pipeline, 'load_variant', None)
+logger = get_task_logger(__name__)
+
+
+def _process_name() -> str:
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def redis_client() -> redis.Redis:
+    """ Retrieves a client of the broker's redis, created on first use """
+
+    global _redis_client
+
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(CELERY_BROKER)
+
+    return _redis_client
+
+
+def runtime_config() -> RuntimeConfig:
+    """ Retrieves the runtime configuration, created per process since its refresh thread does not survive a fork """
+
+    global _runtime_config, _runtime_config_pid
+
+    if _runtime_config_pid != os.getpid():
+        _runtime_config = RuntimeConfig(redis_client())
+        _runtime_config_pid = os.getpid()
+
+    return _runtime_config
+
+
+def enqueue(task, args, kwargs, lane: str, task_id=None, traces=(), ignore_result=False):
+    """ Sends a task to a lane, stamped with the time it was sent and carrying the traces of its requests
+
+        With ignore_result the task's return value is not stored in the backend """
+
+    return task.apply_async(args, kwargs, queue=lane, task_id=task_id, ignore_result=ignore_result,
+                            headers={SENT_HEADER: time.time(), TRACES_HEADER: traces_header(traces)})
+
+
+# -------- Metrics --------
+def _sent_time(request):
+    """ Retrieves the time a task was sent, None if it was not sent through enqueue """
+
+    sent_time = getattr(request, SENT_HEADER, None)
+    if sent_time is None:
+        sent_time = (getattr(request, 'headers', None) or {}).get(SENT_HEADER)
+
+    return sent_time
+
+
+def _lane(request) -> str:
+    return (request.delivery_info or {}).get('routing_key') or 'unknown'
+
+
+def _flush_completed(redis_pipeline, snapshot):
+    """ Adds the tasks completed since the last flush to the counters admission control derives drain rates from """
+
+    global _throughput, _throughput_time
+
+    completed = 0
+    for lane, count in list(_completed.items()):
+        if count > _flushed_completed[lane]:
+            redis_pipeline.incrby(COMPLETED_TASKS_KEY.format(lane), count - _flushed_completed[lane])
+            completed += count - _flushed_completed[lane]
+            _flushed_completed[lane] = count
+
+    if _throughput_time is not None and snapshot['time'] > _throughput_time:
+        _throughput = completed / (snapshot['time'] - _throughput_time)
+    _throughput_time = snapshot['time']
+
+
+def _record_memory():
+    """ Sets this process's memory gauges, labeled by process as the point is comparing worker processes """
+
+    for kind, size in process_memory().items():
+        metrics.set('denzel_worker_{}_bytes'.format(kind), size, process=_process_name())
+
+
+def _variants() -> VariantCache:
+    """ Retrieves this process's model variants, every process loads its own """
+
+    global _variant_cache, _variant_cache_pid
+
+    if _variant_cache_pid != os.getpid():
+        _variant_cache = VariantCache(load_variant, runtime_config(), metrics)
+        _variant_cache_pid = os.getpid()
+
+    return _variant_cache
+
+
+def _record_utilization(snapshot):
+    """ Sets the share of time each stage was busy since the previous flush, out of the threads running it, so the
+        stage limiting throughput stands out """
+
+    for stage in ('process', 'predict'):
+        histogram = snapshot['histograms'].get('denzel_{}_seconds'.format(stage), {}).get('')
+        busy = histogram[-1] if histogram else 0.
+        previous_busy, previous_time = _stage_busy.get(stage, (busy, snapshot['time']))
+        _stage_busy[stage] = (busy, snapshot['time'])
+
+        if snapshot['time'] > previous_time:
+            threads = max(runtime_config()['pipeline_threads'], 1) if stage == 'process' else 1
+            utilization = (busy - previous_busy) / (snapshot['time'] - previous_time) / threads
+            metrics.set('denzel_stage_utilization', min(utilization, 1.), stage=stage, process=_process_name())
+
 
+def _on_flush(redis_pipeline, snapshot):
+    global _requeue_time
 
+    _flush_completed(redis_pipeline, snapshot)
+    _record_memory()  # Measured between flushes, so it is sent with the next one
+    _record_utilization(snapshot)
+    if _variant_cache_pid == os.getpid():
+        metrics.set('denzel_variant_resident_bytes', _variant_cache.memory, process=_process_name())
+    redis_pipeline.hset(WORKERS_KEY, _process_name(), heartbeat(_state, Model.model_version, MODEL_NAME,
+                                                                _throughput))
+
+    # Flushes are periodic, so this is also where a model version change set by "denzel reload-model" is noticed
+    model_version = runtime_config()['model_version']
+    if _state == READY and model_version not in (Model.model_version, Model.failed_model_version):
+        Model.reload(model_version)
+
+    if time.time() - _requeue_time >= REQUEUE_INTERVAL:
+        _requeue_time = time.time()
+        with suppress(redis.RedisError):  # Not to lose the flush's heartbeat
+            _requeue_drained()
+
+
+def _ensure_metrics_flusher():
+    """ Starts flushing metrics once per process, since the flusher thread does not survive a fork """
+
+    global _metrics_flusher_pid
+
+    if _metrics_flusher_pid != os.getpid():
+        MetricsFlusher(metrics, redis_client(), on_flush=_on_flush)
+        _metrics_flusher_pid = os.getpid()
+
+
+@signals.task_prerun.connect
+def task_started(task=None, **kwargs):
+    _ensure_metrics_flusher()
+    Model.begin_task()
+
+    task.request.denzel_start_time = time.perf_counter()
+    metrics.add('denzel_worker_in_flight', 1)
+
+    sent_time = _sent_time(task.request)
+    if sent_time is not None:
+        metrics.observe('denzel_queue_wait_seconds', max(time.time() - sent_time, 0.), lane=_lane(task.request))
+
+
+@signals.task_postrun.connect
+def task_finished(task=None, state=None, **kwargs):
+    Model.end_task()
+    lane = _lane(task.request)
+
+    metrics.add('denzel_worker_in_flight', -1)
+    metrics.inc('denzel_tasks_total', lane=lane, state=state)
+
+    start_time = getattr(task.request, 'denzel_start_time', None)
+    if start_time is not None:
+        metrics.observe('denzel_task_seconds', time.perf_counter() - start_time, lane=lane)
+
+    sent_time = _sent_time(task.request)
+    if sent_time is not None:
+        metrics.observe('denzel_end_to_end_seconds', max(time.time() - sent_time, 0.), lane=lane)
+
+    if is_lane(lane):
+        _completed[lane] += 1
+
+
+# -------- Model --------
 class Model(celery.Task):
+    """ Base of the tasks using the model, loaded by the worker only, never by other processes importing the tasks
 
-    def __init__(self):
-        with open('.worker_loading', 'a'):
-            pass
+        The model is loaded once per worker process, or with WORKER_PRELOAD once in the worker's parent process,
+        and shared by the processes it forks copy-on-write """
 
-        self._model = load_model()
+    _model = None  # Shared by all the tasks using this base
 
-        if os.path.exists('.worker_loading'):  # Needed because concurrent workers will retry to remove
-            os.remove('.worker_loading')
+    @classmethod
+    def load(cls):
+        if cls._model is None:
+            cls.model_version = _configured_model_version()
+            cls._model = load_model()
+
+    @classmethod
+    def load_current(cls):
+        """ Loads the model again if the configured version changed since it was preloaded. A reload only reaches
+            the processes running at the time, processes forked later - by the autoscaler or replacing ones which
+            exited - would otherwise serve the version the worker's parent process preloaded """
+
+        version = _configured_model_version(default=cls.model_version)
+        if version in (cls.model_version, cls.failed_model_version):
+            return
+
+        try:
+            model = load_model()
+        except Exception:
+            logger.exception('Failed loading model version {}, still serving {}'.format(version, cls.model_version))
+            cls.failed_model_version = version
+            return
+
+        cls.model_version, cls._model = version, model
+        logger.info('Loaded model version {}'.format(version))
 
     @property
     def model(self):
-        return self._model
+        if _state != READY:  # Not started by the worker's pool
+            _prepare()
+
+        return Model._model
+
+    # -------- Reloading --------
+    model_version = None  # Of the loaded model, the model_version runtime setting when it was loaded
+    failed_model_version = None  # Last version which failed to load, not retried until set again
+    _lock = threading.Lock()
+    _in_task = False
+    _reloading = False
+    _reloaded = None  # (version, model) loaded in the background, waiting to be swapped in between tasks
+
+    @classmethod
+    def reload(cls, version: str):
+        """ Loads and warms up the model again in a background thread, the loaded model keeps serving meanwhile """
+
+        with cls._lock:
+            if cls._reloading or (cls._reloaded is not None and cls._reloaded[0] == version):  # Already swapping in
+                return
+            cls._reloading = True
+
+        threading.Thread(target=cls._load_reloaded, args=(version,), name='denzel-reload', daemon=True).start()
+
+    @classmethod
+    def _load_reloaded(cls, version: str):
+        try:
+            model = load_model()
+            _warm_up(model)
+        except Exception:
+            logger.exception('Failed loading model version {}, still serving {}'.format(version, cls.model_version))
+            with cls._lock:
+                cls.failed_model_version = version
+                cls._reloading = False
+            return
+
+        with cls._lock:
+            cls._reloaded = (version, model)
+            cls._reloading = False
+            if not cls._in_task:
+                cls._swap()
+
+        logger.info('Loaded model version {}'.format(version))
+
+    @classmethod
+    def _swap(cls):
+        """ Swaps the reloaded model in, called with the lock held, never while a task is running """
+
+        if cls._reloaded is not None:
+            cls.model_version, cls._model = cls._reloaded
+            cls._reloaded = None
+
+    @classmethod
+    def begin_task(cls):
+        with cls._lock:
+            cls._swap()
+            cls._in_task = True
+
+    @classmethod
+    def end_task(cls):
+        with cls._lock:
+            cls._in_task = False
+            cls._swap()
+
+
+def _prepare():
+    """ Loads the model unless it was preloaded and warms it up, reporting this process's state with its heartbeats """
+
+    global _state
+
+    _state = LOADING
+    Model.load()
+    Model.load_current()
+
+    _state = WARMING
+    try:
+        _warm_up(Model._model)
+    except Exception:  # Requests might still succeed, failing ones fail as they always did
+        logger.exception('Warm-up failed')
+
+    _state = READY
+
+
+def _warm_up(model):
+    """ Runs the warmup samples through the pipeline """
+
+    samples = warmup() if warmup is not None else []
+    for json_data in samples:
+        predict(model, process(model, verify_input(json_data)))
+
+
+def _configured_model_version(default='') -> str:
+    """ Reads the model_version runtime setting directly, runtime_config() would start a thread in the worker's
+        parent process, which must not run threads while the pool forks. Returns default if redis is unavailable """
+
+    try:
+        model_version = redis_client().get('model_version')
+    except redis.RedisError:
+        return default
+
+    return '' if model_version is None else model_version.decode()
+
+
+@contextmanager
+def _heartbeating(state: str):
+    """ Sends heartbeats of a state while in the block, for processes which don't flush metrics """
+
+    stop = threading.Event()
+
+    def beat():
+        while True:
+            try:
+                redis_client().hset(WORKERS_KEY, _process_name(), heartbeat(state, model=MODEL_NAME))
+            except redis.RedisError:
+                pass
+            if stop.wait(FLUSH_INTERVAL):
+                return
+
+    thread = threading.Thread(target=beat, name='denzel-heartbeat', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()  # Done before forking, a thread must not be mid-command when the pool forks
+        with suppress(redis.RedisError):
+            redis_client().hdel(WORKERS_KEY, _process_name())
+
+
+@signals.worker_init.connect
+def preload_model(**kwargs):
+    """ Loads the model in the worker's parent process, before the pool forks its processes """
+
+    if not WORKER_PRELOAD:
+        return
+
+    with _heartbeating(LOADING):
+        Model.load()
+
+    # Collections traverse every tracked object, writing to its header and copying its page in every process.
+    # Frozen objects are left out of collections, so the loaded model's pages stay shared (Python 3.7 or later).
+    # Before, only full collections traverse the model's objects, which are old by now, so the forked processes
+    # inherit thresholds which make them rare instead - cycles are still collected, a full collection later
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    else:
+        threshold0, threshold1, _ = gc.get_threshold()
+        gc.set_threshold(threshold0, threshold1, FULL_COLLECTION_THRESHOLD)
+
+
+@signals.worker_process_init.connect
+def worker_process_started(**kwargs):
+    _ensure_metrics_flusher()  # Heartbeats are sent with the metrics, while loading too
+    configure_celery_serializer(runtime_config(), metrics)
+    _prepare()
+    with suppress(redis.RedisError):
+        _requeue_drained()  # Left by processes which died while predicting, later ones are found while flushing
+
+
+@signals.worker_process_shutdown.connect
+def worker_process_stopped(**kwargs):
+    with suppress(redis.RedisError):
+        redis_client().hdel(WORKERS_KEY, _process_name())
+
+
+# -------- Predicting --------
+def _observe_per_request(name: str, seconds: float, count: int):
+    """ Observes a batch's duration spread over its requests, so per request metrics stay comparable """
+
+    for _ in range(count):
+        metrics.observe(name, seconds / count)
+
+
+def _variant(json_data):
+    return json_data.get(VARIANT_FIELD) if isinstance(json_data, dict) else None
+
+
+def _predict_many(model, json_batch, traces) -> list:
+    """ Predicts many requests, returns a (result, exception) pair per request, exception being None on success
+
+        Requests naming a model variant are predicted by it, loaded by the pipeline's load_variant if not resident,
+        and the rest by model """
+
+    groups = OrderedDict()  # Variant to the indices of its requests, None for model
+    for index, json_data in enumerate(json_batch):
+        groups.setdefault(_variant(json_data), []).append(index)
+
+    outcomes = [None] * len(json_batch)
+    for variant, indices in groups.items():
+        group_traces = [traces[index] for index in indices]
+        try:
+            if variant is not None and load_variant is None:
+                raise ValueError('Model variants are not supported, pipeline.py does not define load_variant')
+            group_model = model if variant is None else _variants().get(variant)
+        except Exception as ex:  # Failed to load, the variant's requests fail
+            group_outcomes = [(None, ex)] * len(indices)
+        else:
+            if variant is not None:
+                for trace in group_traces:
+                    trace.mark('variant')
+            group_outcomes = _predict_group(group_model, [json_batch[index] for index in indices], group_traces)
+
+        for index, outcome in zip(indices, group_outcomes):
+            outcomes[index] = outcome
+
+    return outcomes
+
+
+def _predict_group(model, json_batch, traces) -> list:
+    """ Predicts many requests with the same model, returns a (result, exception) pair per request
+
+        With pipeline_threads set, process and predict of the requests overlap. Otherwise, when pipeline.py defines
+        process_batch and predict_batch, the requests are predicted in a single vectorized call. A failing batch is
+        predicted again request by request, so a bad request fails alone """
+
+    pipeline_threads = runtime_config()['pipeline_threads']
+    if pipeline_threads > 0 and len(json_batch) > 1:
+        return pipelined.predict_many(model, json_batch, traces,
+                                      threads=pipeline_threads, queue_size=runtime_config()['pipeline_queue_size'])
+
+    if process_batch is not None and predict_batch is not None and len(json_batch) > 1:
+        stage_counts = [len(trace.stages) for trace in traces]
+        try:
+            start_time = time.perf_counter()
+            data_batch = process_batch(model, json_batch)
+            process_end_time = time.perf_counter()
+            for trace in traces:
+                trace.mark('process')
+
+            results = list(predict_batch(model, data_batch))
+            if len(results) != len(json_batch):
+                raise ValueError('predict_batch returned {} results for {} requests'.format(len(results),
+                                                                                           len(json_batch)))
+            for trace in traces:
+                trace.mark('predict')
+
+            _observe_per_request('denzel_process_seconds', process_end_time - start_time, len(json_batch))
+            _observe_per_request('denzel_predict_seconds', time.perf_counter() - process_end_time, len(json_batch))
+
+            return [(result, None) for result in results]
+        except Exception:
+            logger.exception('Batch of {} requests failed, predicting request by request'.format(len(json_batch)))
+            for trace, stage_count in zip(traces, stage_counts):  # The requests go through the stages again
+                del trace.stages[stage_count:]
+
+    outcomes = []
+    for json_data, trace in zip(json_batch, traces):
+        try:
+            # Preprocess data
+            with metrics.timer('denzel_process_seconds'):
+                data = process(model, json_data)
+            trace.mark('process')
+
+            # Preform predictions
+            with metrics.timer('denzel_predict_seconds'):
+                result = predict(model, data)
+            trace.mark('predict')
+        except Exception as ex:
+            outcomes.append((None, ex))
+            continue
+
+        outcomes.append((result, None))
+
+    return outcomes
 
 
 @app.task(base=Model)
 def invoke_predict(json_data, sync=False):
-    # Preprocess data
-    data = process(invoke_predict.model, json_data)
+    """ Predicts a single request, along with up to worker_drain_size - 1 requests waiting in the same lane """
+
+    task_id = invoke_predict.request.id
+    trace = traces_from_request(invoke_predict.request).get(task_id) or Trace(task_id)
+    trace.mark('queue')
+
+    model = invoke_predict.model
+    trace.model_version = Model.model_version
+
+    lane = _lane(invoke_predict.request)
+    drained = _drain(lane, runtime_config()['worker_drain_size'] - 1)
+
+    try:
+        try:
+            outcomes = _predict_many(model,
+                                     [json_data] + [request.json_data for request in drained],
+                                     [trace] + [request.trace for request in drained])
+        except Exception as ex:  # The drained requests fail along, rather than waiting to be requeued
+            outcomes = [(None, ex)] * (len(drained) + 1)
+
+        if drained:
+            _complete_drained(invoke_predict.backend, lane, drained, outcomes[1:])
+
+        result, error = outcomes[0]
+        if error is not None:
+            raise error
+
+        # Send prediction to callback_uri, delivered by the callback dispatcher
+        if not sync:
+            queue_callback(redis_client(), json_data['callback_uri'], result, task_id, Model.model_version)
+    finally:  # Recorded for "denzel trace", sync responses get their trace along with the result
+        record_traces(redis_client(), [trace] + [request.trace for request in drained])
+
+    return traced_result(result, trace) if sync else result
+
+
+@app.task(base=Model)
+def invoke_predict_batch(json_batch, task_ids, sync=False, store_results=True):
+    """ Predicts a batch of coalesced requests, each request keeps its own task ID and result, stored for async
+        requests unless store_results is False
+
+        Returns a list of {'status': ..., 'result': ...} entries, ordered as json_batch, sync entries also carry
+        the request's 'trace' """
+
+    dequeue_time = time.time()
+    traces = traces_from_request(invoke_predict_batch.request)
+    model = invoke_predict_batch.model
+
+    batch_traces = []
+    for task_id in task_ids:
+        trace = traces.get(task_id) or Trace(task_id)
+        trace.mark('queue', dequeue_time)
+        trace.mark('batch')  # Waiting for the preceding requests of the batch, or for all of them when vectorized
+        trace.model_version = Model.model_version
+        batch_traces.append(trace)
+
+    entries = []
+    outcomes = _predict_many(model, json_batch, batch_traces)
+    for task_id, json_data, (result, error) in zip(task_ids, json_batch, outcomes):
+        if error is not None:  # A failing request should not fail the rest of the batch
+            if not sync and store_results:
+                invoke_predict_batch.backend.mark_as_failure(task_id, error)
+            entries.append({'status': states.FAILURE, 'result': str(error)})
+            continue
+
+        if not sync:
+            queue_callback(redis_client(), json_data['callback_uri'], result, task_id, Model.model_version)
+            if store_results:  # Store under the request's own task ID, so /status/{task_id} works as usual
+                invoke_predict_batch.backend.mark_as_done(task_id, result)
+
+        entries.append({'status': states.SUCCESS, 'result': result})
+
+    if sync:
+        for entry, task_id, trace in zip(entries, task_ids, batch_traces):
+            if task_id is not None:
+                entry['trace'] = trace.to_dict()
+
+    # Streamed records are not traced
+    record_traces(redis_client(), [trace for task_id, trace in zip(task_ids, batch_traces) if task_id is not None])
+
+    return entries
+
+
+# -------- Draining --------
+class DrainedRequest(object):
+    """ An invoke_predict task taken off the broker by another invoke_predict task, which completes it """
+
+    def __init__(self, raw_message: bytes, headers: dict, json_data, sync: bool, lane: str):
+        self.raw_message = raw_message
+        self.task_id = headers['id']
+        self.json_data = json_data
+        self.sync = sync
+        self.lane = lane
+        self.ignore_result = headers.get('ignore_result', False)
+        self.sent_time = headers.get(SENT_HEADER)
+
+        self.trace = traces_from_header(headers.get(TRACES_HEADER)).get(self.task_id) or Trace(self.task_id)
+        self.trace.mark('queue')
+        self.trace.model_version = Model.model_version
+
+        if self.sent_time is not None:
+            metrics.observe('denzel_queue_wait_seconds', max(time.time() - self.sent_time, 0.), lane=lane)
+
+    def complete(self, backend, result, error):
+        """ Delivers the request's result as its own task would have, and counts it as completed """
+
+        if error is None and not self.sync:
+            queue_callback(redis_client(), self.json_data['callback_uri'], result, self.task_id, Model.model_version)
+
+        if not self.ignore_result:
+            if error is None:
+                backend.mark_as_done(self.task_id, traced_result(result, self.trace) if self.sync else result)
+            else:
+                backend.mark_as_failure(self.task_id, error)
+
+        metrics.inc('denzel_tasks_total', lane=self.lane, state=states.SUCCESS if error is None else states.FAILURE)
+        metrics.inc('denzel_drained_tasks_total', lane=self.lane)
+        if self.sent_time is not None:
+            metrics.observe('denzel_end_to_end_seconds', max(time.time() - self.sent_time, 0.), lane=self.lane)
+        if is_lane(self.lane):
+            _completed[self.lane] += 1
+
+
+def _drain(lane: str, count: int) -> list:
+    """ Takes up to count invoke_predict tasks waiting in a lane off the broker, oldest first
+
+        Other tasks taken along are put back where they were. Drained tasks are not acknowledged like the task
+        draining them, they are moved to this process's draining list instead, which _release takes them off once they
+        are completed. If the process dies before, _requeue_drained puts them back in the lane """
+
+    if count <= 0 or not is_lane(lane):
+        return []
+
+    # The broker pushes to the head of the lane's list and workers pop its tail, the oldest messages
+    draining_key = _draining_key(lane)
+    pipeline = redis_client().pipeline()  # Transaction, so no message is taken twice or lost in between
+    for _ in range(count):
+        pipeline.rpoplpush(lane, draining_key)
+    pipeline.hset(DRAINING_KEY, draining_key, time.time())
+    messages = [raw_message for raw_message in pipeline.execute()[:-1] if raw_message is not None]
+
+    drained = []
+    others = []
+    for raw_message in messages:
+        try:
+            message = json.loads(raw_message)
+            headers = message.get('headers') or {}
+            if headers.get('task') != invoke_predict.name or message['properties'].get('body_encoding') != 'base64':
+                others.append(raw_message)
+                continue
+
+            args, kwargs, _ = serialization.loads(base64.b64decode(message['body']),
+                                                  message['content-type'], message['content-encoding'])
+            json_data = args[0] if args else kwargs['json_data']
+            sync = args[1] if len(args) > 1 else kwargs.get('sync', False)
+            drained.append(DrainedRequest(raw_message, headers, json_data, sync, lane))
+        except Exception:  # Malformed, left for the worker to reject as usual
+            logger.exception('Failed draining a message from {}'.format(lane))
+            others.append(raw_message)
+
+    if others:
+        pipeline = redis_client().pipeline()
+        pipeline.rpush(lane, *reversed(others))  # Oldest back at the tail
+        for raw_message in others:
+            pipeline.lrem(draining_key, 1, raw_message)
+        pipeline.execute()
+
+    return drained
+
+
+def _draining_key(lane: str) -> str:
+    return DRAINING_LIST_KEY.format(lane, _process_name())
+
+
+def _complete_drained(backend, lane: str, drained: list, outcomes: list):
+    """ Completes drained requests by their (result, exception) outcomes, then releases them. A request which fails
+        to complete is marked as failed instead, without keeping the rest from completing """
+
+    handled = []
+    try:
+        for request, (result, error) in zip(drained, outcomes):
+            try:
+                request.complete(backend, result, error)
+            except Exception as ex:
+                logger.exception('Failed completing drained task {}'.format(request.task_id))
+                try:
+                    backend.mark_as_failure(request.task_id, ex)
+                except Exception:  # Left in the draining list, requeued once this process is gone
+                    continue
+            handled.append(request)
+    finally:
+        _release(lane, handled)
+
+
+def _release(lane: str, drained: list):
+    """ Takes completed drained requests off this process's draining list of a lane. Only those, since the list may
+        hold requests drained by other tasks of this process meanwhile. The list's entry in DRAINING_KEY is left to
+        _requeue_drained, which removes it once this process is gone """
+
+    if not drained:
+        return
+
+    pipeline = redis_client().pipeline()
+    for request in drained:
+        pipeline.lrem(_draining_key(lane), 1, request.raw_message)
+    pipeline.execute()
+
+
+def _requeue_drained():
+    """ Puts the tasks drained by worker processes which are gone back at the tail of their lanes, to be taken next.
+        A process is gone when it sent no heartbeat for HEARTBEAT_TTL seconds, nor drained tasks meanwhile """
+
+    client = redis_client()
+    draining = client.hgetall(DRAINING_KEY)
+    if not draining:
+        return
 
-    # Preform predictions
-    result = predict(invoke_predict.model, data)
+    heartbeats = client.hgetall(WORKERS_KEY)
+    now = time.time()
+    for draining_key, drain_time in draining.items():
+        draining_key = draining_key.decode()
+        _, _, lane, process_name = draining_key.split(':', 3)
+        worker_heartbeat = heartbeats.get(process_name.encode())
+        if worker_heartbeat is not None and now - json.loads(worker_heartbeat)['time'] <= HEARTBEAT_TTL:
+            continue
+        if now - float(drain_time) <= HEARTBEAT_TTL:  # Might have drained before its first heartbeat
+            continue
 
-    # Send prediction to callback_uri
-    if not sync:
-        requests.post(url=json_data['callback_uri'],
-                      json=result)
+        def requeue(pipeline, draining_key=draining_key, lane=lane):
+            messages = pipeline.lrange(draining_key, 0, -1)  # Newest first
+            pipeline.multi()
+            if messages:
+                pipeline.rpush(lane, *messages)  # Oldest last, at the tail
+            pipeline.delete(draining_key)
+            pipeline.hdel(DRAINING_KEY, draining_key)
+            return len(messages)
 
-    return result
+        # Retried if the list changes meanwhile, so tasks are never requeued twice
+        requeued = client.transaction(requeue, draining_key, value_from_callable=True)
+        if requeued:
+            logger.warning('Requeued {} tasks drained from {} by {}, which is gone'.format(requeued, lane,
+                                                                                          process_name))
 
 
 Model = app.register_task(Model())
@@ -0,0 +1,116 @@
+import json
+import time
+import uuid
+
+import redis
+
+TRACE_ID_HEADER = 'X-Trace-Id'  # Response header, also the task ID of the request
+MODEL_VERSION_HEADER = 'X-Model-Version'  # Response and callback header, the model version which predicted
+TRACES_HEADER = 'denzel_traces'  # Message header carrying the API's part of the traces, by trace ID
+TRACE_STREAM = 'denzel:traces'  # Capped stream of the latest traces, read by "denzel trace --slowest"
+TRACE_MAX_LEN = 10000  # Approximate number of traces kept in the stream
+TRACE_KEY = 'denzel:trace:{}'  # A single trace, for lookups by ID
+TRACE_TTL = 600  # Seconds a trace can be looked up by ID
+TRACED_RESULT_FIELD = 'denzel_traced_result'  # Sync results carry the worker's trace, see traced_result
+
+
+class Trace(object):
+    """ Timestamps of the stages a request went through, identified by the request's task ID
+
+        Every stage is stamped when it ends, so a stage's duration is the time since the previous stamp.
+        The API stamps received, parse, verify and enqueue, the worker continues with queue, process and predict,
+        and sync responses end with respond. The worker also records the version of the model which predicted """
+
+    def __init__(self, trace_id=None, stages=None, model_version=None):
+        self.trace_id = trace_id or str(uuid.uuid4())
+        self.stages = stages or [['received', time.time()]]
+        self.model_version = model_version
+
+    def mark(self, stage: str, timestamp=None):
+        self.stages.append([stage, timestamp or time.time()])
+
+    def update(self, other: 'Trace'):
+        """ Adopts the stages of other, this trace as continued by the worker, if it got further """
+
+        if len(other.stages) > len(self.stages):
+            self.stages = other.stages
+
+        self.model_version = other.model_version or self.model_version
+
+    def durations(self) -> list:
+        """ Retrieves a (stage, seconds) pair per stage, after the first """
+
+        return [(stage, max(end - start, 0.)) for (_, start), (stage, end) in zip(self.stages, self.stages[1:])]
+
+    def total(self) -> float:
+        return self.stages[-1][1] - self.stages[0][1]
+
+    def server_timing(self) -> str:
+        """ Formats the durations as a Server-Timing header value, in milliseconds """
+
+        timings = ['{};dur={:.3f}'.format(stage, seconds * 1000) for stage, seconds in self.durations()]
+        timings.append('total;dur={:.3f}'.format(self.total() * 1000))
+
+        return ', '.join(timings)
+
+    def to_dict(self) -> dict:
+        return {'id': self.trace_id, 'stages': self.stages, 'model_version': self.model_version}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Trace':
+        return cls(trace_id=data['id'], stages=[list(stage) for stage in data['stages']],
+                   model_version=data.get('model_version'))
+
+
+def traces_header(traces) -> dict:
+    """ Builds the message header carrying traces to the worker """
+
+    return {trace.trace_id: trace.stages for trace in traces}
+
+
+def traces_from_request(request) -> dict:
+    """ Retrieves the traces carried by a task's message, by trace ID """
+
+    header = getattr(request, TRACES_HEADER, None)
+    if header is None:
+        header = (getattr(request, 'headers', None) or {}).get(TRACES_HEADER)
+
+    return traces_from_header(header)
+
+
+def traces_from_header(header) -> dict:
+    """ Retrieves the traces carried in a message's traces header, by trace ID """
+
+    return {trace_id: Trace(trace_id, [list(stage) for stage in stages]) for trace_id, stages in (header or {}).items()}
+
+
+def record_traces(redis_client, traces):
+    """ Stores finished traces in the stream and under their IDs, in a single round trip """
+
+    if not traces:
+        return
+
+    try:
+        pipeline = redis_client.pipeline(transaction=False)
+        for trace in traces:
+            payload = json.dumps(trace.to_dict())
+            pipeline.xadd(TRACE_STREAM, {'trace': payload}, maxlen=TRACE_MAX_LEN, approximate=True)
+            pipeline.set(TRACE_KEY.format(trace.trace_id), payload, ex=TRACE_TTL)
+        pipeline.execute()
+    except redis.RedisError:  # Tracing must never fail a task, e.g. redis older than 5.0 has no streams
+        pass
+
+
+def traced_result(result, trace: Trace) -> dict:
+    """ Wraps a sync request's result along with its trace, so the API continues the trace without looking it up """
+
+    return {TRACED_RESULT_FIELD: result, 'trace': trace.to_dict()}
+
+
+def untraced_result(result):
+    """ Unwraps a result of traced_result, returns (result, trace) where trace is None for results not wrapped """
+
+    if isinstance(result, dict) and TRACED_RESULT_FIELD in result:
+        return result[TRACED_RESULT_FIELD], Trace.from_dict(result['trace'])
+
+    return result, None
@@ -0,0 +1,93 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from app.metrics import process_memory
+
+VARIANT_FIELD = 'model_variant'  # Request field naming the model variant to predict with
+
+
+class VariantCache(object):
+    """ Model variants loaded on demand by the pipeline's load_variant, kept in the worker process's memory
+
+        The least recently used variants are evicted once the resident variants pass variant_max_memory bytes, the
+        variant just loaded is always kept. A variant requested while it is being loaded is loaded once, the other
+        tasks wait for it. A variant's size is the growth of the process's resident memory while loading it, so it
+        is approximate, and 0 where /proc is unavailable """
+
+    def __init__(self, load_variant, runtime_config, metrics):
+        self._load_variant = load_variant
+        self._config = runtime_config
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        self._variants = OrderedDict()  # Name to (model, bytes), least recently used first
+        self._loading = {}  # Name to the future of the task loading it
+        self._memory = 0
+
+    @property
+    def memory(self) -> int:
+        with self._lock:
+            return self._memory
+
+    def get(self, variant: str):
+        """ Retrieves a variant's model, loading it if it is not resident """
+
+        model, future, leader = self._lookup(variant)
+        if model is not None:
+            return model
+
+        if not leader:
+            return future.result()
+
+        try:
+            rss = process_memory().get('rss', 0)
+            with self._metrics.timer('denzel_variant_load_seconds'):
+                model = self._load_variant(variant)
+            size = max(process_memory().get('rss', 0) - rss, 0)
+        except Exception as ex:
+            self._complete(variant, future, error=ex)
+            raise
+
+        self._complete(variant, future, model=model, size=size)
+        return model
+
+    def _lookup(self, variant: str):
+        """ Returns (model, None, False) on a hit, else (None, future, leader) where the leader loads the variant """
+
+        with self._lock:
+            entry = self._variants.get(variant)
+            if entry is not None:
+                self._variants.move_to_end(variant)
+                self._metrics.inc('denzel_variant_requests_total', outcome='hit')
+                return entry[0], None, False
+
+            future = self._loading.get(variant)
+            if future is not None:
+                self._metrics.inc('denzel_variant_requests_total', outcome='coalesced')
+                return None, future, False
+
+            future = Future()
+            self._loading[variant] = future
+            self._metrics.inc('denzel_variant_requests_total', outcome='miss')
+            return None, future, True
+
+    def _complete(self, variant: str, future: Future, model=None, size=0, error=None):
+        with self._lock:
+            if error is None:
+                self._variants[variant] = (model, size)
+                self._memory += size
+                self._evict()
+
+            del self._loading[variant]
+
+        if error is None:
+            future.set_result(model)
+        else:
+            future.set_exception(error)
+
+    def _evict(self):
+        max_memory = self._config['variant_max_memory']
+        while len(self._variants) > 1 and self._memory > max_memory:  # Tasks still using an evicted variant keep it
+            _, (_, size) = self._variants.popitem(last=False)
+            self._memory -= size
+            self._metrics.inc('denzel_variant_evictions_total')
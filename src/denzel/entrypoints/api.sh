@@ -15,4 +15,9 @@ if [[ -f .building ]] || [[ -f .updateosreqs ]]; then
 fi
 
 rm -f .building
-gunicorn -b 0.0.0.0:8000 app:app
+
+if [[ "$API_SERVER" == "asgi" ]]; then
+    uvicorn --host 0.0.0.0 --port 8000 app.asgi:app
+else
+    gunicorn -b 0.0.0.0:8000 app.api:app
+fi
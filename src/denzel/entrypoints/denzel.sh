@@ -15,4 +15,44 @@ if [[ -f .building ]] || [[ -f .updateosreqs ]]; then
 fi
 
 rm -f .building
-celery -A app.tasks worker --loglevel=info --logfile=logs/worker.log -n worker@$PROJECT_NAME
+
+# Delivers results to callback URIs, off the workers - restarted whenever it exits
+(while true; do python -m app.callbacks; sleep 1; done) &
+
+# Lane weights, e.g. sync:2,async:1,bulk:1 - read on every start so "denzel lanes" applies after a restart
+WORKER_LANES=$(grep -s '^worker_lanes=' .env | cut -d '=' -f 2-)
+WORKER_ARGS="-A app.tasks worker --loglevel=info --logfile=logs/worker.log -O fair"
+
+# Load the model once per worker instead of once per worker process, unless disabled by "denzel preload"
+WORKER_PRELOAD=$(grep -s '^worker_preload=' .env | cut -d '=' -f 2-)
+export WORKER_PRELOAD=${WORKER_PRELOAD:-1}
+
+# Worker processes set by "denzel scale", either fixed or autoscaling bounds as max,min which apply to every worker
+WORKER_CONCURRENCY=$(grep -s '^worker_concurrency=' .env | cut -d '=' -f 2-)
+WORKER_AUTOSCALE=$(grep -s '^worker_autoscale=' .env | cut -d '=' -f 2-)
+AUTOSCALE_ARGS=${WORKER_AUTOSCALE:+--autoscale=$WORKER_AUTOSCALE}
+
+# Seconds results are stored for, set by "denzel results"
+RESULT_TTL=$(grep -s '^result_ttl=' .env | cut -d '=' -f 2-)
+export RESULT_TTL=${RESULT_TTL:-86400}
+
+# A worker group per model of app/logic/models, consuming the model's lane only, with the processes set by
+# "denzel models", e.g. fraud:2,churn:1 - models not listed run a single process
+MODEL_WORKERS=$(grep -s '^model_workers=' .env | cut -d '=' -f 2-)
+for MODEL in $(python -m app.models); do
+    CONCURRENCY=$(echo ",$MODEL_WORKERS," | grep -o ",$MODEL:[0-9]*," | cut -d ':' -f 2 | tr -d ',')
+    DENZEL_MODEL=$MODEL celery $WORKER_ARGS -Q model.$MODEL -c ${CONCURRENCY:-1} $AUTOSCALE_ARGS \
+        -n $MODEL@%h &
+done
+
+if [[ -z "$WORKER_LANES" ]]; then
+    # A single worker shares all of the lanes
+    celery $WORKER_ARGS ${WORKER_CONCURRENCY:+-c $WORKER_CONCURRENCY} $AUTOSCALE_ARGS -Q sync,async,bulk \
+        -n worker@%h
+else
+    # A worker per lane, running as many processes as the lane's weight
+    for LANE in ${WORKER_LANES//,/ }; do
+        celery $WORKER_ARGS -Q ${LANE%%:*} -c ${LANE##*:} $AUTOSCALE_ARGS -n ${LANE%%:*}@%h &
+    done
+    wait
+fi
@@ -2,7 +2,7 @@ import os
 import subprocess
 from contextlib import suppress
 from shutil import copytree, ignore_patterns
-from time import sleep
+from time import sleep, strftime, localtime
 
 import click
 import denzel
@@ -33,11 +33,20 @@ def create_project(project_name, use_gpu):
         env_file.write('COMPOSE_PROJECT_NAME={}\n'.format(project_name))
         env_file.write('api_port={}\n'.format(config.API_PORT))
         env_file.write('monitor_port={}\n'.format(config.MONITOR_PORT))
+        env_file.write('api_server={}\n'.format(config.API_SERVER))
+        env_file.write('worker_lanes={}\n'.format(config.WORKER_LANES))
+        env_file.write('worker_preload={}\n'.format(config.WORKER_PRELOAD))
+        env_file.write('model_workers={}\n'.format(config.MODEL_WORKERS))
+        env_file.write('worker_concurrency={}\n'.format(config.WORKER_CONCURRENCY))
+        env_file.write('worker_autoscale={}\n'.format(config.WORKER_AUTOSCALE))
+        env_file.write('result_ttl={}\n'.format(config.RESULT_TTL))
+        env_file.write('redis_max_memory={}\n'.format(config.REDIS_MAX_MEMORY))
         env_file.write('image_name={}\n'.format(config.DENZEL_IMAGE_NAME + ('-gpu' if use_gpu else '')))
         env_file.write('image_tag={}\n'.format(config.DENZEL_IMAGE_TAG))
         env_file.write('dockerfile={}\n'.format('Dockerfile' + ('.gpu' if use_gpu else '')))
         env_file.write('runtime={}\n'.format('nvidia' if use_gpu else 'runc'))
         env_file.write('redis_image_tag={}\n'.format(config.REDIS_IMAGE_TAG))
+        env_file.write('balancer_image_tag={}\n'.format(config.BALANCER_IMAGE_TAG))
 
     click.echo('Successfully built ', nl=False)
     click.secho(project_name, fg=config.Colors.DESCRIPTOR.value, nl=False)
@@ -45,7 +54,7 @@ def create_project(project_name, use_gpu):
 
 
 @utils.verify_location
-def launch(api_port, monitor_port):
+def launch(api_port, monitor_port, api_server, workers, api_replicas):
     # Checks if project already launched
     if utils.get_containers_names():
         raise click.ClickException('Project already launched! Did you mean to run "denzel start"?')
@@ -56,18 +65,11 @@ def launch(api_port, monitor_port):
     if utils.is_port_taken(monitor_port):
         raise click.ClickException('Port {} is already taken! Pass an available port using the --monitor-port option')
 
+    if workers < 1 or api_replicas < 1:
+        raise click.ClickException('--workers and --api-replicas must be at least 1')
+
     # Change .env file
-    with open('.env') as env_file:  # Read
-        env_data = env_file.readlines()
-
-    with open('.env', 'w') as env_file:  # Write
-        for data_line in env_data:
-            if 'api_port' in data_line:
-                env_file.write('api_port={}\n'.format(api_port))  # API port
-            elif 'monitor_port' in data_line:
-                env_file.write('monitor_port={}\n'.format(monitor_port))  # Monitor port
-            else:
-                env_file.write(data_line)
+    utils.update_env(api_port=api_port, monitor_port=monitor_port, api_server=api_server)
 
     # Let the user know if using existing image, or creating a new one
     env_data = utils.read_env()
@@ -82,7 +84,8 @@ def launch(api_port, monitor_port):
 
     # Create temporary file for the building stage to be deleted by the startup scripts
     with utils.set_status(config.Status.BUILDING, remove=False):
-        command = ['docker-compose', 'up', '-d', '--no-recreate']
+        command = ['docker-compose', 'up', '-d', '--no-recreate',
+                   '--scale', 'denzel={}'.format(workers), '--scale', 'api={}'.format(api_replicas)]
         subprocess.run(command)
 
 
@@ -100,6 +103,7 @@ def shutdown(purge):
 def start():
     command = ['docker-compose', 'start']
     subprocess.run(command)
+    utils.apply_redis_max_memory()  # Set by "denzel results" after the redis container was created
 
 
 @utils.verify_location
@@ -143,7 +147,8 @@ def status(live):
                         click.secho(status.value, fg=utils.status_to_color(status),  # Service status
                                     nl=service not in config.SERVICES_WITH_EXPOSED_PORT or status != config.Status.UP)
                         if service in config.SERVICES_WITH_EXPOSED_PORT and status == config.Status.UP:
-                            click.echo(' [ Port: {} ]'.format(docker_env['{}_port'.format(service)]))  # Service port
+                            port = docker_env[config.SERVICES_WITH_EXPOSED_PORT[service]]
+                            click.echo(' [ Port: {} ]'.format(port))  # Service port
 
             # Display worker status
             if 'monitor' in service_status[config.Status.UP]:
@@ -153,6 +158,12 @@ def status(live):
                     click.echo('Worker: {} - '.format(worker), nl=False)  # Worker name
                     click.secho(status.value, fg=utils.status_to_color(status))  # Worker status
 
+            # Display readiness and throughput of every worker replica
+            if 'redis' in service_status[config.Status.UP]:
+                for replica, processes in sorted(utils.get_worker_replicas().items()):
+                    click.echo('Replica: {} - {}/{} processes ready, {:.1f} tasks/s'.format(
+                        replica, processes['ready'], processes['processes'], processes['throughput']))
+
             if not live:
                 break
 
@@ -208,12 +219,182 @@ def logworker(live):
 
 
 @utils.verify_location
-def shell(service):
-    container_names = utils.get_containers_names()
-    command = ['docker', 'exec', '-it', container_names[service], 'bash']
+def shell(service, replica):
+    replicas = utils.get_replicas().get(service, [])
+    if not 1 <= replica <= len(replicas):
+        raise click.ClickException('{} has {} replicas'.format(service, len(replicas)))
+
+    command = ['docker', 'exec', '-it', replicas[replica - 1], config.SERVICE_SHELLS.get(service, 'bash')]
     subprocess.run(command)
 
 
 @utils.verify_location
 def response(sync, timeout):
     utils.set_response_manner(synchronous=sync, timeout=timeout)
+
+
+@utils.verify_location
+def batching(enable, max_size, max_wait, worker_drain):
+    utils.set_batching(max_size=max_size if enable else 0,
+                       max_wait=max_wait / 1000,  # Milliseconds to seconds
+                       worker_drain=worker_drain if enable else 0)
+
+
+@utils.verify_location
+def cache(enable, ttl, max_memory):
+    utils.set_cache(ttl=ttl if enable else 0.,
+                    max_memory=max_memory * 1024 ** 2)  # Megabytes to bytes
+
+
+@utils.verify_location
+def variants(max_memory):
+    utils.set_variants(max_memory=max_memory * 1024 ** 2)  # Megabytes to bytes
+
+
+@utils.verify_location
+def streaming(chunk_size, window, timeout):
+    utils.set_streaming(chunk_size=chunk_size, window=window, timeout=timeout)
+
+
+@utils.verify_location
+def compression(min_size, callback, payload, max_request_size):
+    utils.set_compression(min_size=min_size,
+                          callback='' if callback == 'none' else callback,
+                          payload='' if payload == 'none' else payload,
+                          max_request_size=max_request_size)
+
+
+@utils.verify_location
+def admission(max_queue, shed_sync):
+    utils.set_admission(max_queue=max_queue, shed_sync=shed_sync)
+
+
+@utils.verify_location
+def callbacks(batch_size, max_attempts, requeue_dead):
+    utils.set_callbacks(batch_size=batch_size, max_attempts=max_attempts)
+
+    if requeue_dead:
+        click.echo('Requeued {} dead callbacks'.format(utils.requeue_dead_callbacks()))
+
+
+@utils.verify_location
+def pipelining(threads, queue_size):
+    utils.set_pipelining(threads=threads, queue_size=queue_size)
+
+
+@utils.verify_location
+def trace(task_id, slowest):
+    if task_id is not None:
+        request_trace = utils.get_trace(task_id)
+        if request_trace is None:
+            raise click.ClickException('No trace of {}, it might have been too long ago'.format(task_id))
+
+        durations = utils.trace_durations(request_trace)
+        click.echo('Trace of ', nl=False)
+        click.secho(task_id, fg=config.Colors.DESCRIPTOR.value, nl=False)
+        click.echo(' [ Total: {:.3f} ms ]'.format(sum(duration for _, duration in durations)))
+        for stage, duration in durations:
+            click.echo('\t{:<10}{:>12.3f} ms'.format(stage, duration))
+        return
+
+    traces = [(utils.trace_durations(request_trace), request_trace['id']) for request_trace in utils.get_traces()]
+    traces.sort(key=lambda item: sum(duration for _, duration in item[0]), reverse=True)
+
+    click.echo('{:<38}{:>12}  {}'.format('Task ID', 'Total (ms)', 'Stages (ms)'))
+    for durations, trace_id in traces[:slowest]:
+        click.echo('{:<38}{:>12.3f}  {}'.format(trace_id,
+                                               sum(duration for _, duration in durations),
+                                               ' '.join('{}={:.1f}'.format(stage, duration)
+                                                        for stage, duration in durations)))
+
+
+@utils.verify_location
+def lanes(enable, weights, bulk_min_size):
+    worker_lanes = ','.join('{}:{}'.format(lane, weights[lane]) for lane in config.LANES) if enable else ''
+    utils.set_lanes(worker_lanes=worker_lanes,
+                    bulk_min_size=bulk_min_size * 1024)  # Kilobytes to bytes
+
+    click.echo('Worker lanes take effect after a restart ("denzel restart")')
+
+
+@utils.verify_location
+def results(ttl, store_async, max_memory):
+    utils.set_results(ttl=ttl, store_async=store_async, max_memory=max_memory)
+
+    click.echo('Result TTL takes effect after a restart ("denzel restart")')
+
+
+@utils.verify_location
+def gc(purge_results):
+    if purge_results:
+        click.echo('Deleted {} results'.format(utils.purge_results()))
+
+    memory = utils.get_backend_memory()
+    click.echo('Backend memory:')
+    click.echo('\tUsed - {} [ Peak: {} ]'.format(memory['used'], memory['peak']))
+    click.echo('\tMax - {} [ Policy: {} ]'.format('unlimited' if memory['max'] == '0B' else memory['max'],
+                                                  memory['policy']))
+    click.echo('\tStored results - {}'.format(memory['results']))
+    click.echo('\tExpired keys - {}'.format(memory['expired_keys']))
+    click.secho('\tEvicted keys - {}'.format(memory['evicted_keys']),
+                fg=config.Colors.NEUTRAL.value if memory['evicted_keys'] else None)
+
+
+@utils.verify_location
+def reload_model(version):
+    utils.set_model_version(version)
+
+    click.echo('Worker processes are loading model version ', nl=False)
+    click.secho(version, fg=config.Colors.DESCRIPTOR.value, nl=False)
+    click.echo(', the current version is served until it is loaded ("/health" shows the versions served)')
+
+
+@utils.verify_location
+def models(workers):
+    served_models = utils.get_models()
+    unknown_models = set(workers) - set(served_models)
+    if unknown_models:
+        raise click.ClickException('No model named {} in {}'.format(', '.join(sorted(unknown_models)),
+                                                                    config.MODELS_DIR))
+
+    model_workers = utils.get_model_workers()
+    if workers:
+        model_workers.update(workers)
+        utils.set_model_workers(model_workers)
+        click.echo('Model workers take effect after a restart ("denzel restart")')
+
+    if not served_models:
+        click.echo('No models in {}, only /predict is served'.format(config.MODELS_DIR))
+
+    for model in served_models:
+        click.echo('/predict/{} - {} worker processes'.format(model, model_workers.get(model, 1)))
+
+
+@utils.verify_location
+def scale(workers, min_workers, max_workers, policy):
+    utils.set_scaling(workers=workers, min_workers=min_workers, max_workers=max_workers, policy=policy)
+
+    click.echo('Worker processes take effect after a restart ("denzel restart")')
+    if workers is None:
+        click.echo('Scaling thresholds and cooldowns take effect right away')
+
+
+@utils.verify_location
+def scaling_log(count):
+    click.echo('{:<21}{:<28}{:<6}{:>11}{:>8}{:>13}'.format('Time', 'Worker', 'Scale', 'Processes', 'Queued',
+                                                           'Oldest (s)'))
+    for decision in reversed(utils.get_scaling_log(count)):
+        click.echo('{:<21}{:<28}{:<6}{:>11}{:>8}{:>13.2f}'.format(
+            strftime('%Y-%m-%d %H:%M:%S', localtime(decision['time'])),
+            decision['worker'],
+            decision['direction'],
+            '{} -> {}'.format(decision['processes'], decision['target']),
+            decision['queue_depth'],
+            decision['oldest_wait']))
+
+
+@utils.verify_location
+def preload(enable):
+    utils.update_env(worker_preload=int(enable))
+
+    click.echo('Preloading takes effect after a restart ("denzel restart")')
@@ -1,19 +1,73 @@
 from enum import Enum
 
-SERVICES = ['api', 'denzel', 'monitor', 'redis']
-SERVICES_WITH_EXPOSED_PORT = ['api', 'monitor']
+SERVICES = ['api', 'balancer', 'denzel', 'monitor', 'redis']
+SERVICES_WITH_EXPOSED_PORT = {'balancer': 'api_port', 'monitor': 'monitor_port'}  # Service to its port in the env file
+SERVICE_SHELLS = {'balancer': 'sh'}  # Shell of services whose image has no bash, e.g. alpine based
 
 DENZEL_IMAGE_NAME = 'denzel'
-DENZEL_IMAGE_TAG = '1.1.0'
+DENZEL_IMAGE_TAG = '1.2.0'
 
 DENZEL_IMAGE_SERVICES = ['api', 'denzel', 'monitor']
 
-REDIS_IMAGE_TAG = '4'
+REDIS_IMAGE_TAG = '5'  # Streams, used for request traces, require redis 5
+BALANCER_IMAGE_TAG = 'alpine'  # nginx, balancing the API replicas
 
 WORKER_LOG_PATH = 'logs/worker.log'
 
 PIP_REQUIREMENTS_FILE = 'requirements.txt'
 
+RUNTIME_CONFIG_CHANNEL = 'denzel_config'  # Must match app.runtime_config.CONFIG_CHANNEL
+
+# Request traces, must match app.tracing
+TRACE_STREAM = 'denzel:traces'
+TRACE_KEY = 'denzel:trace:{}'
+TRACE_MAX_LEN = 10000
+
+# Worker heartbeats, must match app.health
+WORKERS_KEY = 'denzel:workers'
+HEARTBEAT_TTL = 5.
+
+# Callback delivery, must match app.callbacks
+CALLBACK_QUEUE = 'denzel:callbacks'
+CALLBACK_DEAD_LETTERS = 'denzel:callbacks:dead'
+
+# Moves every dead letter back to the callback queue, returns their count
+REQUEUE_DEAD_SCRIPT = """
+local count = 0
+while redis.call('rpoplpush', KEYS[1], KEYS[2]) do
+    count = count + 1
+end
+return count
+"""
+
+# API servers, wsgi runs a gunicorn worker, asgi runs an asyncio worker (uvicorn)
+API_SERVERS = ['wsgi', 'asgi']
+API_SERVER = 'wsgi'
+
+# Scheduling lanes, each consumed by its own worker processes when weights are set
+LANES = ['sync', 'async', 'bulk']
+WORKER_LANES = ''  # Empty means a single worker shares all of the lanes
+WORKER_PRELOAD = 1  # Load the model before forking worker processes, sharing it between them
+
+# Worker processes, fixed or autoscaled, empty means fixed at one per CPU
+WORKER_CONCURRENCY = ''
+WORKER_AUTOSCALE = ''  # Bounds as max,min
+SCALING_LOG_KEY = 'denzel:scaling_log'
+
+# Additional models, a module each, served on /predict/<model> by worker groups of their own
+MODELS_DIR = 'app/logic/models'
+MODEL_WORKERS = ''  # Model to worker processes, e.g. fraud:2,churn:1 - models not listed run a single process
+
+# Results, stored by the worker in redis
+RESULT_TTL = 24 * 3600  # Seconds, 0 means forever
+RESULT_KEY_PATTERN = 'celery-task-meta-*'
+REDIS_MAX_MEMORY = 0  # Megabytes, 0 means unlimited
+REDIS_MAX_MEMORY_POLICY = 'volatile-ttl'  # Must match docker-compose.yml
+
+# Container replicas by default, created on launch and kept by start and stop
+WORKER_REPLICAS = 1
+API_REPLICAS = 1
+
 # PORTS
 API_PORT = 8000
 MONITOR_PORT = 5555
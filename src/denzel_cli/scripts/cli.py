@@ -1,3 +1,5 @@
+import time
+
 from .. import commands
 from .. import config
 
@@ -22,9 +24,14 @@ def startproject(name, gpu):
 @cli.command()
 @click.option('--api-port', default=config.API_PORT, type=int, help="API endpoints port", show_default=True)
 @click.option('--monitor-port', default=config.MONITOR_PORT, type=int, help="Monitor UI port", show_default=True)
-def launch(api_port, monitor_port):
+@click.option('--api-server', default=config.API_SERVER, type=click.Choice(config.API_SERVERS),
+              help="API server, asgi waits for sync responses without blocking", show_default=True)
+@click.option('--workers', default=config.WORKER_REPLICAS, type=int, help="Worker containers", show_default=True)
+@click.option('--api-replicas', default=config.API_REPLICAS, type=int,
+              help="API containers, behind a load balancer on the API port", show_default=True)
+def launch(api_port, monitor_port, api_server, workers, api_replicas):
     """Builds and starts all services"""
-    commands.launch(api_port, monitor_port)
+    commands.launch(api_port, monitor_port, api_server, workers, api_replicas)
 
 
 # -------- shutdown --------
@@ -110,9 +117,11 @@ def logworker(live):
 @cli.command()
 @click.option('--service', default='denzel', type=click.Choice(config.SERVICES),
               help='Target service', show_default=True)
-def shell(service):
-    """Connect to service bash shell"""
-    commands.shell(service)
+@click.option('--replica', default=1, type=int, help='Replica of the service, as numbered by "denzel status"',
+              show_default=True)
+def shell(service, replica):
+    """Connect to service shell"""
+    commands.shell(service, replica)
 
 
 # -------- response --------
@@ -129,3 +138,291 @@ def response(sync, timeout):
         raise click.ClickException('Sync timeout must be greater than 0')
 
     commands.response(sync, timeout)
+
+
+# -------- batching --------
+@cli.command()
+@click.option('--enable/--disable', required=True, default=True, help='Batching of concurrent requests')
+@click.option('--max-size', default=64, type=int, show_default=True, help='Maximal number of requests in a batch')
+@click.option('--max-wait', default=5., type=float, show_default=True,
+              help='Maximal time to wait for a batch to fill, in milliseconds')
+@click.option('--worker-drain', default=0, type=int, show_default=True,
+              help='Maximal number of waiting requests a worker predicts at once, 0 disables draining')
+def batching(enable, max_size, max_wait, worker_drain):
+    """Set batching of concurrent prediction requests"""
+
+    if enable and max_size <= 1:
+        raise click.ClickException('Batch max size must be greater than 1')
+
+    if max_wait < 0:
+        raise click.ClickException('Batch max wait can\'t be negative')
+
+    if worker_drain < 0:
+        raise click.ClickException('Worker drain can\'t be negative')
+
+    commands.batching(enable, max_size, max_wait, worker_drain)
+
+
+# -------- cache --------
+@cli.command()
+@click.option('--enable/--disable', required=True, default=True, help='Caching of prediction responses')
+@click.option('--ttl', default=60., type=float, show_default=True, help='Time to keep a response, in seconds')
+@click.option('--max-memory', default=64, type=int, show_default=True,
+              help='Maximal memory used by the cache, in megabytes')
+def cache(enable, ttl, max_memory):
+    """Set caching of prediction responses"""
+
+    if enable and ttl <= 0:
+        raise click.ClickException('Cache TTL must be greater than 0')
+
+    if max_memory <= 0:
+        raise click.ClickException('Cache max memory must be greater than 0')
+
+    commands.cache(enable, ttl, max_memory)
+
+
+# -------- variants --------
+@cli.command()
+@click.option('--max-memory', default=1024, type=int, show_default=True,
+              help='Maximal memory used by model variants in every worker process, in megabytes')
+def variants(max_memory):
+    """Set memory of model variants kept loaded in the worker"""
+
+    if max_memory < 0:
+        raise click.ClickException('Variants max memory can\'t be negative')
+
+    commands.variants(max_memory)
+
+
+# -------- streaming --------
+@cli.command()
+@click.option('--chunk-size', default=256, type=int, show_default=True,
+              help='Number of records sent to the worker together')
+@click.option('--window', default=4, type=int, show_default=True, help='Number of chunks in progress at once')
+@click.option('--timeout', default=60., type=float, show_default=True, help='Chunk response timeout in seconds')
+def streaming(chunk_size, window, timeout):
+    """Set chunking of streamed prediction requests"""
+
+    if chunk_size <= 0 or window <= 0:
+        raise click.ClickException('Chunk size and window must be greater than 0')
+
+    if timeout <= 0:
+        raise click.ClickException('Chunk timeout must be greater than 0')
+
+    commands.streaming(chunk_size, window, timeout)
+
+
+# -------- compression --------
+@cli.command()
+@click.option('--min-size', default=1024, type=int, show_default=True,
+              help='Smallest response body in bytes to compress')
+@click.option('--callback', default='none', type=click.Choice(['none', 'gzip', 'zstd']), show_default=True,
+              help='Encoding of bodies sent to callback URIs')
+@click.option('--payload', default='none', type=click.Choice(['none', 'gzip', 'zstd']), show_default=True,
+              help='Encoding of task arguments and results passed through redis')
+@click.option('--max-request-size', default=100 * 1024 ** 2, type=int, show_default=True,
+              help='Largest size in bytes a compressed request may decompress to, per line if streamed, '
+                   '0 for unlimited')
+def compression(min_size, callback, payload, max_request_size):
+    """Set compression of responses, callbacks and task payloads"""
+
+    if min_size < 0 or max_request_size < 0:
+        raise click.ClickException('Sizes must be at least 0')
+
+    commands.compression(min_size, callback, payload, max_request_size)
+
+
+# -------- admission --------
+@cli.command()
+@click.option('--max-queue', default=0, type=int, show_default=True,
+              help='Number of queued tasks from which requests are rejected, 0 for unlimited')
+@click.option('--shed-sync/--no-shed-sync', default=False, show_default=True,
+              help='Reject sync requests which are not expected to finish within the timeout')
+def admission(max_queue, shed_sync):
+    """Set admission control of prediction requests"""
+
+    if max_queue < 0:
+        raise click.ClickException('Max queue can\'t be negative')
+
+    commands.admission(max_queue, shed_sync)
+
+
+# -------- callbacks --------
+@cli.command()
+@click.option('--batch-size', default=1, type=int, show_default=True,
+              help='Results sent to the same callback URI together, as a JSON array if greater than 1')
+@click.option('--max-attempts', default=5, type=int, show_default=True,
+              help='Delivery attempts before a result is given up on')
+@click.option('--requeue-dead', is_flag=True, help='Send the results which were given up on again')
+def callbacks(batch_size, max_attempts, requeue_dead):
+    """Set delivery of results to callback URIs"""
+
+    if batch_size < 1:
+        raise click.ClickException('Batch size must be at least 1')
+
+    if max_attempts < 1:
+        raise click.ClickException('Max attempts must be at least 1')
+
+    commands.callbacks(batch_size, max_attempts, requeue_dead)
+
+
+# -------- pipelining --------
+@cli.command()
+@click.option('--threads', default=0, type=int, show_default=True,
+              help='Threads running process while predict runs, 0 runs them one after the other')
+@click.option('--queue-size', default=4, type=int, show_default=True,
+              help='Processed requests waiting for predict, from which the process threads wait')
+def pipelining(threads, queue_size):
+    """Set overlapping of process and predict in the worker"""
+
+    if threads < 0:
+        raise click.ClickException('Threads can\'t be negative')
+
+    if queue_size < 1:
+        raise click.ClickException('Queue size must be at least 1')
+
+    commands.pipelining(threads, queue_size)
+
+
+# -------- trace --------
+@cli.command()
+@click.argument('task_id', required=False)
+@click.option('--slowest', type=int, help='Summarize the N slowest recent requests instead')
+def trace(task_id, slowest):
+    """Show stage timings of a request, or of the slowest requests"""
+
+    if (task_id is None) == (slowest is None):
+        raise click.ClickException('Pass either a task ID or --slowest N')
+
+    if slowest is not None and slowest <= 0:
+        raise click.ClickException('Number of slowest requests must be greater than 0')
+
+    commands.trace(task_id, slowest)
+
+
+# -------- lanes --------
+@cli.command()
+@click.option('--enable/--disable', required=True, default=True, help='Separate worker processes per lane')
+@click.option('--sync-weight', default=2, type=int, show_default=True, help='Worker processes of the sync lane')
+@click.option('--async-weight', default=1, type=int, show_default=True, help='Worker processes of the async lane')
+@click.option('--bulk-weight', default=1, type=int, show_default=True, help='Worker processes of the bulk lane')
+@click.option('--bulk-min-size', default=1024, type=int, show_default=True,
+              help='Request size from which requests go to the bulk lane, in kilobytes, 0 for streams only')
+def lanes(enable, sync_weight, async_weight, bulk_weight, bulk_min_size):
+    """Set scheduling lanes of sync, async and bulk requests"""
+
+    weights = {'sync': sync_weight, 'async': async_weight, 'bulk': bulk_weight}
+    if enable and min(weights.values()) <= 0:
+        raise click.ClickException('Lane weights must be greater than 0')
+
+    if bulk_min_size < 0:
+        raise click.ClickException('Bulk min size can\'t be negative')
+
+    commands.lanes(enable, weights, bulk_min_size)
+
+
+# -------- results --------
+@cli.command()
+@click.option('--ttl', default=24 * 3600, type=int, show_default=True,
+              help='Seconds results are stored for, 0 for forever')
+@click.option('--store-async/--no-store-async', default=True, show_default=True,
+              help='Store results which are sent to callback URIs')
+@click.option('--max-memory', default=0, type=int, show_default=True,
+              help='Memory cap of redis in megabytes, 0 for unlimited')
+def results(ttl, store_async, max_memory):
+    """Set storing of prediction results"""
+
+    if ttl < 0:
+        raise click.ClickException('TTL can\'t be negative')
+
+    if max_memory < 0:
+        raise click.ClickException('Max memory can\'t be negative')
+
+    commands.results(ttl, store_async, max_memory)
+
+
+# -------- gc --------
+@cli.command()
+@click.option('--purge-results', is_flag=True, help='Delete all of the stored results')
+def gc(purge_results):
+    """Show and reclaim memory used by stored results"""
+
+    commands.gc(purge_results)
+
+
+# -------- reload-model --------
+@cli.command(name='reload-model')
+@click.option('--version', help='Version of the loaded model  [default: current time]')
+def reload_model(version):
+    """Load the model again without downtime"""
+
+    if version is None:
+        version = time.strftime('%Y%m%d-%H%M%S')
+
+    commands.reload_model(version)
+
+
+# -------- scale --------
+@cli.command()
+@click.option('--workers', type=int, help='Fixed number of worker processes, 0 for one per CPU')
+@click.option('--min', 'min_workers', default=1, type=int, show_default=True,
+              help='Worker processes autoscaling starts from and never goes below')
+@click.option('--max', 'max_workers', type=int, help='Worker processes autoscaling never goes above, enables it')
+@click.option('--max-depth', default=1, type=int, show_default=True,
+              help='Queued tasks per worker process from which processes are added')
+@click.option('--max-wait', default=1., type=float, show_default=True,
+              help='Seconds the oldest queued task may wait before processes are added')
+@click.option('--up-cooldown', default=10., type=float, show_default=True, help='Seconds between adding processes')
+@click.option('--down-cooldown', default=60., type=float, show_default=True,
+              help='Seconds from the last change before removing a process')
+@click.option('--log', 'log_count', type=int, help='Show this many latest scaling decisions instead')
+def scale(workers, min_workers, max_workers, max_depth, max_wait, up_cooldown, down_cooldown, log_count):
+    """Set worker processes, fixed or autoscaled by the queues"""
+
+    if log_count is not None:
+        if log_count <= 0:
+            raise click.ClickException('Log count must be greater than 0')
+        commands.scaling_log(log_count)
+        return
+
+    if (workers is None) == (max_workers is None):
+        raise click.ClickException('Set either --workers, or --max to autoscale')
+
+    if workers is not None and workers < 0:
+        raise click.ClickException('Workers can\'t be negative')
+
+    if max_workers is not None and not 0 <= min_workers <= max_workers or max_workers == 0:
+        raise click.ClickException('Autoscaling requires 0 <= --min <= --max and --max > 0')
+
+    if max_depth <= 0 or min(max_wait, up_cooldown, down_cooldown) < 0:
+        raise click.ClickException('Max depth must be greater than 0, max wait and cooldowns can\'t be negative')
+
+    commands.scale(workers, min_workers, max_workers, {'max_depth': max_depth, 'max_wait': max_wait,
+                                                       'up_cooldown': up_cooldown, 'down_cooldown': down_cooldown})
+
+
+# -------- models --------
+@cli.command()
+@click.option('--workers', '-w', multiple=True, metavar='MODEL:PROCESSES',
+              help='Worker processes of a model, may be repeated')
+def models(workers):
+    """Show the served models and set their worker processes"""
+
+    model_workers = {}
+    for entry in workers:
+        model, _, processes = entry.partition(':')
+        if not model or not processes.isdigit() or int(processes) <= 0:
+            raise click.ClickException('Workers must be given as MODEL:PROCESSES, with at least 1 process')
+        model_workers[model] = int(processes)
+
+    commands.models(model_workers)
+
+
+# -------- preload --------
+@cli.command()
+@click.option('--enable/--disable', required=True, default=True,
+              help='Load the model once and share it between worker processes')
+def preload(enable):
+    """Set sharing of the loaded model between worker processes"""
+
+    commands.preload(enable)
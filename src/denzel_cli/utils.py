@@ -1,7 +1,9 @@
 from typing import Optional
 import subprocess
 import re
+import json
 import os
+import time
 from contextlib import contextmanager
 from collections import defaultdict
 
@@ -124,34 +126,297 @@ def redis_backup(background: bool):
     redis_container.exec_run(command)
 
 
-def set_response_manner(synchronous: bool, timeout: float):
-    """ Set the state of synchronous responses True == async, False == sync """
+def redis_command(*args, shell=False):
+    """ Executes a redis-cli command in the redis container, returns None if redis is not up
+
+        With shell, args is a single shell command line instead, e.g. for piping redis-cli commands """
 
     containers_status = get_containers_status()
     if 'redis' not in containers_status[config.Status.UP]:
-        return
+        return None
 
     # Fetch the redis container
     client = docker.from_env()
     containers_names = get_containers_names()
     redis_container = client.containers.get(containers_names['redis'])
 
-    # Set or del
-    command = ['redis-cli', 'set', 'synchronous_timeout']
+    if shell:
+        return redis_container.exec_run(['sh', '-c'] + list(args))
 
-    if not synchronous:
-        timeout = 0.0
+    return redis_container.exec_run(['redis-cli'] + [str(arg) for arg in args])
+
+
+def _redis_info(*sections) -> dict:
+    """ Retrieves fields of redis INFO sections, as strings """
+
+    info = {}
+    for section in sections:
+        result = redis_command('info', section)
+        if result is None:
+            raise click.ClickException('Redis is not up')
+
+        for line in result.output.decode().splitlines():
+            field, _, value = line.partition(':')
+            if value:
+                info[field] = value.strip()
+
+    return info
+
+
+def set_results(ttl: int, store_async: bool, max_memory: int):
+    """ Set how long results are stored, whether async results are stored at all, and the redis memory cap """
+
+    update_env(result_ttl=ttl, redis_max_memory=max_memory)  # The TTL is read by the worker on start
+    set_runtime_config(store_async_results=int(store_async))
+    apply_redis_max_memory()
+
+
+def apply_redis_max_memory(timeout: float = 10.):
+    """ Sets the redis memory cap of the env file, waiting up to timeout seconds for redis to accept commands.
+        The redis container keeps the cap it was created with, so this is done again whenever the stack starts """
+
+    max_memory = read_env().get('redis_max_memory')
+    if max_memory is None:  # Projects created before the cap was configurable
+        return
+
+    deadline = time.time() + timeout
+    while True:
+        result = redis_command('config', 'set', 'maxmemory', '{}mb'.format(max_memory))
+        if result is not None and result.output.strip() == b'OK':
+            break
+        if time.time() > deadline:
+            click.secho('Failed setting the redis memory cap, run "denzel results" again once redis is up',
+                        fg=config.Colors.FAILURE.value)
+            return
+        time.sleep(.5)
+
+    redis_command('config', 'set', 'maxmemory-policy', config.REDIS_MAX_MEMORY_POLICY)
+
+
+def get_backend_memory() -> dict:
+    """ Retrieves the memory usage of redis and the number of stored results """
+
+    info = _redis_info('memory', 'stats')
+    result = redis_command('--scan', '--pattern', config.RESULT_KEY_PATTERN, '--count', 1000)
+
+    return {'used': info.get('used_memory_human', '?'),
+            'peak': info.get('used_memory_peak_human', '?'),
+            'max': info.get('maxmemory_human', '0B'),
+            'policy': info.get('maxmemory_policy', '?'),
+            'evicted_keys': int(info.get('evicted_keys', 0)),
+            'expired_keys': int(info.get('expired_keys', 0)),
+            'results': len(result.output.splitlines())}
+
+
+def purge_results() -> int:
+    """ Deletes all of the stored results and returns memory to the OS, returns the number of results deleted """
 
-    command.append(str(timeout))
+    # Deleted in batches, unlink frees the memory in the background so redis keeps serving meanwhile
+    result = redis_command("redis-cli --scan --pattern '{}' --count 1000 | "
+                           "xargs -r -n 1000 redis-cli unlink | "
+                           "awk '{{deleted += $1}} END {{print deleted + 0}}'".format(config.RESULT_KEY_PATTERN),
+                           shell=True)
+    if result is None:
+        raise click.ClickException('Redis is not up')
 
-    result = redis_container.exec_run(command)
+    redis_command('memory', 'purge')  # Freed memory is kept by the allocator otherwise
+
+    return int(result.output.decode().strip() or 0)
+
+
+def set_runtime_config(**settings):
+    """ Sets runtime settings and notifies the API, returns False if redis is not up """
+
+    command = ['mset']
+    for name, value in settings.items():
+        command += [name, value]
+
+    result = redis_command(*command)
+    if result is None:
+        return False
 
     if result.exit_code != 0:
-        raise click.ClickException('Failed to change response manner')
+        raise click.ClickException('Failed to change {}'.format(', '.join(settings)))
+
+    # Notify the API so it refreshes its runtime configuration
+    redis_command('publish', config.RUNTIME_CONFIG_CHANNEL, ','.join(settings))
 
     # Save
     redis_backup(background=True)
 
+    return True
+
+
+def set_response_manner(synchronous: bool, timeout: float):
+    """ Set the state of synchronous responses True == async, False == sync """
+
+    if not synchronous:
+        timeout = 0.0
+
+    set_runtime_config(synchronous_timeout=timeout)
+
+
+def set_batching(max_size: int, max_wait: float, worker_drain: int):
+    """ Set the API requests batching, max_size <= 1 disables batching, worker_drain <= 1 disables draining """
+
+    set_runtime_config(batch_max_size=max_size, batch_max_wait=max_wait, worker_drain_size=worker_drain)
+
+
+def set_cache(ttl: float, max_memory: int):
+    """ Set the API predictions cache, ttl == 0 disables caching """
+
+    set_runtime_config(cache_ttl=ttl, cache_max_memory=max_memory)
+
+
+def set_variants(max_memory: int):
+    """ Set the memory model variants may take in every worker process """
+
+    set_runtime_config(variant_max_memory=max_memory)
+
+
+def set_streaming(chunk_size: int, window: int, timeout: float):
+    """ Set the chunking of streamed prediction requests """
+
+    set_runtime_config(stream_chunk_size=chunk_size, stream_window=window, stream_timeout=timeout)
+
+
+def set_compression(min_size: int, callback: str, payload: str, max_request_size: int):
+    """ Set the compression threshold, the encoding of callback bodies and of task arguments and results, and the
+        size compressed requests may decompress to """
+
+    set_runtime_config(compression_min_size=min_size, callback_compression=callback, payload_compression=payload,
+                       max_decompressed_size=max_request_size)
+
+
+def get_trace(task_id: str):
+    """ Retrieves the trace of a request as a dictionary, None if it was not found """
+
+    result = redis_command('get', config.TRACE_KEY.format(task_id))
+    if result is None:
+        raise click.ClickException('Redis is not up')
+
+    payload = result.output.decode().strip()
+    if payload:
+        return json.loads(payload)
+
+    # Expired as a single trace, might still be in the stream
+    for trace in get_traces():
+        if trace['id'] == task_id:
+            return trace
+
+    return None
+
+
+def get_traces() -> list:
+    """ Retrieves the recent traces, latest first """
+
+    result = redis_command('xrevrange', config.TRACE_STREAM, '+', '-', 'COUNT', config.TRACE_MAX_LEN)
+    if result is None:
+        raise click.ClickException('Redis is not up')
+
+    if result.exit_code != 0:
+        raise click.ClickException('Failed to read traces, tracing requires redis 5 or later')
+
+    # Every entry is printed as its ID, field name and value, each on its own line
+    lines = result.output.decode().splitlines()
+    return [json.loads(payload) for payload in lines[2::3]]
+
+
+def trace_durations(trace: dict) -> list:
+    """ Retrieves a (stage, milliseconds) pair per stage of a trace, each stage being stamped when it ended """
+
+    stages = trace['stages']
+    return [(stage, max(end - start, 0.) * 1000) for (_, start), (stage, end) in zip(stages, stages[1:])]
+
+
+def set_callbacks(batch_size: int, max_attempts: int):
+    """ Set how many results are delivered to a callback URI together, and how many times delivery is attempted """
+
+    set_runtime_config(callback_batch_size=batch_size, callback_max_attempts=max_attempts)
+
+
+def set_pipelining(threads: int, queue_size: int):
+    """ Set how many threads run process while predict runs, 0 runs them one after the other """
+
+    set_runtime_config(pipeline_threads=threads, pipeline_queue_size=queue_size)
+
+
+def requeue_dead_callbacks() -> int:
+    """ Moves the callbacks which failed for good back to the delivery queue, returns their count """
+
+    result = redis_command('eval', config.REQUEUE_DEAD_SCRIPT, 2, config.CALLBACK_DEAD_LETTERS, config.CALLBACK_QUEUE)
+    if result is None:
+        raise click.ClickException('Redis is not up')
+
+    return int(result.output.decode().strip() or 0)
+
+
+def set_model_version(model_version: str):
+    """ Set the model version, worker processes load the model again when it changes """
+
+    if not set_runtime_config(model_version=model_version):
+        raise click.ClickException('Redis is not up')
+
+
+def set_admission(max_queue: int, shed_sync: bool):
+    """ Set the API admission control, max_queue == 0 means an unlimited queue """
+
+    set_runtime_config(admission_max_queue=max_queue, admission_shed_sync=int(shed_sync))
+
+
+def set_lanes(worker_lanes: str, bulk_min_size: int):
+    """ Set the lane weights read by the worker on start, and the size from which requests go to the bulk lane """
+
+    update_env(worker_lanes=worker_lanes)
+    set_runtime_config(bulk_min_size=bulk_min_size)
+
+
+@verify_location
+def get_models() -> list:
+    """ Retrieves the names of the models declared in app/logic/models, a module or package each """
+
+    if not os.path.isdir(config.MODELS_DIR):  # Projects created before models were added
+        return []
+
+    return sorted(os.path.splitext(name)[0] for name in os.listdir(config.MODELS_DIR)
+                  if not name.startswith('_') and
+                  (name.endswith('.py') or os.path.isfile(os.path.join(config.MODELS_DIR, name, '__init__.py'))))
+
+
+def get_model_workers() -> dict:
+    """ Retrieves the worker processes set per model, read by the worker on start """
+
+    model_workers = read_env().get('model_workers', config.MODEL_WORKERS)
+    return {model: int(processes) for model, processes in
+            (entry.split(':') for entry in model_workers.split(',') if entry)}
+
+
+def set_model_workers(model_workers: dict):
+    update_env(model_workers=','.join('{}:{}'.format(model, processes)
+                                      for model, processes in sorted(model_workers.items())))
+
+
+def set_scaling(workers: int, min_workers: int, max_workers: int, policy: dict):
+    """ Set fixed worker processes, or autoscaling between min_workers and max_workers when workers is None
+
+        The processes are read by the worker on start, the autoscaling policy is applied right away """
+
+    if workers is not None:
+        update_env(worker_concurrency=workers or '', worker_autoscale='')
+    else:
+        update_env(worker_concurrency='', worker_autoscale='{},{}'.format(max_workers, min_workers))
+        set_runtime_config(**{'autoscale_{}'.format(name): value for name, value in policy.items()})
+
+
+def get_scaling_log(count: int) -> list:
+    """ Retrieves the latest scaling decisions of the autoscaler, latest first """
+
+    result = redis_command('lrange', config.SCALING_LOG_KEY, 0, count - 1)
+    if result is None:
+        raise click.ClickException('Redis is not up')
+
+    return [json.loads(line) for line in result.output.decode().splitlines() if line]
+
 
 @verify_location
 def is_gpu():
@@ -172,10 +437,35 @@ def read_env():
     return env_data
 
 
+@verify_location
+def update_env(**values):
+    """ Updates values in the env file, adding the ones missing from it """
+
+    env_data = read_env()
+    env_data.update(values)
+
+    with open('.env', 'w') as env_file:
+        for key, value in env_data.items():
+            env_file.write('{}={}\n'.format(key, value))
+
+
+def is_worker_loading():
+    """ Checks whether any worker process is loading or warming up its model, according to their heartbeats """
+
+    result = redis_command('hvals', config.WORKERS_KEY)
+    if result is None or result.exit_code != 0:
+        return False
+
+    now = time.time()
+    heartbeats = [json.loads(payload) for payload in result.output.decode().splitlines() if payload]
+    return any(heartbeat['state'] != 'ready' and now - heartbeat['time'] <= config.HEARTBEAT_TTL
+               for heartbeat in heartbeats)
+
+
 @verify_location
 def get_worker_status():
     """ Retrieves worker's status """
-    if os.path.exists('.worker_loading'):
+    if is_worker_loading():
         return {'all': config.Status.LOADING}
 
     try:
@@ -193,8 +483,8 @@ def get_worker_status():
 
 
 @verify_location
-def get_containers_names():
-    """ Retrieves a dictionary mapping service name to its container's name """
+def get_replicas():
+    """ Retrieves a dictionary mapping service name to its containers' names, ordered by replica number """
     project_name = get_project_name()
 
     # Get output of docker-compose ps
@@ -202,8 +492,8 @@ def get_containers_names():
     containers = list(map(lambda x: x.name, client.containers.list(all=True)))
 
     # Find containers' names
-    containers_names = {}
-    container_name_regex = re.compile('^{project_name}_({services})_[0-9]+'.format(
+    replicas = defaultdict(list)
+    container_name_regex = re.compile('^{project_name}_({services})_([0-9]+)'.format(
         project_name=project_name,
         services='|'.join(config.SERVICES)))
 
@@ -212,34 +502,73 @@ def get_containers_names():
         match = re.match(container_name_regex, container)
 
         if match:
-            name = container[match.start():match.end()]
-            descriptor = name.split('_')[-2]
-            containers_names[descriptor] = name
+            replicas[match.group(1)].append((int(match.group(2)), match.group(0)))
+
+    return {service: [name for _, name in sorted(names)] for service, names in replicas.items()}
+
+
+@verify_location
+def get_containers_names():
+    """ Retrieves a dictionary mapping service name to its (first replica's) container's name """
 
-    return containers_names
+    return {service: names[0] for service, names in get_replicas().items()}
 
 
 @verify_location
 def get_containers_status():
-    """ Retrieves a dictionary mapping status to its service name"""
+    """ Retrieves a dictionary mapping status to its service name, replicas named by their number (e.g. denzel_2) """
     # Init status dictionary
     status = defaultdict(list)
 
     client = docker.from_env()
     live_containers = list(map(lambda x: x.name, client.containers.list()))
-    containers = get_containers_names()
 
     # Get status files
     status_files = [f for f in os.listdir('.') if f.startswith('.')]
-    for service_name, service in containers.items():
+    for service, names in get_replicas().items():
+        service_status_file = [f for f in status_files if re.match(r'\.{}'.format(service), f)]
+
+        for replica, name in enumerate(names, start=1):
+            service_name = service if len(names) == 1 else '{}_{}'.format(service, replica)
 
-        if service in live_containers:
-            service_status_file = [f for f in status_files if re.match(r'\.{}'.format(service_name), f)]
-            if service_status_file:  # Status by file
-                status[file_to_status(service_status_file[0])].append(service_name)
+            if name in live_containers:
+                if service_status_file:  # Status by file
+                    status[file_to_status(service_status_file[0])].append(service_name)
+                else:
+                    status[config.Status.UP].append(service_name)
             else:
-                status[config.Status.UP].append(service_name)
-        else:
-            status[config.Status.DOWN].append(service_name)
+                status[config.Status.DOWN].append(service_name)
 
     return status
+
+
+@verify_location
+def get_worker_replicas():
+    """ Retrieves the worker processes of every worker container according to their heartbeats, as a dictionary
+        mapping the container's name to its number of ready and total processes and their tasks per second """
+
+    result = redis_command('hgetall', config.WORKERS_KEY)
+    if result is None or result.exit_code != 0:
+        return {}
+
+    # Processes are named host:pid, where the host is the container's host name
+    client = docker.from_env()
+    worker_containers = get_replicas().get('denzel', [])
+    hosts = {container.attrs['Config']['Hostname']: container.name
+             for container in client.containers.list() if container.name in worker_containers}
+
+    now = time.time()
+    lines = result.output.decode().splitlines()
+    replicas = {name: {'ready': 0, 'processes': 0, 'throughput': 0.} for name in worker_containers}
+    for process, payload in zip(lines[::2], lines[1::2]):
+        heartbeat = json.loads(payload)
+        if now - heartbeat['time'] > config.HEARTBEAT_TTL:  # Gone
+            continue
+
+        host = process.rsplit(':', 1)[0]
+        replica = replicas.setdefault(hosts.get(host, host), {'ready': 0, 'processes': 0, 'throughput': 0.})
+        replica['processes'] += 1
+        replica['ready'] += heartbeat['state'] == 'ready'
+        replica['throughput'] += heartbeat.get('throughput', 0.)
+
+    return replicas
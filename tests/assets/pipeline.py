@@ -1,43 +1,23 @@
 import pickle
-import numpy as np
 
 FEATURES = ['sepal-length', 'sepal-width', 'petal-length', 'petal-width']
 
 # -------- Handled by api container --------
+# Records are validated all at once and passed on as an array of the features, in this order
+INPUT_SCHEMA = {'required': ['callback_uri'],
+                'records': 'data',
+                'features': {feature: 'float64' for feature in FEATURES}}
+
+
 def verify_input(json_data):
     """
     Verifies the validity of an API request content
 
-    :param json_data: Parsed JSON accepted from API call
+    :param json_data: Parsed JSON accepted from API call, validated by INPUT_SCHEMA
     :type json_data: dict
     :return: Data for the the process function
     """
 
-    # callback_uri is needed to sent the responses to
-    if 'callback_uri' not in json_data:
-        raise ValueError('callback_uri not supplied')
-
-    # Verify data was sent
-    if 'data' not in json_data:
-        raise ValueError('no data to predict for!')
-
-    # Verify data structure
-    if not isinstance(json_data['data'], dict):
-        raise ValueError('jsondata["data"] must be a mapping between unique id and features')
-
-    # Verify data scheme
-    for unique_id, features in json_data['data'].items():
-        feature_names = features.keys()
-        feature_values = features.values()
-
-        # Verify all features needed were sent
-        if not all([feature in feature_names for feature in FEATURES]):
-            raise ValueError('For each example all of the features [{}] must be present'.format(FEATURES))
-
-        # Verify all features that were sent are floats
-        if not all([isinstance(value, float) for value in feature_values]):
-            raise ValueError('All feature values must be floats')
-
     return json_data
 
 
@@ -62,15 +42,9 @@ def process(model, json_data):
     :return: Model ready data
     """
 
-    # Gather unique IDs
-    ids = json_data['data'].keys()
-
-    # Gather feature values and make sure they are in the right order
-    data = []
-    for features in json_data['data'].values():
-        data.append([features[FEATURES[0]], features[FEATURES[1]], features[FEATURES[2]], features[FEATURES[3]]])
-
-    data = np.array(data)
+    # Unique IDs and the feature values, ordered as in INPUT_SCHEMA
+    ids = json_data['record_ids']
+    data = json_data['data']
     """
     data = [[float, float, float, float],
             [float, float, float, float]]
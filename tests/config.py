@@ -1,4 +1,8 @@
 from denzel_cli.scripts import cli
 
 PROJECT_COMMANDS = [cli.launch, cli.logs, cli.logworker, cli.restart, cli.shell, cli.shutdown,
-                    cli.start, cli.status, cli.stop, cli.updatereqs]
+                    cli.start, cli.status, cli.stop, cli.updatereqs, cli.batching,
+                    cli.cache, cli.variants, cli.streaming, cli.compression, cli.admission,
+                    cli.lanes, cli.trace, cli.callbacks, cli.pipelining,
+                    cli.scale, cli.models, cli.preload, cli.reload_model,
+                    cli.results, cli.gc]
@@ -141,7 +141,7 @@ def test_cpu_project(tmpdir, datadir):
                     result = runner.invoke(cli.status)
                     assert result.exit_code == 0
 
-                    if str(result.output).count('UP') < 5:
+                    if str(result.output).count('UP') < 6:
                         time.sleep(2)
                     else:
                         break  # All is up
@@ -189,7 +189,7 @@ def test_cpu_project(tmpdir, datadir):
                     result = runner.invoke(cli.status)
                     assert result.exit_code == 0
 
-                    if str(result.output).count('UP') < 5:
+                    if str(result.output).count('UP') < 6:
                         time.sleep(2)
                     else:
                         break  # All is up
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app package of the project template, importable as inside the containers
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src', 'denzel'))
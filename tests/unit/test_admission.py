@@ -0,0 +1,156 @@
+from types import SimpleNamespace
+
+import fakeredis
+import falcon
+import pytest
+
+from app import admission
+from app.admission import AdmissionController
+from app.tasks import COMPLETED_TASKS_KEY
+
+LANES = ['sync', 'async']
+
+
+class Thread(object):
+    """ Never started, the tests take the samples themselves """
+
+    def __init__(self, target=None, name=None, daemon=None):
+        pass
+
+    def start(self):
+        pass
+
+
+class StopSampling(Exception):
+    pass
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def client(server):
+    return fakeredis.FakeRedis(server=server)
+
+
+@pytest.fixture
+def controller(client, monkeypatch):
+    monkeypatch.setattr(admission.threading, 'Thread', Thread)
+    config = {'admission_max_queue': 0, 'admission_shed_sync': 0}
+    return AdmissionController(client, config, lanes=LANES)
+
+
+def _sample(controller, monkeypatch, *steps):
+    """ Runs the sampling loop, calling each of steps between two samples a second apart, then stops it """
+
+    clock = SimpleNamespace(now=0.)
+    steps = list(steps)
+
+    def sleep(seconds):
+        if not steps:
+            raise StopSampling()
+        clock.now += 1.
+        steps.pop(0)()
+
+    monkeypatch.setattr(admission, 'time', SimpleNamespace(monotonic=lambda: clock.now, sleep=sleep))
+    with pytest.raises(StopSampling):
+        controller._sample_forever()
+
+
+def _retry_after(ex) -> int:
+    return int(ex.value.headers['Retry-After'])
+
+
+def test_admits_by_default(controller):
+    controller._depths['sync'] = 1000
+
+    controller.admit(5., 'sync')
+    controller.admit(0., 'async')
+
+    assert controller.stats()['admitted'] == 2
+
+
+def test_rejects_backlog(controller):
+    controller._config['admission_max_queue'] = 10
+    controller._depths.update({'sync': 4, 'async': 5})
+    controller._rates.update({'sync': 1., 'async': 1.})
+    controller.admit(0., 'async')
+
+    controller._depths['async'] = 16
+    with pytest.raises(falcon.HTTPServiceUnavailable) as ex:
+        controller.admit(0., 'async')
+
+    assert _retry_after(ex) == 6  # 11 tasks over the limit at 2 tasks per second
+    assert controller.stats()['rejected_backlog'] == 1
+
+
+def test_backlog_retry_after_without_rate(controller):
+    controller._config['admission_max_queue'] = 1
+    controller._depths['sync'] = 5
+
+    with pytest.raises(falcon.HTTPServiceUnavailable) as ex:
+        controller.admit(0., 'sync')
+
+    assert _retry_after(ex) == 1
+
+
+def test_sheds_sync_requests_which_would_time_out(controller):
+    controller._config['admission_shed_sync'] = 1
+    controller._rates['sync'] = 2.
+    controller._depths['sync'] = 9
+    controller.admit(5., 'sync')  # 10 tasks drained in exactly 5 seconds
+
+    controller._depths['sync'] = 14
+    with pytest.raises(falcon.HTTPTooManyRequests) as ex:
+        controller.admit(5., 'sync')
+
+    assert _retry_after(ex) == 3  # 15 tasks, of which 10 drain within the timeout, at 2 tasks per second
+    assert controller.stats()['rejected_sync'] == 1
+
+
+def test_sheds_only_sync_requests_with_known_rates(controller):
+    controller._config['admission_shed_sync'] = 1
+    controller._depths.update({'sync': 100, 'async': 100})
+    controller._rates['async'] = 1.
+
+    controller.admit(5., 'sync')  # No rate measured yet
+    controller.admit(0., 'async')
+
+    controller._config['admission_shed_sync'] = 0
+    controller._rates['sync'] = 1.
+    controller.admit(5., 'sync')
+
+
+def test_measures_drain_rates_while_busy(controller, client, monkeypatch):
+    def lane(name='sync'):
+        return controller.stats()['lanes'][name]
+
+    def busy():
+        assert lane() == {'queue_depth': 4, 'drain_rate': 0.}
+        client.set(COMPLETED_TASKS_KEY.format('sync'), 3)
+
+    def drained():
+        assert lane()['drain_rate'] == 3.
+        client.delete('sync')
+        client.set(COMPLETED_TASKS_KEY.format('sync'), 4)
+
+    def idle():
+        assert lane() == {'queue_depth': 0, 'drain_rate': 2.}  # Busy when the last second started
+
+    client.lpush('sync', *range(4))
+    _sample(controller, monkeypatch, busy, drained, idle)
+
+    assert lane()['drain_rate'] == 2.  # Idle seconds are not measured
+    assert lane('async') == {'queue_depth': 0, 'drain_rate': 0.}
+
+
+def test_keeps_estimates_while_redis_is_down(controller, client, server, monkeypatch):
+    def down():
+        server.connected = False
+
+    client.lpush('sync', *range(4))
+    _sample(controller, monkeypatch, down)
+
+    assert controller.stats()['queue_depth'] == 4
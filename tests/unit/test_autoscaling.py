@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+
+from app import tasks, autoscaling
+from app.autoscaling import QueueAutoscaler, SCALING_LOG_KEY
+from app.tasks import SENT_HEADER
+
+LANE = 'async'
+
+
+class Pool(object):
+    def __init__(self, processes: int):
+        self.num_processes = processes
+
+    def grow(self, n: int):
+        self.num_processes += n
+
+    def shrink(self, n: int):
+        self.num_processes -= n
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(tasks, '_redis_client', client)
+    return client
+
+
+def _autoscaler(processes=1, max_concurrency=4, min_concurrency=1):
+    queues = SimpleNamespace(consume_from={LANE: None})
+    worker = SimpleNamespace(hostname='worker@test', app=SimpleNamespace(amqp=SimpleNamespace(queues=queues)))
+    autoscaler = QueueAutoscaler(Pool(processes), max_concurrency, min_concurrency, worker=worker)
+    autoscaler._last_change = 0.  # As if idle for long
+    return autoscaler
+
+
+def _enqueue(client, count, waited=0.):
+    for _ in range(count):
+        client.lpush(LANE, json.dumps({'headers': {SENT_HEADER: time.time() - waited}}))
+
+
+def _scale(autoscaler):
+    autoscaler._last_evaluation = 0.  # Evaluated on every call, not once per tick
+    return autoscaler._maybe_scale()
+
+
+def test_scales_up_to_queue_depth(client):
+    autoscaler = _autoscaler()
+    _enqueue(client, 3)
+
+    assert _scale(autoscaler)
+    assert autoscaler.processes == 3
+    assert json.loads(client.lindex(SCALING_LOG_KEY, 0))['direction'] == 'up'
+
+
+def test_scales_up_within_bounds(client):
+    autoscaler = _autoscaler(max_concurrency=2)
+    _enqueue(client, 10)
+
+    assert _scale(autoscaler)
+    assert autoscaler.processes == 2
+    assert not _scale(autoscaler)
+
+
+def test_scales_up_for_waiting_tasks(client):
+    client.set('autoscale_max_depth', 10)
+    autoscaler = _autoscaler()
+    _enqueue(client, 1, waited=5.)
+
+    assert _scale(autoscaler)
+    assert autoscaler.processes == 2
+
+
+def test_scale_up_cooldown(client):
+    client.set('autoscale_max_depth', 1)
+    autoscaler = _autoscaler()
+    _enqueue(client, 2)
+    assert _scale(autoscaler)
+
+    _enqueue(client, 2)
+    assert not _scale(autoscaler)  # Within the default 10 seconds
+
+    client.set('autoscale_up_cooldown', 0)
+    assert _scale(autoscaler)
+    assert autoscaler.processes == 4
+
+
+def test_scales_down_when_idle(client):
+    autoscaler = _autoscaler(processes=3)
+
+    assert _scale(autoscaler)
+    assert autoscaler.processes == 2
+    assert json.loads(client.lindex(SCALING_LOG_KEY, 0))['direction'] == 'down'
+    assert not _scale(autoscaler)  # Within the down cooldown
+
+
+def test_keeps_minimum_and_busy_processes(client):
+    client.set('autoscale_down_cooldown', 0)
+    autoscaler = _autoscaler(processes=1)
+    assert not _scale(autoscaler)
+
+    autoscaler = _autoscaler(processes=2, max_concurrency=2)
+    _enqueue(client, 1)
+    assert not _scale(autoscaler)
+
+
+def test_starts_no_threads(client, monkeypatch):
+    monkeypatch.setattr(tasks, '_runtime_config_pid', None)
+    threads = threading.active_count()
+    _enqueue(client, 2)
+
+    _scale(_autoscaler())
+
+    assert threading.active_count() == threads
+    assert tasks._runtime_config_pid is None
+
+
+def test_settings_ignore_malformed_values(client):
+    client.set('autoscale_max_depth', 'many')
+
+    _, _, settings = _autoscaler()._sample()
+
+    assert settings['autoscale_max_depth'] == 1
+    assert set(settings) == set(autoscaling.SETTINGS)
@@ -0,0 +1,104 @@
+import time
+
+import pytest
+from celery import states
+
+from app import batching
+from app.batching import Batcher, BatchItemError
+from app.lanes import SYNC_LANE, ASYNC_LANE
+from app.tracing import Trace
+
+TIMEOUT = 5.
+
+
+class Task(object):
+    """ Result of a sent batch, predicting every request as its 'value' unless it is 'fail' """
+
+    def __init__(self, json_batch):
+        self.json_batch = json_batch
+
+    def get(self, timeout=None):
+        return [{'status': states.FAILURE, 'result': 'failed'} if json_data['value'] == 'fail' else
+                {'status': states.SUCCESS, 'result': json_data['value']} for json_data in self.json_batch]
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    sent = []
+
+    def enqueue(task, args, kwargs, lane, traces=(), ignore_result=False):
+        sent.append({'json_batch': args[0], 'task_ids': args[1], 'sync': kwargs['sync'], 'lane': lane,
+                     'ignore_result': ignore_result})
+        return Task(args[0])
+
+    monkeypatch.setattr(batching, 'enqueue', enqueue)
+    return sent
+
+
+def _batcher(max_size, max_wait):
+    return Batcher({'batch_max_size': max_size, 'batch_max_wait': max_wait, 'store_async_results': 1})
+
+
+def _submit(batcher, value, sync_timeout=0.):
+    return batcher.submit({'value': value}, sync_timeout, Trace(value))
+
+
+def test_enabled():
+    assert not _batcher(1, 1.).enabled
+    assert _batcher(2, 1.).enabled
+
+
+def test_flushes_when_full(sent):
+    batcher = _batcher(2, 60.)
+
+    futures = [_submit(batcher, 'a'), _submit(batcher, 'b')]
+
+    assert [future.result(TIMEOUT) for future in futures] == ['a', 'b']  # Async requests resolve to their task IDs
+    assert sent == [{'json_batch': [{'value': 'a'}, {'value': 'b'}], 'task_ids': ['a', 'b'], 'sync': False,
+                     'lane': ASYNC_LANE, 'ignore_result': True}]
+
+
+def test_flushes_after_max_wait(sent):
+    batcher = _batcher(10, .05)
+
+    start_time = time.monotonic()
+    assert _submit(batcher, 'a').result(TIMEOUT) == 'a'
+
+    assert time.monotonic() - start_time >= .05
+    assert len(sent) == 1 and sent[0]['task_ids'] == ['a']
+    assert batcher.stats() == {'batches': 1, 'items': 1, 'last_fill_ratio': .1, 'mean_fill_ratio': .1}
+
+
+def test_sync_results_and_failures(sent):
+    batcher = _batcher(3, 60.)
+
+    futures = [_submit(batcher, 'a', TIMEOUT), _submit(batcher, 'fail', TIMEOUT), _submit(batcher, 'b', TIMEOUT)]
+
+    assert futures[0].result(TIMEOUT) == 'a'
+    assert futures[2].result(TIMEOUT) == 'b'
+    with pytest.raises(BatchItemError):
+        futures[1].result(TIMEOUT)
+    assert sent[0]['lane'] == SYNC_LANE and sent[0]['sync'] and not sent[0]['ignore_result']
+
+
+def test_sends_sync_and_async_requests_apart(sent):
+    batcher = _batcher(2, 60.)
+
+    futures = [_submit(batcher, 'a', TIMEOUT), _submit(batcher, 'b')]
+
+    assert [future.result(TIMEOUT) for future in futures] == ['a', 'b']
+    assert sorted((batch['lane'], batch['task_ids']) for batch in sent) == [(ASYNC_LANE, ['b']), (SYNC_LANE, ['a'])]
+
+
+def test_failing_sends_fail_the_requests(monkeypatch):
+    def enqueue(*args, **kwargs):
+        raise ConnectionError('broker down')
+
+    monkeypatch.setattr(batching, 'enqueue', enqueue)
+    batcher = _batcher(2, 60.)
+
+    futures = [_submit(batcher, 'a'), _submit(batcher, 'b')]
+
+    for future in futures:
+        with pytest.raises(ConnectionError):
+            future.result(TIMEOUT)
@@ -0,0 +1,179 @@
+import asyncio
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from app.cache import PredictionCache
+
+TIMEOUT = 5.
+
+
+def _cache(**config):
+    settings = {'cache_ttl': 60., 'cache_max_memory': 1024 ** 2, 'model_version': 'v1'}
+    settings.update(config)
+    return PredictionCache(settings)
+
+
+def _wait_coalesced(cache):
+    deadline = time.monotonic() + TIMEOUT
+    while not cache.stats()['coalesced'] and time.monotonic() < deadline:
+        time.sleep(.001)
+
+
+def test_enabled():
+    assert _cache().enabled
+    assert not _cache(cache_ttl=0.).enabled
+
+
+def test_keys():
+    cache = _cache()
+    key = cache.key({'a': 1, 'b': [1, 2]}, True, 'application/json')
+
+    assert cache.key({'b': [1, 2], 'a': 1}, True, 'application/json') == key  # Field order does not matter
+    assert cache.key({'a': 1, 'b': [1, 3]}, True, 'application/json') != key
+    assert cache.key({'a': 1, 'b': [1, 2]}, False, 'application/json') != key
+    assert cache.key({'a': 1, 'b': [1, 2]}, True, 'application/msgpack') != key
+    assert cache.key({'a': 1, 'b': [1, 2]}, True, 'application/json', model='fraud') != key
+    assert _cache(model_version='v2').key({'a': 1, 'b': [1, 2]}, True, 'application/json') != key
+
+
+def test_array_keys():
+    cache = _cache()
+
+    assert cache.key({'data': np.arange(3)}, True, 'json') == cache.key({'data': np.arange(3)}, True, 'json')
+    assert cache.key({'data': np.arange(3)}, True, 'json') != cache.key({'data': np.arange(1, 4)}, True, 'json')
+
+
+def test_idempotency_keys_replace_the_content():
+    cache = _cache()
+
+    assert cache.key({'a': 1}, True, 'json', idempotency_key='k') == cache.key({'a': 2}, True, 'json',
+                                                                               idempotency_key='k')
+    assert cache.key({'a': 1}, True, 'json', idempotency_key='k') != cache.key({'a': 1}, True, 'json')
+
+
+def test_hits():
+    cache = _cache()
+    computed = []
+
+    def compute():
+        computed.append(1)
+        return b'body'
+
+    assert cache.get_or_compute('key', compute) == b'body'
+    assert cache.get_or_compute('key', compute) == b'body'
+    assert len(computed) == 1
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'coalesced': 0, 'evictions': 0, 'entries': 1, 'memory': 7}
+
+
+def test_expiry():
+    cache = _cache(cache_ttl=-1.)  # Expired on arrival
+
+    cache.get_or_compute('key', lambda: b'first')
+
+    assert cache.get_or_compute('key', lambda: b'second') == b'second'
+
+
+def test_evicts_least_recently_used():
+    cache = _cache(cache_max_memory=20)  # Two entries of 10 bytes
+    for key in ('key1', 'key2'):
+        cache.get_or_compute(key, lambda: b'body01')
+    cache.get_or_compute('key1', lambda: b'other1')  # Used, so key2 is evicted next
+
+    cache.get_or_compute('key3', lambda: b'body01')
+
+    assert cache.get_or_compute('key1', lambda: b'other1') == b'body01'
+    assert cache.get_or_compute('key2', lambda: b'other2') == b'other2'
+    assert cache.stats()['evictions'] == 2
+
+
+def test_failures_are_not_cached():
+    cache = _cache()
+
+    def fail():
+        raise ValueError('bad request')
+
+    with pytest.raises(ValueError):
+        cache.get_or_compute('key', fail)
+
+    assert cache.get_or_compute('key', lambda: b'body') == b'body'
+
+
+def test_coalesces_identical_requests():
+    cache = _cache()
+    started, release = threading.Event(), threading.Event()
+
+    def compute():
+        started.set()
+        release.wait(TIMEOUT)
+        return b'body'
+
+    leader = threading.Thread(target=cache.get_or_compute, args=('key', compute))
+    leader.start()
+    started.wait(TIMEOUT)
+
+    follower_bodies = []
+    follower = threading.Thread(target=lambda: follower_bodies.append(
+        cache.get_or_compute('key', lambda: b'computed again', timeout=TIMEOUT)))
+    follower.start()
+    _wait_coalesced(cache)
+    release.set()
+    leader.join(TIMEOUT)
+    follower.join(TIMEOUT)
+
+    assert follower_bodies == [b'body']
+    assert cache.stats()['misses'] == 1
+
+
+def test_followers_get_the_leaders_failure():
+    cache = _cache()
+    started, release = threading.Event(), threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(TIMEOUT)
+        raise ValueError('bad request')
+
+    leader = threading.Thread(target=lambda: pytest.raises(ValueError, cache.get_or_compute, 'key', fail))
+    leader.start()
+    started.wait(TIMEOUT)
+
+    errors = []
+
+    def follow():
+        try:
+            cache.get_or_compute('key', lambda: b'computed again', timeout=TIMEOUT)
+        except ValueError as ex:
+            errors.append(ex)
+
+    follower = threading.Thread(target=follow)
+    follower.start()
+    _wait_coalesced(cache)
+    release.set()
+    leader.join(TIMEOUT)
+    follower.join(TIMEOUT)
+
+    assert len(errors) == 1
+
+
+def test_coalesces_async_requests():
+    cache = _cache()
+    computed = []
+
+    async def compute():
+        computed.append(1)
+        await asyncio.sleep(.01)
+        return b'body'
+
+    async def requests():
+        return await asyncio.gather(*[cache.get_or_compute_async('key', compute, timeout=TIMEOUT) for _ in range(3)])
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(requests()) == [b'body'] * 3
+    finally:
+        loop.close()
+    assert len(computed) == 1
+    assert cache.stats()['coalesced'] == 2
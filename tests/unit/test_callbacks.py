@@ -0,0 +1,200 @@
+import json
+import time
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+import requests
+
+from app import callbacks
+from app.callbacks import CallbackDispatcher, queue_callback, CALLBACK_QUEUE, RETRY_SET, DEAD_LETTERS
+from app.codecs import pack, unpack
+from app.metrics import Metrics
+
+URI = 'http://callback'
+
+
+class Session(object):
+    """ Records the callbacks sent, responding with the given statuses in turn, or raising them if exceptions """
+
+    def __init__(self, *statuses):
+        self.sent = []
+        self._statuses = list(statuses)
+
+    def post(self, uri, data=None, headers=None, timeout=None):
+        self.sent.append({'uri': uri, 'body': data, 'headers': headers})
+        status = self._statuses.pop(0) if self._statuses else 200
+        if isinstance(status, Exception):
+            raise status
+
+        return SimpleNamespace(status_code=status)
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis()
+
+
+def _dispatcher(client, session, **config):
+    settings = {'callback_batch_size': 1, 'callback_max_attempts': 3, 'callback_compression': '',
+                'compression_min_size': 1024}
+    settings.update(config)
+    dispatcher = CallbackDispatcher(client, settings, Metrics(), concurrency=1)
+    dispatcher._session = session
+    return dispatcher
+
+
+def _deliver(dispatcher, uri=URI, batch_size=1):
+    """ Delivers the queued callbacks once, as the dispatcher's loop does """
+
+    dispatcher._release_due(keys=[RETRY_SET, CALLBACK_QUEUE], args=[time.time(), callbacks.PULL_SIZE])
+    for callback_uri, group in dispatcher._group(dispatcher._pull(), batch_size):
+        dispatcher._slots.acquire()
+        dispatcher._deliver(callback_uri, group, batch_size > 1)
+
+
+def _retries(client) -> list:
+    return [unpack(item) for item in client.zrange(RETRY_SET, 0, -1)]
+
+
+def test_delivers_results(client):
+    session = Session()
+    queue_callback(client, URI, {'prediction': 1}, 'task1', 'v1')
+    queue_callback(client, URI, {'prediction': 2}, 'task2')
+
+    _deliver(_dispatcher(client, session))
+
+    assert [json.loads(sent['body']) for sent in session.sent] == [{'prediction': 1}, {'prediction': 2}]  # Oldest first
+    assert session.sent[0]['headers']['X-Model-Version'] == 'v1'
+    assert 'X-Model-Version' not in session.sent[1]['headers']
+    assert not client.llen(CALLBACK_QUEUE)
+    assert not client.llen(_dispatcher(client, session)._processing)
+
+
+def test_batches_by_uri_and_model_version(client):
+    session = Session()
+    for prediction, uri, version in [(1, URI, 'v1'), (2, 'http://other', 'v1'), (3, URI, 'v1'), (4, URI, 'v2'),
+                                     (5, URI, 'v1')]:
+        queue_callback(client, uri, prediction, 'task{}'.format(prediction), version)
+
+    _deliver(_dispatcher(client, session), batch_size=2)
+
+    assert sorted((sent['uri'], sent['body']) for sent in session.sent) == \
+        [(URI, b'[1,3]'), (URI, b'[4]'), (URI, b'[5]'), ('http://other', b'[2]')]
+
+
+def test_compresses_large_bodies(client):
+    session = Session()
+    queue_callback(client, URI, 'x' * 100, 'task')
+
+    _deliver(_dispatcher(client, session, callback_compression='gzip', compression_min_size=10))
+
+    assert session.sent[0]['headers']['Content-Encoding'] == 'gzip'
+
+
+@pytest.mark.parametrize('failure', [500, 429, requests.ConnectionError('refused')])
+def test_retries_with_backoff(client, failure):
+    queue_callback(client, URI, 1, 'task')
+
+    before = time.time()
+    _deliver(_dispatcher(client, Session(failure)))
+
+    retries = client.zrange(RETRY_SET, 0, -1, withscores=True)
+    assert len(retries) == 1
+    assert before + callbacks.BACKOFF_BASE * .5 <= retries[0][1] <= time.time() + callbacks.BACKOFF_BASE
+    assert unpack(retries[0][0])['attempt'] == 1
+
+
+def test_redelivers_due_retries(client):
+    session = Session(500)
+    dispatcher = _dispatcher(client, session)
+    queue_callback(client, URI, 1, 'task')
+    _deliver(dispatcher)
+
+    _deliver(dispatcher)  # Not due yet
+    assert len(session.sent) == 1
+
+    client.zadd(RETRY_SET, {client.zrange(RETRY_SET, 0, 0)[0]: 0})
+    _deliver(dispatcher)
+    assert len(session.sent) == 2
+    assert not client.zcard(RETRY_SET)
+
+
+def test_dead_letters_after_max_attempts(client):
+    queue_callback(client, URI, 1, 'task')
+    dispatcher = _dispatcher(client, Session(500, 500, 500))
+
+    for _ in range(3):
+        _deliver(dispatcher)
+        for item in client.zrange(RETRY_SET, 0, -1):  # Due right away
+            client.zadd(RETRY_SET, {item: 0})
+
+    dead = [unpack(item) for item in client.lrange(DEAD_LETTERS, 0, -1)]
+    assert len(dead) == 1
+    assert dead[0]['task_id'] == 'task' and dead[0]['attempt'] == 0  # Starts over if requeued
+    assert dead[0]['error'] == 'Callback responded with status 500'
+    assert not _retries(client)
+
+
+def test_client_errors_are_dead_letters_right_away(client):
+    queue_callback(client, URI, 1, 'task')
+
+    _deliver(_dispatcher(client, Session(404)))
+
+    assert client.llen(DEAD_LETTERS) == 1
+    assert not _retries(client)
+
+
+def test_keeps_pulled_callbacks_until_handled(client):
+    dispatcher = _dispatcher(client, Session())
+    for task in range(3):
+        queue_callback(client, URI, task, 'task{}'.format(task))
+
+    pulled = dispatcher._pull()
+    assert [item['task_id'] for _, item in pulled] == ['task0', 'task1', 'task2']
+    assert client.llen(dispatcher._processing) == 3 and not client.llen(CALLBACK_QUEUE)
+
+    dispatcher._slots.acquire()
+    dispatcher._deliver(URI, pulled[:1], False)
+    assert client.llen(dispatcher._processing) == 2
+
+
+def test_requeues_callbacks_left_by_previous_dispatcher(client):
+    session = Session()
+    queue_callback(client, URI, 1, 'task1')
+    _dispatcher(client, session)._pull()  # Exits before delivering
+    queue_callback(client, URI, 2, 'task2')
+
+    dispatcher = _dispatcher(client, session)
+    assert dispatcher._requeue_processing(keys=[dispatcher._processing, CALLBACK_QUEUE]) == 1
+    _deliver(dispatcher)
+
+    assert [json.loads(sent['body']) for sent in session.sent] == [1, 2]  # Oldest first
+
+
+def test_keeps_callbacks_when_redis_fails(client, monkeypatch):
+    dispatcher = _dispatcher(client, Session(500))
+    queue_callback(client, URI, 1, 'task')
+    pulled = dispatcher._pull()
+
+    def zadd(*args, **kwargs):
+        raise callbacks.redis.ConnectionError()
+
+    monkeypatch.setattr(client, 'zadd', zadd)
+    dispatcher._slots.acquire()
+    dispatcher._deliver(URI, pulled, False)
+
+    assert client.llen(dispatcher._processing) == 1
+
+
+def test_malformed_callbacks_are_dead_letters(client):
+    session = Session()
+    client.lpush(CALLBACK_QUEUE, b'\xc1', pack({'uri': URI}))
+    queue_callback(client, URI, 1, 'task')
+
+    dispatcher = _dispatcher(client, session)
+    _deliver(dispatcher)
+
+    assert len(session.sent) == 1
+    assert [unpack(item)['payload'] for item in client.lrange(DEAD_LETTERS, 0, -1)] == [pack({'uri': URI}), b'\xc1']
+    assert not client.llen(dispatcher._processing)
@@ -0,0 +1,104 @@
+import io
+import json
+
+import numpy as np
+import pytest
+from kombu import serialization
+
+from app import codecs
+from app.codecs import pack, unpack, decode_body, encode_body, canonical_dumps, CELERY_SERIALIZER, JSON, MSGPACK, NPY
+
+ARRAYS = [np.arange(12, dtype='<f4').reshape(3, 4),
+          np.array(7, dtype='<i8'),  # 0-d
+          np.array(1.5),
+          np.empty((0, 3), dtype='<f8'),
+          np.arange(6, dtype='>i2').reshape(2, 3),
+          np.asfortranarray(np.arange(6, dtype='<u1').reshape(2, 3)),
+          np.arange(10, dtype='<f8')[::2]]  # Not contiguous
+
+
+@pytest.mark.parametrize('array', ARRAYS)
+def test_msgpack_round_trip(array):
+    restored = unpack(pack({'data': array}))['data']
+
+    assert restored.dtype == array.dtype
+    assert restored.shape == array.shape
+    assert np.array_equal(restored, array)
+
+
+def test_msgpack_arrays_are_writable():
+    restored = unpack(pack(np.arange(3)))
+    restored[0] = 10
+
+    assert restored.flags.writeable
+    assert restored.tolist() == [10, 1, 2]
+
+
+def test_msgpack_numpy_scalars_and_objects():
+    assert unpack(pack({'a': np.int64(3), 'b': np.float32(.5)})) == {'a': 3, 'b': .5}
+    assert unpack(pack(np.array(['x', None], dtype=object))) == ['x', None]
+
+
+def test_msgpack_non_str_keys():
+    assert unpack(pack({1: 'a', np.int64(2): 'b', 'c': {3: [np.int32(4)]}})) == {1: 'a', 2: 'b', 'c': {3: [4]}}
+
+
+def test_celery_serializer_round_trip():
+    array = np.arange(4, dtype='<f8').reshape(2, 2)
+    content_type, content_encoding, payload = serialization.dumps(([{'data': array}, True], {}, {}),
+                                                                  serializer=CELERY_SERIALIZER)
+    args, kwargs, _ = serialization.loads(payload, content_type, content_encoding)
+
+    assert np.array_equal(args[0]['data'], array) and args[1] is True
+
+
+def test_compressed_celery_payloads(monkeypatch):
+    monkeypatch.setattr(codecs, '_celery_config', {'payload_compression': 'gzip', 'compression_min_size': 0})
+    array = np.zeros((100, 100))
+
+    payload = codecs._celery_pack({'data': array})
+
+    assert len(payload) < array.nbytes
+    assert np.array_equal(codecs._celery_unpack(payload)['data'], array)
+
+
+def test_npy_bodies():
+    array = np.arange(6, dtype='<i4').reshape(2, 3)
+    for body_array in (array, np.asfortranarray(array)):
+        stream = io.BytesIO()
+        np.save(stream, body_array)
+
+        json_data = decode_body(stream.getvalue(), NPY, {'callback_uri': 'http://callback'})
+
+        assert json_data['callback_uri'] == 'http://callback'
+        assert np.array_equal(json_data['data'], array)
+        assert json_data['data'].flags.writeable
+
+
+def test_npy_rejects_objects():
+    stream = io.BytesIO()
+    np.save(stream, np.array(['x', None], dtype=object), allow_pickle=True)
+
+    with pytest.raises(codecs.UnsupportedMediaType):
+        decode_body(stream.getvalue(), NPY, {})
+
+
+def test_json_and_msgpack_bodies():
+    obj = {'data': {'a': [1, 2]}, 'callback_uri': 'http://callback'}
+
+    assert decode_body(encode_body(obj, JSON), 'application/json; charset=utf-8', {}) == obj
+    assert decode_body(encode_body(obj, MSGPACK), 'application/x-msgpack', {}) == obj
+
+    with pytest.raises(codecs.UnsupportedMediaType):
+        decode_body(b'', 'text/csv', {})
+
+
+def test_json_numpy_values():
+    assert json.loads(encode_body({'a': np.arange(3), 'b': np.float32(.5), np.int64(1): 'c'}, JSON)) == \
+        {'a': [0, 1, 2], 'b': .5, '1': 'c'}
+
+
+def test_canonical_dumps():
+    assert canonical_dumps({'b': 1, 'a': np.arange(3)}) == canonical_dumps({'a': np.arange(3), 'b': 1})
+    assert canonical_dumps({'a': np.arange(3)}) != canonical_dumps({'a': np.arange(3).reshape(3, 1)})
+    assert canonical_dumps({'a': np.arange(3)}) != canonical_dumps({'a': np.arange(1, 4)})
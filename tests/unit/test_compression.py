@@ -0,0 +1,143 @@
+import asyncio
+import gzip
+import zlib
+
+import falcon
+import pytest
+from falcon import testing
+
+from app.compression import DecompressingRequest, CompressionMiddleware, CompressionStats, negotiate_encoding, \
+    compress, decompress, supported_encodings, GZIP, _AsyncDecompressingStream
+
+
+class EchoResource(object):
+
+    def on_post(self, req, resp):
+        resp.data = b''.join(iter(req.stream.readline, b''))
+
+    def on_put(self, req, resp):
+        resp.data = req.stream.read()
+
+    def on_get(self, req, resp):
+        resp.stream = iter([b'{"index": 0}\n', b'{"index": 1}\n'])
+
+
+@pytest.fixture
+def stats():
+    return CompressionStats()
+
+
+@pytest.fixture
+def client(stats):
+    app = falcon.App(request_type=DecompressingRequest,
+                     middleware=[CompressionMiddleware({'compression_min_size': 16, 'max_decompressed_size': 32},
+                                                       stats)])
+    app.add_route('/', EchoResource())
+    return testing.TestClient(app)
+
+
+@pytest.mark.parametrize('encoding', supported_encodings())
+def test_round_trip(encoding):
+    data = b'denzel' * 100
+    assert decompress(compress(data, encoding), encoding) == data
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding(None) is None
+    assert negotiate_encoding('br') is None
+    assert negotiate_encoding('gzip') == GZIP
+    assert negotiate_encoding('gzip;q=0') is None
+    assert negotiate_encoding('*') == supported_encodings()[0]
+
+
+def test_decompressed_request(client, stats):
+    response = client.simulate_post('/', body=gzip.compress(b'line 1\nline 2\n'), headers={'Content-Encoding': 'gzip'})
+
+    assert response.content == b'line 1\nline 2\n'
+    assert stats.stats()['decompressed_requests'] == 1
+    assert stats.stats()['decompression_seconds'] > 0
+
+
+def test_limits_decompressed_size(client):
+    def put(body):
+        return client.simulate_put('/', body=gzip.compress(body), headers={'Content-Encoding': 'gzip'})
+
+    assert put(b'a' * 32).content == b'a' * 32
+    assert put(b'a' * 33).status_code == 413
+
+
+def test_limits_decompressed_lines(client):
+    def post(body):
+        return client.simulate_post('/', body=gzip.compress(body), headers={'Content-Encoding': 'gzip'})
+
+    assert post(b'a' * 32 + b'\n' + b'b' * 32 + b'\n').status_code == 200
+    assert post(b'a' * 32 + b'\n' + b'b' * 33).status_code == 413
+
+
+def _read_async(body: bytes, limit: int, lines: bool):
+    async def chunks():
+        for start in range(0, len(body), 7):
+            yield body[start:start + 7]
+
+    async def read():
+        stream = _AsyncDecompressingStream(chunks(), GZIP)
+        stream.limit = limit
+        return b''.join([data async for data in stream]) if lines else await stream.read()
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(read())
+    finally:
+        loop.close()
+
+
+def test_limits_async_decompressed_size():
+    body = gzip.compress(b'a' * 20 + b'\n' + b'b' * 20 + b'\n')
+
+    assert _read_async(body, 42, lines=False) == gzip.decompress(body)
+    with pytest.raises(falcon.HTTPError):
+        _read_async(body, 41, lines=False)
+
+    assert _read_async(body, 20, lines=True) == gzip.decompress(body)
+    with pytest.raises(falcon.HTTPError):
+        _read_async(gzip.compress(b'a' * 20 + b'\n' + b'b' * 21), 20, lines=True)
+
+
+def test_unsupported_request_encoding(client):
+    assert client.simulate_post('/', body=b'data', headers={'Content-Encoding': 'br'}).status_code == 415
+
+
+def test_compressed_response(client, stats):
+    body = b'a' * 100
+    response = client.simulate_post('/', body=body, headers={'Accept-Encoding': 'gzip'})
+
+    assert response.headers['Content-Encoding'] == GZIP
+    assert gzip.decompress(response.content) == body
+    assert stats.stats()['compressed_responses'] == 1
+
+
+def test_small_response_uncompressed(client):
+    response = client.simulate_post('/', body=b'short', headers={'Accept-Encoding': 'gzip'})
+
+    assert 'Content-Encoding' not in response.headers
+    assert response.content == b'short'
+
+
+def test_stream_flushed_per_chunk(stats):
+    middleware = CompressionMiddleware({'compression_min_size': 16, 'max_decompressed_size': 0}, stats)
+    chunks = middleware._compress_stream(iter([b'{"index": 0}\n', b'{"index": 1}\n']), GZIP)
+
+    # Every chunk decompresses fully as soon as it is sent, without waiting for the end of the stream
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert decompressor.decompress(next(chunks)) == b'{"index": 0}\n'
+    assert decompressor.decompress(next(chunks)) == b'{"index": 1}\n'
+    decompressor.decompress(b''.join(chunks))
+    assert decompressor.eof
+
+
+def test_records_streamed_compression(client, stats):
+    response = client.simulate_get('/', headers={'Accept-Encoding': 'gzip'})
+
+    assert gzip.decompress(response.content) == b'{"index": 0}\n{"index": 1}\n'
+    assert stats.stats()['compressed_responses'] == 1
+    assert stats.stats()['bytes_in'] == 26 and stats.stats()['bytes_out'] == len(response.content)
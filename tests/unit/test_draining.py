@@ -0,0 +1,160 @@
+import base64
+import json
+import time
+
+import fakeredis
+import pytest
+from kombu import serialization
+
+from app import tasks
+from app.health import heartbeat, WORKERS_KEY, READY
+
+LANE = 'sync'
+
+
+def _message(task_id, task=None, json_data=None):
+    content_type, content_encoding, body = serialization.dumps(([json_data or {'data': task_id}, True], {}, {}),
+                                                               serializer='json')
+    return json.dumps({'body': base64.b64encode(body.encode()).decode(), 'content-type': content_type,
+                       'content-encoding': content_encoding, 'properties': {'body_encoding': 'base64'},
+                       'headers': {'task': task or tasks.invoke_predict.name, 'id': task_id}})
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(tasks, '_redis_client', client)
+    return client
+
+
+class Backend(object):
+    """ Records the task results marked """
+
+    def __init__(self, fail=False):
+        self.done = []
+        self.failed = []
+        self._fail = fail
+
+    def mark_as_failure(self, task_id, ex):
+        if self._fail:
+            raise ConnectionError('redis is down')
+        self.failed.append((task_id, ex))
+
+
+def _enqueue(client, *task_ids):
+    for task_id in task_ids:  # As the broker does, the oldest message ends up at the tail
+        client.lpush(LANE, _message(task_id))
+
+
+def test_drains_oldest_first(client):
+    _enqueue(client, 'a', 'b', 'c')
+
+    drained = tasks._drain(LANE, 2)
+
+    assert [request.task_id for request in drained] == ['a', 'b']
+    assert drained[0].json_data == {'data': 'a'} and drained[0].sync
+    assert [json.loads(message)['headers']['id'] for message in client.lrange(LANE, 0, -1)] == ['c']
+
+
+def test_keeps_drained_until_released(client):
+    _enqueue(client, 'a', 'b', 'c')
+
+    drained = tasks._drain(LANE, 2)
+    assert client.llen(tasks._draining_key(LANE)) == 2
+    assert client.hexists(tasks.DRAINING_KEY, tasks._draining_key(LANE))
+
+    later = tasks._drain(LANE, 1)  # e.g. by another task of the process
+    tasks._release(LANE, drained)
+    assert [json.loads(message)['headers']['id'] for message in client.lrange(tasks._draining_key(LANE), 0, -1)] \
+        == ['c']
+
+    tasks._release(LANE, later)
+    assert not client.exists(tasks._draining_key(LANE))
+
+
+def test_puts_other_tasks_back(client):
+    client.lpush(LANE, _message('other', task='app.tasks.invoke_predict_batch'))
+    _enqueue(client, 'a')
+
+    drained = tasks._drain(LANE, 2)
+
+    assert [request.task_id for request in drained] == ['a']
+    assert [json.loads(message)['headers']['id'] for message in client.lrange(LANE, 0, -1)] == ['other']
+    assert client.llen(tasks._draining_key(LANE)) == 1
+
+
+def test_drains_nothing_from_empty_lane(client):
+    _enqueue(client, 'a')
+    tasks._drain(LANE, 1)
+
+    assert tasks._drain(LANE, 3) == []
+    assert tasks._drain('unknown', 3) == []
+    assert client.llen(tasks._draining_key(LANE)) == 1  # Drained earlier, not completed yet
+
+
+def test_puts_malformed_messages_back(client):
+    client.lpush(LANE, json.dumps({'body': 'e30=', 'content-type': 'application/unknown', 'content-encoding': 'utf-8',
+                                   'properties': {'body_encoding': 'base64'},
+                                   'headers': {'task': tasks.invoke_predict.name, 'id': 'bad'}}))
+
+    assert tasks._drain(LANE, 1) == []
+    assert client.llen(LANE) == 1
+    assert not client.llen(tasks._draining_key(LANE))
+
+
+def test_completes_drained_requests_despite_failures(client, monkeypatch):
+    def complete(request, backend, result, error):
+        if request.task_id == 'a':
+            raise ConnectionError('callback queue is down')
+        backend.done.append(request.task_id)
+
+    monkeypatch.setattr(tasks.DrainedRequest, 'complete', complete)
+    backend = Backend()
+    _enqueue(client, 'a', 'b')
+
+    tasks._complete_drained(backend, LANE, tasks._drain(LANE, 2), [(1, None), (2, None)])
+
+    assert backend.done == ['b']
+    assert [(task_id, str(ex)) for task_id, ex in backend.failed] == [('a', 'callback queue is down')]
+    assert not client.llen(tasks._draining_key(LANE))
+
+
+def test_keeps_requests_which_could_not_be_marked_failed(client, monkeypatch):
+    def complete(request, backend, result, error):
+        raise ConnectionError('redis is down')
+
+    monkeypatch.setattr(tasks.DrainedRequest, 'complete', complete)
+    _enqueue(client, 'a')
+
+    tasks._complete_drained(Backend(fail=True), LANE, tasks._drain(LANE, 1), [(1, None)])
+
+    assert client.llen(tasks._draining_key(LANE)) == 1  # Requeued once the process is gone
+
+
+def test_requeues_tasks_of_gone_processes(client):
+    _enqueue(client, 'a', 'b', 'c')
+    tasks._drain(LANE, 2)
+    draining_key = tasks._draining_key(LANE)
+    gone_key = tasks.DRAINING_LIST_KEY.format(LANE, 'gone:1')
+    client.rename(draining_key, gone_key)
+    client.hdel(tasks.DRAINING_KEY, draining_key)
+    client.hset(tasks.DRAINING_KEY, gone_key, time.time() - 60)
+
+    tasks._requeue_drained()
+
+    assert [json.loads(message)['headers']['id'] for message in client.lrange(LANE, 0, -1)] == ['c', 'b', 'a']
+    assert not client.exists(gone_key)
+    assert not client.hlen(tasks.DRAINING_KEY)
+    assert [request.task_id for request in tasks._drain(LANE, 1)] == ['a']
+
+
+def test_leaves_tasks_of_live_processes(client):
+    _enqueue(client, 'a')
+    tasks._drain(LANE, 1)
+    client.hset(tasks.DRAINING_KEY, tasks._draining_key(LANE), time.time() - 60)
+    client.hset(WORKERS_KEY, tasks._process_name(), heartbeat(READY))
+
+    tasks._requeue_drained()
+
+    assert client.llen(tasks._draining_key(LANE)) == 1
+    assert not client.llen(LANE)
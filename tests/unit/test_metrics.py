@@ -0,0 +1,86 @@
+import json
+import time
+
+from app.health import FORGET_AGE
+from app.metrics import Metrics, worker_snapshots, merge, exposition, STALE_GAUGE_AGE, BUCKETS
+
+
+def _payload(age=0., **counters):
+    metrics = Metrics()
+    for name, value in counters.items():
+        metrics.inc(name, value)
+    snapshot = metrics.snapshot()
+    snapshot['time'] = time.time() - age
+    return json.dumps(snapshot).encode()
+
+
+def _snapshot(metrics, age=0.) -> dict:
+    snapshot = metrics.snapshot()
+    snapshot['time'] = time.time() - age
+    return snapshot
+
+
+def test_merges_processes():
+    first, second = Metrics(), Metrics()
+    first.inc('denzel_tasks_total', lane='sync')
+    second.inc('denzel_tasks_total', 2, lane='sync')
+    second.inc('denzel_tasks_total', lane='bulk')
+    first.set('denzel_worker_in_flight', 1)
+    second.set('denzel_worker_in_flight', 2)
+    first.observe('denzel_predict_seconds', .003)
+    second.observe('denzel_predict_seconds', 100.)
+
+    merged = merge([_snapshot(first), _snapshot(second)])
+
+    assert merged['counters']['denzel_tasks_total'] == {'{lane="sync"}': 3., '{lane="bulk"}': 1.}
+    assert merged['gauges']['denzel_worker_in_flight'] == {'': 3.}
+    histogram = merged['histograms']['denzel_predict_seconds']['']
+    assert histogram[BUCKETS.index(.005)] == 1 and histogram[len(BUCKETS)] == 1  # In the +Inf bucket
+    assert histogram[-1] == 100.003
+
+
+def test_drops_stale_gauges_only():
+    metrics = Metrics()
+    metrics.inc('denzel_tasks_total', lane='sync')
+    metrics.set('denzel_worker_in_flight', 1)
+
+    merged = merge([_snapshot(metrics, STALE_GAUGE_AGE + 1)])
+
+    assert merged['counters']['denzel_tasks_total'] == {'{lane="sync"}': 1.}
+    assert not merged['gauges']
+
+
+def test_exposition():
+    local, worker = Metrics(), Metrics()
+    local.inc('denzel_api_requests_total', route='/predict', status='200')
+    worker.observe('denzel_predict_seconds', .02)
+    worker.observe('denzel_predict_seconds', .3)
+    worker.inc('unknown_total')  # Not in METRICS, not exported
+
+    lines = exposition(_snapshot(local), [_snapshot(worker)]).splitlines()
+
+    assert '# TYPE denzel_api_requests_total counter' in lines
+    assert 'denzel_api_requests_total{route="/predict",status="200"} 1.0' in lines
+    assert '# TYPE denzel_predict_seconds histogram' in lines
+    assert 'denzel_predict_seconds_bucket{le="0.01"} 0' in lines
+    assert 'denzel_predict_seconds_bucket{le="0.025"} 1' in lines  # Cumulative
+    assert 'denzel_predict_seconds_bucket{le="0.5"} 2' in lines
+    assert 'denzel_predict_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'denzel_predict_seconds_count 2' in lines
+    assert any(line.startswith('denzel_predict_seconds_sum 0.32') for line in lines)
+    assert not any('unknown_total' in line for line in lines)
+
+
+def test_label_values_are_escaped():
+    metrics = Metrics()
+    metrics.inc('denzel_api_requests_total', route='/a"b\\c', status='200')
+
+    assert 'denzel_api_requests_total{route="/a\\"b\\\\c",status="200"} 1.0' in exposition(_snapshot(metrics), [])
+
+
+def test_forgets_processes_gone_for_long():
+    snapshots, forgotten = worker_snapshots({b'host:1': _payload(denzel_payloads_total=1),
+                                             b'host:2': _payload(FORGET_AGE + 1, denzel_payloads_total=2)})
+
+    assert [snapshot['counters']['denzel_payloads_total'] for snapshot in snapshots] == [{'': 1}]
+    assert forgotten == [b'host:2']
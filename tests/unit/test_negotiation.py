@@ -0,0 +1,27 @@
+import pytest
+from falcon import testing
+
+from app.codecs import accepted_media_type, JSON, MSGPACK
+
+
+@pytest.mark.parametrize('accept', [None, '', '*/*', 'application/*', 'application/json', 'text/html, */*;q=0.8'])
+def test_json_by_default(accept):
+    assert accepted_media_type(accept) == JSON
+
+
+@pytest.mark.parametrize('accept', ['application/msgpack', 'application/x-msgpack', 'application/msgpack, */*',
+                                    'application/json;q=0.5, application/msgpack'])
+def test_msgpack_when_named(accept):
+    assert accepted_media_type(accept) == MSGPACK
+
+
+@pytest.mark.parametrize('accept', ['application/msgpack;q=0', 'application/msgpack;q=0.5, application/json'])
+def test_json_when_preferred(accept):
+    assert accepted_media_type(accept) == JSON
+
+
+def test_request_accept_header():
+    # Falcon reports a missing Accept header as */*
+    assert accepted_media_type(testing.create_req().accept) == JSON
+    assert accepted_media_type(testing.create_req(headers={'Accept': '*/*'}).accept) == JSON
+    assert accepted_media_type(testing.create_req(headers={'Accept': 'application/msgpack'}).accept) == MSGPACK
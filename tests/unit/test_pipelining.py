@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+from app.metrics import Metrics
+from app.pipelining import PipelinedPredictor
+from app.tracing import Trace
+
+
+class Recorder(object):
+    """ Process and predict stages recording what they ran, from any thread """
+
+    def __init__(self, process_delay=0., predict_delay=0.):
+        self.events = []
+        self.processed = 0
+        self.predicted = 0
+        self.max_ahead = 0  # Most requests processed but not yet predicted
+        self._process_delay = process_delay
+        self._predict_delay = predict_delay
+        self._lock = threading.Lock()
+
+    def process(self, model, json_data):
+        time.sleep(self._process_delay)
+        if json_data == 'bad process':
+            raise ValueError(json_data)
+
+        with self._lock:
+            self.events.append(('process', json_data))
+            self.processed += 1
+        return json_data
+
+    def predict(self, model, data):
+        with self._lock:
+            self.events.append(('predict', data))
+            self.max_ahead = max(self.max_ahead, self.processed - self.predicted)
+        time.sleep(self._predict_delay)
+        if data == 'bad predict':
+            raise ValueError(data)
+
+        with self._lock:
+            self.predicted += 1
+        return '{} predicted'.format(data)
+
+
+def _predict_many(recorder, json_batch, threads=2, queue_size=2, predictor=None):
+    predictor = predictor or PipelinedPredictor(recorder.process, recorder.predict, Metrics())
+    traces = [Trace() for _ in json_batch]
+    return predictor.predict_many(None, json_batch, traces, threads, queue_size), traces
+
+
+def test_keeps_the_requests_order():
+    json_batch = ['request{}'.format(i) for i in range(10)]
+
+    outcomes, traces = _predict_many(Recorder(), json_batch, threads=4)
+
+    assert outcomes == [('{} predicted'.format(json_data), None) for json_data in json_batch]
+    assert all([stage for stage, _ in trace.stages] == ['received', 'process', 'predict'] for trace in traces)
+
+
+def test_failures_are_per_request():
+    outcomes, _ = _predict_many(Recorder(), ['ok', 'bad process', 'bad predict'])
+
+    assert outcomes[0] == ('ok predicted', None)
+    assert [(result, str(error)) for result, error in outcomes[1:]] == \
+        [(None, 'bad process'), (None, 'bad predict')]
+
+
+def test_overlaps_process_and_predict():
+    recorder = Recorder(process_delay=.01)
+    json_batch = ['request{}'.format(i) for i in range(5)]
+
+    _predict_many(recorder, json_batch, threads=1, queue_size=len(json_batch))
+
+    assert recorder.events.index(('predict', 'request0')) < recorder.events.index(('process', 'request4'))
+
+
+def test_bounds_the_processed_requests_waiting():
+    recorder = Recorder(predict_delay=.005)
+
+    outcomes, _ = _predict_many(recorder, list(range(30)), threads=2, queue_size=1)
+
+    assert len(outcomes) == 30
+    assert recorder.max_ahead <= 4  # One queued, one blocked per thread and the one being predicted
+
+
+@pytest.mark.parametrize('queue_size', [0, -1])
+def test_queue_holds_one_request_at_least(queue_size):
+    outcomes, _ = _predict_many(Recorder(), ['request'], queue_size=queue_size)
+
+    assert outcomes == [('request predicted', None)]
+
+
+def test_replaces_the_executor_when_threads_change():
+    recorder = Recorder()
+    predictor = PipelinedPredictor(recorder.process, recorder.predict, Metrics())
+
+    _predict_many(recorder, ['request'], threads=2, predictor=predictor)
+    executor = predictor._executor
+    _predict_many(recorder, ['request'], threads=2, predictor=predictor)
+    assert predictor._executor is executor
+
+    _predict_many(recorder, ['request'], threads=3, predictor=predictor)
+    assert predictor._executor is not executor
@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+import redis
+
+from app import tasks
+
+Model = type(tasks.Model)  # Registered as an instance, its state is kept by the class
+
+
+@pytest.fixture
+def preloaded(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(tasks, '_redis_client', client)
+    monkeypatch.setattr(Model, '_model', 'preloaded')
+    monkeypatch.setattr(Model, 'model_version', 'v1')
+    monkeypatch.setattr(Model, 'failed_model_version', None)
+    monkeypatch.setattr(tasks, 'load_model', lambda: 'loaded')
+    return client
+
+
+def test_keeps_current_model(preloaded):
+    preloaded.set('model_version', 'v1')
+
+    Model.load_current()
+
+    assert (Model.model_version, Model._model) == ('v1', 'preloaded')
+
+
+def test_loads_changed_version(preloaded):
+    preloaded.set('model_version', 'v2')
+
+    Model.load_current()
+
+    assert (Model.model_version, Model._model) == ('v2', 'loaded')
+
+
+def test_keeps_serving_when_loading_fails(preloaded, monkeypatch):
+    def load_model():
+        raise RuntimeError('corrupt')
+
+    monkeypatch.setattr(tasks, 'load_model', load_model)
+    preloaded.set('model_version', 'v2')
+
+    Model.load_current()
+
+    assert (Model.model_version, Model._model, Model.failed_model_version) == ('v1', 'preloaded', 'v2')
+
+
+def test_reloads_in_the_background(preloaded, monkeypatch):
+    started = []
+    monkeypatch.setattr(Model, '_reloading', False)
+    monkeypatch.setattr(Model, '_reloaded', ('v2', 'reloaded'))  # Waiting for the running task to end
+    monkeypatch.setattr(tasks.threading, 'Thread', lambda target=None, args=(), **kwargs: SimpleNamespace(
+        start=lambda: started.append(args)))
+
+    Model.reload('v2')  # Noticed again by a flush meanwhile
+    assert not started
+
+    Model.reload('v3')
+    assert started == [('v3',)]
+    Model.reload('v4')  # Until v3 is loaded
+    assert started == [('v3',)]
+
+
+def test_keeps_model_when_redis_is_unavailable(preloaded, monkeypatch):
+    def get(key):
+        raise redis.ConnectionError()
+
+    monkeypatch.setattr(preloaded, 'get', get)
+
+    Model.load_current()
+
+    assert (Model.model_version, Model._model) == ('v1', 'preloaded')
@@ -0,0 +1,72 @@
+import threading
+import time
+
+import celery
+import fakeredis
+import pytest
+from celery import states
+
+from app import results
+from app.results import fetch_statuses, wait_for_any, result_key
+from app.tracing import Trace, traced_result
+
+TIMEOUT = 5.
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(results, 'celery_app', celery.Celery('tests', backend='redis://'))  # Never connected
+    return fakeredis.FakeRedis()
+
+
+def _meta(status, result) -> bytes:
+    backend = results.celery_app.backend
+    if status == states.FAILURE:
+        result = backend.prepare_exception(result)
+    return backend.encode({'status': status, 'result': result, 'traceback': None, 'children': []})
+
+
+def _store(client, task_id, status, result):
+    client.set(result_key(task_id), _meta(status, result))
+
+
+def test_fetch_statuses(client):
+    _store(client, 'done', states.SUCCESS, {'prediction': 1})
+    _store(client, 'failed', states.FAILURE, ValueError('bad input'))
+    _store(client, 'sync', states.SUCCESS, traced_result(2, Trace('sync')))
+
+    assert fetch_statuses(client, ['done', 'failed', 'sync', 'unknown']) == {
+        'done': {'status': states.SUCCESS, 'result': {'prediction': 1}},
+        'failed': {'status': states.FAILURE, 'result': 'bad input'},
+        'sync': {'status': states.SUCCESS, 'result': 2},  # Without the worker's trace
+        'unknown': {'status': states.PENDING, 'result': None}}
+
+
+def test_wait_returns_when_already_ready(client):
+    _store(client, 'done', states.SUCCESS, 1)
+
+    start_time = time.monotonic()
+    wait_for_any(client, ['pending', 'done'], timeout=TIMEOUT)
+
+    assert time.monotonic() - start_time < TIMEOUT
+
+
+def test_wait_returns_when_a_task_is_ready(client):
+    def publish(status):
+        client.publish(result_key('task'), _meta(status, 1))
+
+    threading.Timer(.05, publish, args=(states.STARTED,)).start()  # Not ready yet
+    threading.Timer(.1, publish, args=(states.SUCCESS,)).start()
+
+    start_time = time.monotonic()
+    wait_for_any(client, ['other', 'task'], timeout=TIMEOUT)
+
+    assert .05 <= time.monotonic() - start_time < TIMEOUT  # Not before it was ready
+
+
+def test_wait_times_out(client):
+    start_time = time.monotonic()
+    wait_for_any(client, ['pending'], timeout=.1)
+
+    assert time.monotonic() - start_time >= .1
+    assert not client.pubsub_numsub(result_key('pending'))[0][1]  # Unsubscribed
@@ -0,0 +1,74 @@
+import time
+
+import fakeredis
+import pytest
+
+from app.runtime_config import RuntimeConfig, SETTINGS, CONFIG_CHANNEL, parse_settings
+
+TIMEOUT = 5.
+
+
+def _eventually(condition):
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        assert time.monotonic() < deadline, 'Not refreshed in time'
+        time.sleep(.01)
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis()
+
+
+def test_defaults(client):
+    config = RuntimeConfig(client)
+
+    assert config.snapshot() == {name: default for name, (_, default) in SETTINGS.items()}
+
+
+def test_reads_typed_settings(client):
+    client.set('batch_max_size', '8')
+    client.set('batch_max_wait', '0.5')
+    client.set('model_version', 'v2')
+
+    config = RuntimeConfig(client)
+
+    assert (config['batch_max_size'], config['batch_max_wait'], config['model_version']) == (8, .5, 'v2')
+
+
+def test_defaults_while_redis_is_down():
+    server = fakeredis.FakeServer()
+    server.connected = False
+
+    config = RuntimeConfig(fakeredis.FakeRedis(server=server))
+
+    assert config['batch_max_size'] == SETTINGS['batch_max_size'][1]
+
+
+def test_malformed_settings_are_unset(client):
+    client.set('batch_max_size', 'many')
+
+    assert RuntimeConfig(client)['batch_max_size'] == SETTINGS['batch_max_size'][1]
+
+
+def test_refreshes_when_notified(client):
+    config = RuntimeConfig(client)
+    _eventually(lambda: client.pubsub_numsub(CONFIG_CHANNEL)[0][1])  # Subscribed
+
+    client.set('synchronous_timeout', '0')
+    client.publish(CONFIG_CHANNEL, 'synchronous_timeout')
+
+    _eventually(lambda: config['synchronous_timeout'] == 0.)
+
+
+def test_refreshes_periodically(client):
+    config = RuntimeConfig(client, refresh_interval=.05)
+
+    client.set('cache_ttl', '60')  # Without a notification
+
+    _eventually(lambda: config['cache_ttl'] == 60.)
+
+
+def test_parse_settings():
+    assert parse_settings(['worker_drain_size', 'cache_ttl', 'model_version'], [b'4', None, b'v1']) == \
+        {'worker_drain_size': 4, 'cache_ttl': SETTINGS['cache_ttl'][1], 'model_version': 'v1'}
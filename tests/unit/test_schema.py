@@ -0,0 +1,117 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from app.schema import InputValidator, verifier, RECORD_IDS_FIELD
+
+SCHEMA = {'required': ['callback_uri'],
+          'features': {'height': 'float64', 'weight': 'float64', 'embedding': ('float32', (2,))}}
+
+
+def _request(records):
+    return {'callback_uri': 'http://callback', 'data': records}
+
+
+@pytest.fixture
+def validate():
+    return InputValidator(SCHEMA)
+
+
+def test_records_by_id(validate):
+    validated = validate(_request({'a': {'height': 1.5, 'weight': 2, 'embedding': [3, 4], 'extra': 'x'},
+                                   'b': {'height': 5, 'weight': 6., 'embedding': [7., 8.]}}))
+
+    assert validated[RECORD_IDS_FIELD] == ['a', 'b']
+    assert validated['data'].dtype == np.float64
+    assert validated['data'].tolist() == [[1.5, 2., 3., 4.], [5., 6., 7., 8.]]
+    assert validated['callback_uri'] == 'http://callback'
+
+
+def test_list_of_records():
+    validate = InputValidator({'features': {'x': 'int64', 'y': 'int64'}})
+    validated = validate({'data': [{'x': 1, 'y': 2}, {'x': 3, 'y': 4}]})
+
+    assert validated[RECORD_IDS_FIELD] == [0, 1]
+    assert validated['data'].tolist() == [[1, 2], [3, 4]]
+
+
+def test_columns(validate):
+    validated = validate(_request({'height': np.array([1., 2.]), 'weight': np.array([3, 4]),
+                                   'embedding': np.array([[5., 6.], [7., 8.]], dtype=np.float32)}))
+
+    assert validated[RECORD_IDS_FIELD] == [0, 1]
+    assert validated['data'].tolist() == [[1., 3., 5., 6.], [2., 4., 7., 8.]]
+
+
+def test_array(validate):
+    validated = validate(_request(np.arange(8, dtype=np.int32).reshape(2, 4)))
+
+    assert validated['data'].dtype == np.float64
+    assert validated['data'].shape == (2, 4)
+
+
+def test_no_records(validate):
+    assert validate(_request([]))['data'].shape == (0, 4)
+    assert validate(_request({}))['data'].shape == (0, 4)
+
+
+def test_leaves_request_intact(validate):
+    request = _request([{'height': 1., 'weight': 2., 'embedding': [3., 4.]}])
+
+    validate(request)
+
+    assert isinstance(request['data'], list) and RECORD_IDS_FIELD not in request
+
+
+@pytest.mark.parametrize('request_data', [
+    {'data': []},  # No callback_uri
+    {'callback_uri': 'http://callback'},  # No records
+    _request('records'),
+    _request([{'height': 1., 'weight': 2.}]),  # Missing feature
+    _request([{'height': 'tall', 'weight': 2., 'embedding': [3., 4.]}]),
+    _request([{'height': 1., 'weight': 2., 'embedding': [3., 4., 5.]}]),  # Wrong shape
+    _request([{'height': 1., 'weight': 2., 'embedding': 3.}]),
+    _request([[1., 2., 3., 4.]]),  # Not a mapping
+    _request({'height': np.array([1.]), 'weight': np.array([2.])}),  # Missing column
+    _request(np.zeros((2, 3))),  # Wrong number of columns
+])
+def test_rejects(validate, request_data):
+    with pytest.raises(ValueError):
+        validate(request_data)
+
+
+def test_uniform_features_must_be_single_values():
+    validate = InputValidator({'features': {'x': 'float64', 'y': 'float64'}})
+
+    with pytest.raises(ValueError):
+        validate({'data': [{'x': [1., 2.], 'y': [3., 4.]}]})
+
+    with pytest.raises(ValueError):
+        validate({'data': [{'x': 1., 'y': 2.}, {'x': 1., 'y': [2., 3.]}]})
+
+
+def test_integer_features_reject_floats():
+    validate = InputValidator({'features': {'count': 'int64'}})
+
+    assert validate({'data': [{'count': True}, {'count': 2}]})['data'].tolist() == [[1], [2]]
+    with pytest.raises(ValueError):
+        validate({'data': [{'count': 1.5}]})
+
+
+def test_requires_features():
+    with pytest.raises(ValueError):
+        InputValidator({'features': {}})
+
+
+def test_verifier():
+    def verify_input(json_data):
+        json_data['verified'] = True
+        return json_data
+
+    pipeline = SimpleNamespace(verify_input=verify_input)
+    assert verifier(pipeline) is verify_input
+
+    pipeline.INPUT_SCHEMA = {'features': {'x': 'float64'}}
+    verified = verifier(pipeline)({'data': [{'x': 1}]})
+    assert verified['verified'] and verified['data'].tolist() == [[1.]]
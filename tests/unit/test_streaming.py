@@ -0,0 +1,114 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from celery import states
+
+from app import streaming
+from app.streaming import stream_predictions, stream_predictions_async
+
+TIMEOUT = 5.
+
+
+class Task(object):
+    """ Predicts a chunk's records by doubling their 'x' field, or fails """
+
+    def __init__(self, json_batch, error=None):
+        self.id = 'task{}'.format(json_batch[0]['x'])
+        self.json_batch = json_batch
+        self.error = error
+
+    def get(self, timeout=None):
+        if self.error is not None:
+            raise self.error
+        return [{'status': states.SUCCESS, 'result': json_data['x'] * 2} for json_data in self.json_batch]
+
+
+@pytest.fixture
+def dispatched(monkeypatch):
+    """ Records the tasks sent, which fail for records with x == 'fail' """
+
+    tasks = []
+
+    def dispatch(chunk):
+        json_batch = [json_data for _, json_data, error in chunk if error is None]
+        if not json_batch:
+            return None
+        failing = any(json_data['x'] == 'fail' for json_data in json_batch)
+        tasks.append(Task(json_batch, RuntimeError('worker died') if failing else None))
+        return tasks[-1]
+
+    monkeypatch.setattr(streaming, 'verify_input', lambda json_data: json_data)
+    monkeypatch.setattr(streaming, '_dispatch', dispatch)
+    return tasks
+
+
+def _lines(*values, read=None):
+    for value in values:
+        if read is not None:
+            read.append(value)
+        yield value if isinstance(value, bytes) else json.dumps({'x': value}).encode()
+
+
+def _responses(chunks) -> list:
+    return [json.loads(line) for chunk in chunks for line in chunk.splitlines()]
+
+
+def test_reads_only_within_the_window(dispatched):
+    read = []
+    responses = stream_predictions(_lines(*range(10), read=read), chunk_size=2, window=2, timeout=TIMEOUT)
+
+    next(responses)
+    assert len(read) == 4  # Two chunks in flight
+    next(responses)
+    assert len(read) == 6
+
+    list(responses)
+    assert len(read) == 10
+    assert len(dispatched) == 5
+
+
+def test_responses_keep_the_order_of_records(dispatched):
+    chunks = stream_predictions(_lines(1, b'not json', b'', 2, 3), chunk_size=2, window=1, timeout=TIMEOUT)
+
+    responses = _responses(chunks)
+
+    assert [(response['index'], response['status']) for response in responses] == \
+        [(0, states.SUCCESS), (1, states.FAILURE), (2, states.SUCCESS), (3, states.SUCCESS)]
+    assert [response['result'] for response in responses if response['status'] == states.SUCCESS] == [2, 4, 6]
+
+
+def test_failed_chunks_fail_their_records_only(dispatched):
+    responses = _responses(stream_predictions(_lines(1, 'fail', 2), chunk_size=2, window=4, timeout=TIMEOUT))
+
+    assert [response['status'] for response in responses] == [states.FAILURE, states.FAILURE, states.SUCCESS]
+    assert responses[0]['result'] == 'worker died'
+
+
+def test_async_reads_only_within_the_window(dispatched):
+    read = []
+
+    async def stream():
+        for line in _lines(*range(6), read=read):
+            yield line + b'\n'
+
+    async def wait(task_id, timeout=None):
+        task = next(task for task in dispatched if task.id == task_id)
+        return {'status': states.SUCCESS, 'result': task.get()}
+
+    async def predict():
+        responses = stream_predictions_async(stream(), chunk_size=2, window=1, timeout=TIMEOUT,
+                                             listener=SimpleNamespace(wait=wait))
+        first = await responses.__anext__()
+        read_by_first = len(read)
+        return [first] + [chunk async for chunk in responses], read_by_first
+
+    loop = asyncio.new_event_loop()
+    try:
+        chunks, read_by_first = loop.run_until_complete(predict())
+    finally:
+        loop.close()
+
+    assert read_by_first == 2  # The first chunk only
+    assert [response['result'] for response in _responses(chunks)] == [0, 2, 4, 6, 8, 10]
@@ -0,0 +1,62 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from click.testing import CliRunner
+
+from denzel_cli import utils
+from denzel_cli.scripts import cli
+
+TRACES = [{'id': 'fast', 'stages': [['sent', 10.], ['queue', 10.001], ['predict', 10.002]]},
+          {'id': 'slow', 'stages': [['sent', 20.], ['queue', 20.01], ['process', 20.0125], ['predict', 20.02]]}]
+
+
+@pytest.fixture
+def redis(tmp_path, monkeypatch):
+    """ Answers the redis-cli commands of the trace command from TRACES, stored as traces are """
+
+    monkeypatch.chdir(str(tmp_path))
+    (tmp_path / '.env').write_text('')  # Inside a project
+
+    stored = {'fast': json.dumps(TRACES[0])}
+
+    def redis_command(*args, shell=False):
+        if args[0] == 'get':
+            output = stored.get(args[1].split(':')[-1], '')
+        else:  # xrevrange, an entry ID, field and value per trace
+            output = '\n'.join('{}-0\ntrace\n{}'.format(index, json.dumps(trace))
+                               for index, trace in enumerate(reversed(TRACES)))
+        return SimpleNamespace(output=(output + '\n').encode(), exit_code=0)
+
+    monkeypatch.setattr(utils, 'redis_command', redis_command)
+
+
+def _invoke(*args) -> list:
+    result = CliRunner().invoke(cli.trace, list(args))
+    assert result.exit_code == 0, result.output
+    return result.output.splitlines()
+
+
+def test_trace_of_a_request(redis):
+    assert _invoke('fast') == ['Trace of fast [ Total: 2.000 ms ]',
+                               '\tqueue            1.000 ms',
+                               '\tpredict          1.000 ms']
+
+
+def test_trace_found_in_the_stream(redis):
+    assert _invoke('slow')[0] == 'Trace of slow [ Total: 20.000 ms ]'
+
+
+def test_slowest_traces(redis):
+    lines = _invoke('--slowest', '1')
+
+    assert lines[0].split() == ['Task', 'ID', 'Total', '(ms)', 'Stages', '(ms)']
+    assert lines[1].split() == ['slow', '20.000', 'queue=10.0', 'process=2.5', 'predict=7.5']
+    assert len(lines) == 2
+
+
+def test_unknown_trace(redis):
+    result = CliRunner().invoke(cli.trace, ['gone'])
+
+    assert result.exit_code != 0
+    assert 'No trace of gone' in result.output
@@ -0,0 +1,35 @@
+from app.tracing import Trace, traced_result, untraced_result
+
+
+def test_traced_result_round_trip():
+    trace = Trace('task')
+    trace.mark('queue')
+    trace.mark('predict')
+    trace.model_version = '20261018'
+
+    result, worker_trace = untraced_result(traced_result({'a123': 'Iris-setosa'}, trace))
+
+    assert result == {'a123': 'Iris-setosa'}
+    assert worker_trace.trace_id == 'task'
+    assert worker_trace.stages == trace.stages
+    assert worker_trace.model_version == '20261018'
+
+
+def test_untraced_result_of_plain_result():
+    assert untraced_result({'a123': 'Iris-setosa'}) == ({'a123': 'Iris-setosa'}, None)
+    assert untraced_result(None) == (None, None)
+
+
+def test_update_adopts_longer_trace():
+    api_trace = Trace('task')
+    api_trace.mark('enqueue')
+    worker_trace = Trace.from_dict(api_trace.to_dict())
+    worker_trace.mark('queue')
+    worker_trace.model_version = '1'
+
+    api_trace.update(worker_trace)
+    api_trace.mark('respond')
+
+    assert [stage for stage, _ in api_trace.durations()] == ['enqueue', 'queue', 'respond']
+    assert api_trace.model_version == '1'
+    assert 'total;dur=' in api_trace.server_timing()
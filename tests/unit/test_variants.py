@@ -0,0 +1,127 @@
+import threading
+import time
+
+import pytest
+
+from app import variants
+from app.metrics import Metrics
+from app.variants import VariantCache
+
+TIMEOUT = 5.
+SIZES = {'small': 10, 'medium': 15, 'large': 30}
+
+
+class Loader(object):
+    """ Loads variants as their names, growing the resident memory faked by rss by the variant's size """
+
+    def __init__(self):
+        self.rss = 0
+        self.loaded = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, variant):
+        self.started.set()
+        self.release.wait(TIMEOUT)
+        if variant == 'broken':
+            raise ValueError('no such variant')
+
+        self.loaded.append(variant)
+        self.rss += SIZES.get(variant, 0)
+        return variant
+
+
+@pytest.fixture
+def loader(monkeypatch):
+    loader = Loader()
+    monkeypatch.setattr(variants, 'process_memory', lambda: {'rss': loader.rss})
+    return loader
+
+
+def _cache(loader, max_memory=1024):
+    return VariantCache(loader, {'variant_max_memory': max_memory}, Metrics())
+
+
+def _requests(cache) -> dict:
+    return cache._metrics.snapshot()['counters']['denzel_variant_requests_total']
+
+
+def _wait_coalesced(cache, count):
+    deadline = time.monotonic() + TIMEOUT
+    while _requests(cache).get('{outcome="coalesced"}', 0) < count and time.monotonic() < deadline:
+        time.sleep(.001)
+
+
+def test_loads_variants_once(loader):
+    cache = _cache(loader)
+
+    assert [cache.get(variant) for variant in ('small', 'medium', 'small')] == ['small', 'medium', 'small']
+    assert loader.loaded == ['small', 'medium']
+    assert cache.memory == 25
+    assert _requests(cache) == {'{outcome="miss"}': 2., '{outcome="hit"}': 1.}
+
+
+def test_evicts_least_recently_used(loader):
+    cache = _cache(loader, max_memory=25)
+    cache.get('small')
+    cache.get('medium')
+    cache.get('small')  # Used, so medium is evicted next
+
+    cache.get('medium')
+    cache.get('large')
+
+    assert list(cache._variants) == ['large']  # Kept even though larger than variant_max_memory
+    assert cache.memory == 30
+    assert cache._metrics.snapshot()['counters']['denzel_variant_evictions_total'] == {'': 2.}
+
+    cache.get('small')
+    assert list(cache._variants) == ['small']
+
+
+def test_coalesces_variants_being_loaded(loader):
+    cache = _cache(loader)
+    loader.release.clear()
+
+    models = []
+    tasks = [threading.Thread(target=lambda: models.append(cache.get('small'))) for _ in range(3)]
+    tasks[0].start()
+    loader.started.wait(TIMEOUT)
+    for task in tasks[1:]:
+        task.start()
+    _wait_coalesced(cache, 2)
+    loader.release.set()
+    for task in tasks:
+        task.join(TIMEOUT)
+
+    assert models == ['small'] * 3
+    assert loader.loaded == ['small']
+
+
+def test_failures_are_not_cached(loader):
+    cache = _cache(loader)
+    loader.release.clear()
+
+    errors = []
+
+    def get():
+        try:
+            cache.get('broken')
+        except ValueError as ex:
+            errors.append(ex)
+
+    tasks = [threading.Thread(target=get) for _ in range(2)]
+    tasks[0].start()
+    loader.started.wait(TIMEOUT)
+    tasks[1].start()
+    _wait_coalesced(cache, 1)
+    loader.release.set()
+    for task in tasks:
+        task.join(TIMEOUT)
+
+    assert len(errors) == 2  # The waiting task gets the failure too
+    assert not cache._variants and not cache._loading
+
+    with pytest.raises(ValueError):
+        cache.get('broken')  # Loaded again
+    assert _requests(cache)['{outcome="miss"}'] == 2.